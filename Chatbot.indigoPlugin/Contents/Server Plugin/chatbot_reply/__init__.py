@@ -3,10 +3,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from .exceptions import PatternError, NoRulesFoundError, RecursionTooDeepError
-from .exceptions import PatternVariableNotFoundError
-from .script import rule, Script, split_on_whitespace, kill_non_alphanumerics
+from .exceptions import PatternVariableNotFoundError, UserStateConflictError
+from .script import rule, substitution, Script
+from .script import split_on_whitespace, kill_non_alphanumerics
 from .script import UserInfo
+from .responses import ResponseTable
 from .reply import ChatbotEngine
+from .users import UserStore, MemoryUserStore
+from .sqlite_store import SQLiteUserStore, SharedSQLiteUserStore
+from .normalizer import Normalizer
 
 # Set default logging handler to avoid "No handler found" warnings.
 import logging
@@ -19,7 +24,10 @@ except ImportError:
 
 logging.getLogger(__name__).addHandler(NullHandler())
 
-__all__ = ["ChatbotEngine", "Script", "rule", "UserInfo", "PatternError",
+__all__ = ["ChatbotEngine", "Script", "rule", "substitution", "UserInfo",
+           "UserStore", "MemoryUserStore", "SQLiteUserStore",
+           "SharedSQLiteUserStore", "Normalizer", "ResponseTable",
+           "UserStateConflictError", "PatternError",
            "PatternVariableNotFoundError", "NoRulesFoundError",
            "RecursionTooDeepError", "split_on_whitespace",
            "kill_non_alphanumerics"]
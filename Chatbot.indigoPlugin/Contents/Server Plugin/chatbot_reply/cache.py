@@ -0,0 +1,66 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.cache, a small bounded cache that counts its hits
+"""
+from __future__ import unicode_literals
+
+import collections
+
+CacheInfo = collections.namedtuple("CacheInfo",
+                                   ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache(object):
+    """ A dictionary with a maximum size, which when full discards the
+    entry that was least recently used. Keeps count of hits and misses,
+    like functools.lru_cache.
+
+    Public methods:
+    get - look up a key, and count a hit or a miss
+    put - add or replace an entry
+    clear - empty the cache, without resetting the hit and miss counts
+    info - return a CacheInfo tuple
+    """
+    def __init__(self, maxsize=1000):
+        """ Create an empty cache. If maxsize is 0 the cache will never
+        store anything. """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """ Return the value for key, and mark it as recently used. If
+        key is not in the cache, return default. """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Add an entry to the cache, discarding the least recently used
+        entry if the cache is full. """
+        if self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
@@ -32,7 +32,13 @@ class NoRulesFoundError(Exception):
     pass
 
 
+class UserStateConflictError(Exception):
+    """ Raised by a shared user store when a user was changed by another
+    engine since this one loaded them. """
+    pass
+
+
 class RecursionTooDeepError(Exception):
     """ Raised by reply.reply when recursively expanding replies goes
-    over the recursion depth limit."""
+    over the recursion depth limit, or when a reply refers to itself."""
     pass
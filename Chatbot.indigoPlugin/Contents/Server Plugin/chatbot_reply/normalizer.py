@@ -0,0 +1,199 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.normalizer, folds the different forms of a word into one,
+so that "lights", "lighting" and "lamp" can all match the same rules
+"""
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from chatbot_reply.script import normalize_words
+
+_VOWELS = "aeiou"
+_DOUBLES = re.compile(r"([^aeiouylsz])\1$", flags=re.UNICODE)
+
+
+class Normalizer(object):
+    """ Transform each word of messages and patterns, after they have been
+    made lower case and had their punctuation removed, so that different
+    forms of a word match each other. The steps, each of which may be
+    turned on or off, are done in this order:
+
+        fold_accents - remove accents, so "caf\u00e9" becomes "cafe"
+        stem - remove common English suffixes, so "lights" and "lighting"
+            become "light" (see stem)
+        synonyms - a dictionary of words and the words to put in their
+            place, such as {"lamp": "light"}. The keys and values go through
+            the steps before this one, so they may be written in any form.
+        transforms - a list of functions to call last, each of which is
+            passed a word and returns the word to put in its place
+
+    Since the same few hundred words come up again and again, the result
+    for each word is remembered, in a dictionary which is emptied when it
+    holds more than cache_size words. Looking words up in a dictionary is
+    safe without a lock, and much quicker than keeping an LRUCache in
+    order.
+
+    The engine gives its Normalizer to its Targets and Patterns, so
+    messages and patterns are always transformed the same way. The words
+    in match variables are transformed too, while the raw_match variables
+    keep the words as they were typed.
+
+    Public methods:
+    normalize_word - transform a word
+    normalize_words - transform a list of words
+    normalize_text - transform the words of a string separated by spaces
+    """
+    def __init__(self, fold_accents=False, stem=False, synonyms=None,
+                 transforms=(), cache_size=10000):
+        self.fold_accents = fold_accents
+        self.stem = stem
+        self.transforms = tuple(transforms)
+        self.cache_size = cache_size
+        self._cache = {"": ""}
+        self.synonyms = {}
+        for word, synonym in (synonyms or {}).items():
+            key, value = self._prepare(word), self._prepare(synonym)
+            if not key or not value or " " in key + value:
+                raise ValueError('Synonyms must be single words, not "{0}" '
+                                 'and "{1}"'.format(word, synonym))
+            self.synonyms[key] = value
+
+    def _prepare(self, word):
+        """ Put a word of a synonyms dictionary in the form it will be
+        looked up in. """
+        word = " ".join(normalize_words(word.split()))
+        if self.fold_accents:
+            word = fold_accents(word)
+        if self.stem:
+            word = " ".join([stem(w) for w in word.split()])
+        return word
+
+    def __getstate__(self):
+        return (self.fold_accents, self.stem, self.synonyms, self.transforms,
+                self.cache_size)
+
+    def __setstate__(self, state):
+        (self.fold_accents, self.stem, self.synonyms, self.transforms,
+         self.cache_size) = state
+        self._cache = {"": ""}
+
+    def __eq__(self, other):
+        return (isinstance(other, Normalizer) and
+                self.__getstate__()[:4] == other.__getstate__()[:4])
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def normalize_word(self, word):
+        """ Return a word after the steps turned on for this Normalizer.
+        Empty words are left alone. """
+        result = self._cache.get(word)
+        if result is None:
+            result = word
+            if self.fold_accents:
+                result = fold_accents(result)
+            if self.stem:
+                result = stem(result)
+            result = self.synonyms.get(result, result)
+            for transform in self.transforms:
+                result = transform(result)
+            if len(self._cache) >= self.cache_size:
+                self._cache = {"": ""}
+            self._cache[word] = result
+        return result
+
+    def normalize_words(self, words):
+        """ Return a list of the words after normalize_word. """
+        get = self._cache.get
+        results = [get(word) for word in words]
+        if None in results:
+            results = [self.normalize_word(word) if result is None else result
+                       for word, result in zip(words, results)]
+        return results
+
+    def normalize_text(self, text):
+        """ Return a string of words separated by single spaces after
+        normalize_word. """
+        return " ".join(self.normalize_words(text.split(" ")))
+
+
+def fold_accents(word):
+    """ Return a word with the accents removed from its letters. """
+    decomposed = unicodedata.normalize("NFKD", word)
+    return "".join([c for c in decomposed if not unicodedata.combining(c)])
+
+
+def stem(word):
+    """ Remove the plural and verb endings from a lower case English word,
+    following step 1 of the Porter stemming algorithm: "lights",
+    "lighting" and "lighted" become "light", and "ponies" becomes "poni".
+    Words of three letters or fewer, such as "is" and "was", are left
+    alone. Stems aren't always words, but the same stem is made from the
+    same word in messages and patterns, which is all matching needs.
+    """
+    if len(word) <= 3:
+        return word
+
+    if word.endswith("sses") or word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+
+    if word.endswith("eed"):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ("ed", "ing"):
+            if word.endswith(suffix) and _has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if word.endswith(("at", "bl", "iz")):
+                    word += "e"
+                elif _DOUBLES.search(word):
+                    word = word[:-1]
+                elif _measure(word) == 1 and _ends_cvc(word):
+                    word += "e"
+                break
+
+    if word.endswith("y") and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+    return word
+
+
+def _consonants(word):
+    """ Return a list of True for each consonant in word and False for each
+    vowel, counting y as a vowel when it follows a consonant. """
+    result = []
+    for i, c in enumerate(word):
+        if c in _VOWELS:
+            result.append(False)
+        elif c == "y":
+            result.append(i == 0 or not result[-1])
+        else:
+            result.append(True)
+    return result
+
+
+def _measure(word):
+    """ Return the number of vowel-consonant sequences in word. """
+    consonants = _consonants(word)
+    return sum([1 for i in range(1, len(consonants))
+                if consonants[i] and not consonants[i - 1]])
+
+
+def _has_vowel(word):
+    return not all(_consonants(word))
+
+
+def _ends_cvc(word):
+    """ Return True if word ends with a consonant, a vowel and a consonant
+    other than w, x or y, as in "hop". """
+    if len(word) < 3 or word[-1] in "wxy":
+        return False
+    consonants = _consonants(word[-3:])
+    return consonants[0] and not consonants[1] and consonants[2]
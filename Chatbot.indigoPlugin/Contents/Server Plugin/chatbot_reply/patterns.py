@@ -103,9 +103,14 @@ class StopScanLoop(StopIteration):
 
 class Token(object):
     """ Parent class of all the types of token that can be found by the parser.
-    The only thing this does is make isinstance(obj, Token) work.
+    It makes isinstance(obj, Token) work, and gives the tokens which don't
+    contain words a normalize method which does nothing. Token classes use
+    __slots__, since a large set of rules makes a lot of them.
     """
-    pass
+    __slots__ = ()
+
+    def normalize(self, normalizer):
+        pass
 
 
 class Wild(Token):
@@ -117,6 +122,7 @@ class Wild(Token):
         maximum that the user did specify. Is a positive integer stored
         as a string.
     """
+    __slots__ = ("wild", "minimum", "maximum")
     regexc = re.compile(r".(\d*)(~?)(\d*)", re.UNICODE)
     wildcards = {"@": r"[^_\d\W]+",
                  "#": r"\d+",
@@ -179,6 +185,8 @@ class Word(Token):
     text - one or multiple words separated by spaces. String.
 
     """
+    __slots__ = ("text",)
+
     def __init__(self, tokens, text, terminator):
         self.text = text
 
@@ -198,6 +206,9 @@ class Word(Token):
     def score(self):
         return len(self.text.split(" ")) * _WORD_SCORE
 
+    def normalize(self, normalizer):
+        self.text = normalizer.normalize_text(self.text)
+
     def regex(self, variables, counter):
         return self.text + r"\b"
 
@@ -207,6 +218,8 @@ class Memo(Token):
     item - a Token to be placed in a named group when the regular expression
         is generated
     """
+    __slots__ = ("item",)
+
     def __init__(self, tokens, text, terminator):
         self.item = ParsedPattern(tokens, just_one=True).contents[0]
 
@@ -219,6 +232,9 @@ class Memo(Token):
     def score(self):
         return self.item.score()
 
+    def normalize(self, normalizer):
+        self.item.normalize(normalizer)
+
     def regex(self, variables, counter):
         return "(?P<match{0}>{1})".format(next(counter),
                                           self.item.regex(variables, counter))
@@ -227,6 +243,8 @@ class Memo(Token):
 class Space(Token):
     """ Parse and represent whitespace.
     """
+    __slots__ = ()
+
     def __init__(self, tokens, text, terminator):
         pass
 
@@ -252,11 +270,16 @@ class Variable(Token):
     """ Parse and represent variables. Instance variables:
     var_id - the one character variable type between % and : in the pattern
     var_name - variable name following : in the pattern
+    normalizer - the Normalizer for the words of the variable's value, or
+        None
 
     """
+    __slots__ = ("var_id", "var_name", "normalizer")
+
     def __init__(self, tokens, text, terminator):
         self.var_id = text[1]
         self.var_name = ParsedPattern(tokens, just_one=True).contents[0].text
+        self.normalizer = None
 
     def add_to_parsetree(self, parsetree):
         parsetree.contents.append(self)
@@ -267,6 +290,9 @@ class Variable(Token):
     def score(self):
         return _VARIABLE_SCORE
 
+    def normalize(self, normalizer):
+        self.normalizer = normalizer
+
     def regex(self, variables, counter):
         if (self.var_id not in variables or
                 self.var_name not in variables[self.var_id]):
@@ -282,6 +308,8 @@ class Variable(Token):
         value = value.lower()
         try:
             parse_tree = ParsedPattern(value, simple=True)
+            if self.normalizer is not None:
+                parse_tree.normalize(self.normalizer)
             regex = parse_tree.regex(None)
         except PatternError as e:
             msg = " in variable %{0}:{1}".format(self.var_id, self.var_name)
@@ -296,6 +324,8 @@ class Optional(Token):
     choices - a ParseTree containing ParseTrees, one for each sub-pattern
     separated by |'s within the square brackets.
     """
+    __slots__ = ("choices",)
+
     def __init__(self, tokens, text, terminator):
         self.choices = ParsedPattern(tokens, terminator="]")
 
@@ -309,6 +339,9 @@ class Optional(Token):
     def score(self):
         return max([chunk.score() for chunk in self.choices.contents])
 
+    def normalize(self, normalizer):
+        self.choices.normalize(normalizer)
+
     def regex(self, variables, counter):
         output = [chunk.regex(variables, counter)
                   for chunk in self.choices.contents]
@@ -320,6 +353,8 @@ class Group(Token):
     choices - a ParseTree containing ParseTrees, one for each sub-pattern
     separated by |'s within the parentheses.
     """
+    __slots__ = ("choices",)
+
     def __init__(self, tokens, text, terminator):
         self.choices = ParsedPattern(tokens, terminator=")")
 
@@ -333,6 +368,9 @@ class Group(Token):
     def score(self):
         return max([chunk.score() for chunk in self.choices.contents])
 
+    def normalize(self, normalizer):
+        self.choices.normalize(normalizer)
+
     def regex(self, variables, counter):
         output = [chunk.regex(variables, counter)
                   for chunk in self.choices.contents]
@@ -342,6 +380,8 @@ class Group(Token):
 class Terminator(Token):
     """ Parse the terminator characters ) and ]
     """
+    __slots__ = ()
+
     def __init__(self, tokens, text, terminator):
         if terminator != text:
             raise PatternError("Found an unexpected {0}".format(text))
@@ -355,6 +395,8 @@ class Terminator(Token):
 class Pipe(Token):
     """ Parse the separator character |
     """
+    __slots__ = ()
+
     def __init__(self, tokens, text, terminator):
         if terminator != ")" and terminator != "]":
             raise PatternError("Alternatives operator | must be "
@@ -370,6 +412,8 @@ class Invalid(Token):
     """ Throw a PatternError, used when the tokenizer finds an unknown
     character.
     """
+    __slots__ = ()
+
     def __init__(self, tokens, text, terminator):
         raise PatternError("Found an unexpected character {0}".format(text))
 
@@ -450,6 +494,7 @@ class PatternTokenizer(object):
 
 
 class ParsedPattern(object):
+    __slots__ = ("contents",)
     pp = PatternTokenizer(simple=False)
     pp_simple = PatternTokenizer(simple=True)
 
@@ -542,6 +587,13 @@ class ParsedPattern(object):
         """
         return sum(token.score() for token in self.contents)
 
+    def normalize(self, normalizer):
+        """ Pass the words of the pattern through a Normalizer (see
+        normalizer.py), so that they match the words of messages passed
+        through the same one. """
+        for token in self.contents:
+            token.normalize(normalizer)
+
     def regex(self, variables, counter=None):
         """ Generate a regular expression from the parsed pattern,
         substituting in variable values if given.
@@ -586,21 +638,75 @@ class ParsedPattern(object):
 
 
 class Pattern(object):
+    """ A pattern string, parsed and compiled into a regular expression.
+
+    Public instance variables:
+    raw - the pattern string
+    alternates - the dictionary of variables which may be used at compile
+        time, given to the constructor
+    normalizer - the Normalizer (see normalizer.py) the words of the
+        pattern are passed through, or None
+    formatted_pattern - the pattern with its spacing normalized
+    score - a number to compare this pattern with others for specificity
+    regexc - the compiled regular expression, or None if the pattern uses
+        variables which can only be found out when matching
+    parse_tree - the ParsedPattern, which is let go once the regular
+        expression is compiled and made again if anything asks for it
+
+    Public methods:
+    regex - make a regular expression, given the values of variables
+    match - match a target string
+
+    When pickled, the parse tree is left out unless it is still needed.
+    """
+    __slots__ = ("raw", "alternates", "simple", "normalizer",
+                 "formatted_pattern", "score", "regexc", "_parse_tree")
 
-    def __init__(self, raw, alternates=None, simple=False):
+    def __init__(self, raw, alternates=None, simple=False, normalizer=None):
         self.raw = raw
         self.alternates = alternates
+        self.simple = simple
+        self.normalizer = normalizer
         if self.raw:
-            self._parse_tree = ParsedPattern(raw, simple=simple)
+            self._parse_tree = self._parse()
             self.formatted_pattern = self._parse_tree.format()
             self.score = self._parse_tree.score()
             self.regexc = self._cache_regexc(alternates)
+            if self.regexc is not None:
+                self._parse_tree = None
         else:
             self._parse_tree = None
             self.formatted_pattern = ""
             self.score = _WILDCARD_SCORE
             self.regexc = None
 
+    def __getstate__(self):
+        return (self.raw, self.alternates, self.simple, self.normalizer,
+                self.formatted_pattern, self.score, self.regexc)
+
+    def __setstate__(self, state):
+        (self.raw, self.alternates, self.simple, self.normalizer,
+         self.formatted_pattern, self.score, self.regexc) = state
+        self._parse_tree = None
+        if self.raw and self.regexc is None:
+            self._parse_tree = self._parse()
+
+    def _parse(self):
+        parse_tree = ParsedPattern(self.raw, simple=self.simple)
+        if self.normalizer is not None:
+            parse_tree.normalize(self.normalizer)
+        return parse_tree
+
+    @property
+    def parse_tree(self):
+        """ The ParsedPattern for raw, which is parsed again if it was let
+        go after compiling the regular expression. """
+        if self._parse_tree is not None:
+            return self._parse_tree
+        if not self.raw:
+            return None
+        return self._parse()
+
     def __bool__(self):
         return len(self.raw) != 0
 
@@ -618,15 +724,15 @@ class Pattern(object):
             return None
 
     def regex(self, variables):
-        return self._parse_tree.regex(variables) + "$"
+        return self.parse_tree.regex(variables) + "$"
 
     def match(self, string, variables):
-        allvars = {}
-        allvars.update(self.alternates)
-        allvars.update(variables)
         if self.regexc:
-            m = re.match(self.regexc, string)
+            m = self.regexc.match(string)
         else:
+            allvars = {}
+            allvars.update(self.alternates)
+            allvars.update(variables)
             try:
                 regex = self.regex(allvars)
             except PatternVariableNotFoundError as e:
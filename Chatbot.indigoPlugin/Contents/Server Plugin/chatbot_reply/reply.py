@@ -9,22 +9,41 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
+import bisect
+import hashlib
+import hmac
 import logging
+import os
 import re
+import threading
+import weakref
 
 from chatbot_reply.six import get_method_self, text_type
+from chatbot_reply.six.moves import cPickle as pickle
 
+from chatbot_reply.cache import LRUCache
 from chatbot_reply.rules import RulesDB
 from chatbot_reply.script import Script, UserInfo
-from chatbot_reply.script import kill_non_alphanumerics, split_on_whitespace
+from chatbot_reply.users import UserTable
+from chatbot_reply.script import normalize_words
+from chatbot_reply.substitutions import TokenBuffer
 from chatbot_reply.exceptions import *
 
-# todo use imp thread locking, though this thing is totally not thread-safe
 # should case sensitivity be an option?
 # If we decide to rerun setup methods, need to reparse alternates
 
 log = logging.getLogger(__name__)
 
+_REFERENCE_RE = re.compile("<(.*?)>", flags=re.UNICODE)
+_WORD_RE = re.compile(r"\S+", flags=re.UNICODE)
+_SNAPSHOT_VERSION = 2
+_USER_STATE_VERSION = 1
+
+# held for the whole of every load of scripts, by all engines, since
+# loading fills the registry of Script classes, which is shared
+_load_lock = threading.RLock()
+
 
 class ChatbotEngine(object):
     """ Python Chatbot Reply Generator
@@ -38,36 +57,255 @@ class ChatbotEngine(object):
 
     Public instance methods:
       load_script_directory: loads rules from a directory of python files
+      load_rules: loads rules from directories of python files into a new
+              rules database, and replaces the old one with it
+      reload_script_directory: reloads only the changed files in a directory
       clear_rules: empties the rule database
       reply: given a message, find the best matching rule, run it, and return
               the reply
+      reply_stateless: like reply, but for a user whose state the caller
+              keeps, see encode_user_state
+      cache_info: return hit and miss statistics for the engine's caches
+      set_user_limits: change the limits on the number of users kept
+      user_table_info: return statistics about the users kept
+      close: write out and close the user store, if there is one
+      snapshot: save the state of the engine to a file
+      restore: load scripts and state saved by snapshot
     """
 
-    def __init__(self, depth=50):
+    def __init__(self, depth=50, reply_cache_size=1000,
+                 target_cache_size=1000, max_users=0, idle_timeout=0,
+                 user_store=None, state_key=None, normalizer=None):
         """Initialize a new ChatbotEngine.
 
-        Keyword argument:
+        Keyword arguments:
         depth -- Recursion depth limit for replies that reference other replies
+        reply_cache_size -- Number of replies from rules declared pure
+            to remember
+        target_cache_size -- Number of normalized messages and replies
+            to remember
+        max_users -- Number of users to keep, or 0 for no limit. When
+            there are more, the one who sent a message least recently is
+            evicted.
+        idle_timeout -- Number of seconds after which users who haven't
+            sent a message are evicted, or 0 to keep them
+        user_store -- a UserStore (see users.py) to save evicted users in,
+            so they can be restored on their next message. If None, evicted
+            users are forgotten. If the store is persistent, such as a
+            SQLiteUserStore (see sqlite_store.py), all users are saved
+            to it after each reply, so they survive a restart. If it is
+            shared, such as a SharedSQLiteUserStore, several engines may
+            use it to talk to the same users.
+        state_key -- a bytestring used to sign the user state returned by
+            reply_stateless, so that state which wasn't made by an engine
+            with the same key is refused. If None, a random key is made,
+            and only this engine will accept the state it returns.
+        normalizer -- a Normalizer (see normalizer.py) to pass the words
+            of messages and patterns through after substitutions, for
+            stemming, synonyms or removing accents. If None, words are only
+            made lower case and have their punctuation removed.
         """
         self._depth_limit = depth
+        if state_key is None:
+            state_key = os.urandom(32)
+        self._state_key = state_key
+        self._normalizer = normalizer
+        self._reply_cache = LRUCache(reply_cache_size)
+        self._target_cache = LRUCache(target_cache_size)
+        self._reply_targets = weakref.WeakValueDictionary()
 
         self._botvars = {}
         self._variables = {"b": self._botvars,
                            "u": None}
 
-        self._users = {}  # will contain UserInfo objects
+        self._users = UserTable(max_users, idle_timeout, user_store,
+                                self._evict_user, self._restore_user)
+        # held by replies and by anything which changes the rules, so a
+        # reply is made with the same rules from start to finish
+        self._lock = threading.RLock()
         log.debug("Chatbot instance created.")
         self.clear_rules()
 
     def clear_rules(self):
         """ Empty the rules database """
-        log.debug("Rules database cleared")
-        self.rules_db = RulesDB()
+        with self._lock:
+            log.debug("Rules database cleared")
+            self.rules_db = RulesDB(self._normalizer)
+            self._clear_caches()
 
     def load_script_directory(self, directory, ignore_errors=False):
         """ Load rules from *.py in a directory """
-        self.rules_db.load_script_directory(directory, self._botvars,
-                                            ignore_errors)
+        with _load_lock, self._lock:
+            self._clear_caches()
+            self.rules_db.load_script_directory(directory, self._botvars,
+                                                ignore_errors)
+
+    def load_rules(self, directories, ignore_errors=False):
+        """ Load rules from *.py in a list of directories into a new rules
+        database, and sort them, while replies go on using the old one. Then
+        replace the old rules with the new ones in one step. Replies which
+        are in progress finish with the rules they started with. The
+        scripts' setup methods change a copy of the bot variables, which
+        replaces them along with the rules. If loading raises an exception,
+        the old rules and bot variables are kept. Other loads and reloads,
+        in this engine or any other, wait until this one is done.
+        """
+        with _load_lock:
+            rules_db = RulesDB(self._normalizer)
+            botvars = dict(self._botvars)
+            for directory in directories:
+                rules_db.load_script_directory(directory, botvars,
+                                               ignore_errors)
+            rules_db.sort_rules()
+            with self._lock:
+                self.rules_db = rules_db
+                self._botvars = botvars
+                self._variables["b"] = botvars
+                self._clear_caches()
+        log.debug("Replaced the rules database")
+
+    def reload_script_directory(self, directory, ignore_errors=False):
+        """ Reload rules from the *.py files in a directory which have
+        changed since it was loaded, and drop those from deleted files.
+        The bot variables, the users and the scripts from unchanged files
+        are kept. Returns the list of files which were imported.
+        """
+        with _load_lock, self._lock:
+            self._clear_caches()
+            return self.rules_db.reload_script_directory(directory,
+                                                         self._botvars,
+                                                         ignore_errors)
+
+    def _clear_caches(self):
+        self._reply_cache.clear()
+        self._target_cache.clear()
+        self._reply_targets.clear()
+
+    def cache_info(self):
+        """ Return a dictionary of CacheInfo tuples (see cache.py) for the
+        engine's caches. """
+        return {"replies": self._reply_cache.info(),
+                "targets": self._target_cache.info()}
+
+    def set_user_limits(self, max_users=0, idle_timeout=0):
+        """ Change max_users and idle_timeout (see __init__). """
+        with self._lock:
+            self._users.set_limits(max_users, idle_timeout)
+
+    def user_table_info(self):
+        """ Return a UserTableInfo tuple (see users.py) giving the number
+        of users kept and the numbers evicted and restored. """
+        return self._users.info()
+
+    def close(self):
+        """ Close the user store, if there is one. """
+        if self._users.store is not None:
+            self._users.store.close()
+
+    def snapshot(self, path):
+        """ Save the bot variables, the resident users, the instance
+        variables of the scripts and the Patterns made from their rules to
+        a file, so that restore can start an engine again without setting
+        everything up from scratch.
+        """
+        with self._lock:
+            snapshot = {"version": _SNAPSHOT_VERSION,
+                        "directories": self.rules_db.directories,
+                        "scripts": self.rules_db.saved_scripts(),
+                        "botvars": self._botvars,
+                        "users": self._users.items()}
+            temp_path = path + ".tmp"
+            with open(temp_path, "wb") as f:
+                pickle.dump(snapshot, f, 2)
+        os.rename(temp_path, path)
+        log.debug("Saved snapshot of {0} users to {1}".format(
+            len(snapshot["users"]), path))
+
+    def restore(self, path):
+        """ Empty the rules database and load the script directories named
+        in a file written by snapshot, along with the bot variables and
+        users saved in it. Scripts whose source files haven't changed since
+        the snapshot are not set up again. Returns the list of directories
+        loaded.
+
+        Exceptions:
+        ValueError -- if the file was written by a different version
+        Anything load_script_directory or unpickling the file may raise
+        """
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot.get("version") != _SNAPSHOT_VERSION:
+            raise ValueError("{0} is not a snapshot this version of the "
+                             "chatbot engine can read".format(path))
+        with _load_lock, self._lock:
+            self.clear_rules()
+            self._botvars.clear()
+            self._botvars.update(snapshot["botvars"])
+            for directory, ignore_errors in snapshot["directories"]:
+                self.rules_db.load_script_directory(directory, self._botvars,
+                                                    ignore_errors,
+                                                    snapshot["scripts"])
+            for user, userinfo in snapshot["users"]:
+                self._users.add(user, userinfo)
+                self._restore_user(user, userinfo)
+        log.debug("Restored snapshot of {0} users from {1}".format(
+            len(snapshot["users"]), path))
+        return [directory for directory, ignore_errors
+                in snapshot["directories"]]
+
+    def _evict_user(self, user, userinfo):
+        """ Called by the UserTable before it evicts a user. Give all the
+        script instances which have set the user up a chance to save what
+        they need. """
+        for inst in self.rules_db.script_instances:
+            if not (inst.eager_setup_user or
+                    inst.topic in userinfo.topics_set_up):
+                continue
+            inst.userinfo = userinfo
+            try:
+                inst.evict_user(user)
+            except Exception:
+                log.error("Error in evict_user method of {0}".format(
+                    inst.__class__.__name__), exc_info=True)
+
+    def _restore_user(self, user, userinfo):
+        """ Called by the UserTable after it restores a user. Replies which
+        were pickled lost the method that makes their Targets, so give it
+        back to them. """
+        for lazy_target in userinfo.repl_history:
+            lazy_target.rebind(self._reply_target)
+
+    def _target(self, topic_name, text):
+        """ Return a Target made from text using the substitutions of a topic.
+        If all the substitutions are declared deterministic, Targets are
+        remembered and shared, keyed by topic name and text.
+        """
+        topic = self.rules_db.topics[topic_name]
+        if not topic.deterministic_substitutions:
+            return Target(text, topic.substitutions, self._normalizer)
+        key = (topic_name, text)
+        target = self._target_cache.get(key)
+        if target is None:
+            target = Target(text, topic.substitutions, self._normalizer)
+            self._target_cache.put(key, target)
+        return target
+
+    def _reply_target(self, topic_name, text):
+        """ Return a Target for a reply in a user's history. Where possible
+        share one Target among all the users who got the same reply, for
+        as long as any of them still has it in their history.
+        """
+        topic = self.rules_db.topics.get(topic_name)
+        if topic is None:  # scripts were reloaded without that topic
+            return Target(text, normalizer=self._normalizer)
+        if not topic.deterministic_substitutions:
+            return Target(text, topic.substitutions, self._normalizer)
+        key = (topic_name, text)
+        target = self._reply_targets.get(key)
+        if target is None:
+            target = self._target(topic_name, text)
+            self._reply_targets[key] = target
+        return target
 
     def reply(self, user, user_dict, message):
         """ For the current topic, find the best matching rule for the message.
@@ -84,54 +322,254 @@ class ChatbotEngine(object):
         Return value: string returned by rule(s)
 
         Exceptions:
-        RecursionTooDeepError -- if recursion goes over depth limit passed
-            to __init__
+        RecursionTooDeepError -- if references to other rules nest deeper
+            than the depth limit passed to __init__, or go around in a circle
+        UserStateConflictError -- if the user store is shared, and another
+            engine changed the user without holding the store's lock
         """
         if not isinstance(message, text_type):
             raise TypeError("message argument must be string, not bytestring")
 
-        self.rules_db.sort_rules()
-
         log.debug('Asked to reply to: "{0}" from {1}'.format(message, user))
-        self._setup_user(user, user_dict)
+        with self._lock:
+            self.rules_db.sort_rules()
+            with self._users.locked(user):
+                userinfo = self._setup_user(user, user_dict)
+                reply = self._reply_to_user(user, userinfo, message)
+                self._users.changed(user)
+        return reply
+
+    def reply_stateless(self, user, user_dict, message, state=None):
+        """ Like reply, but instead of keeping what it knows about the user,
+        take it as an argument and return it, so the caller can store it
+        wherever it likes and any engine with the same scripts can answer
+        the user's next message.
 
+        Arguments:
+        user, user_dict, message -- as for reply
+        state -- the bytestring returned with the reply to the user's
+            previous message, or None for a new user. It is signed with the
+            engine's state_key, so state returned by an engine with a
+            different key, or changed since, is refused.
+
+        Return value: a tuple of the reply and the user's new state
+
+        Exceptions:
+        ValueError -- if state wasn't made by an engine with the same
+            state_key and version
+        """
+        if not isinstance(message, text_type):
+            raise TypeError("message argument must be string, not bytestring")
+
+        log.debug('Asked to reply to: "{0}" from {1} without keeping '
+                  "state".format(message, user))
+        with self._lock:
+            self.rules_db.sort_rules()
+            new = state is None
+            if new:
+                userinfo = UserInfo(user_dict)
+            else:
+                userinfo = decode_user_state(state, self._state_key,
+                                             user_dict, self._reply_target)
+            self._prepare_user(user, userinfo, new)
+            reply = self._reply_to_user(user, userinfo, message)
+        return reply, encode_user_state(userinfo, self._state_key)
+
+    def _reply_to_user(self, user, userinfo, message):
+        """ Make the reply to a message from a user who has been set up,
+        and remember it in their history. """
+        rulenames = []
         try:
-            reply = self._reply(user, message, 0)
+            reply = self._reply(user, userinfo, message, rulenames)[0]
         except RecursionTooDeepError as e:
             e.args = ('Could not find reply to "{0}", due to rules '
                       "referencing other rules too many "
                       "times".format(message),)
             raise
-        self._remember(user, message, reply)
+        self._remember(userinfo, message, reply, rulenames)
         return reply
 
-    def _reply(self, user, message, depth):
-        """ Recursively construct replies """
-        if depth > self._depth_limit:
-            raise RecursionTooDeepError
+    def _reply(self, user, userinfo, message, rulenames):
+        """ Construct a reply to a message, expanding the references to
+        other rules in it. Rather than recursing, keep a stack of the
+        replies being expanded, and expand the references in each from left
+        to right. Each (topic, text) reference is only expanded once per
+        message, and a reference to one that is still being expanded is an
+        error.
+
+        Return the reply, and either None or, if the reply may be
+        remembered and reused, a flag which is True if it can only be
+        reused when the previous reply is the same. Add the names of the
+        rules used to make the reply to the list rulenames.
+        """
+        expanded = {}
+        stack = [self._start_expansion(user, userinfo, message, 0,
+                                       rulenames)]
+        path = set([stack[0].key])
+        while True:
+            expansion = stack[-1]
+            reference = expansion.next_reference()
+            if reference is None:
+                stack.pop()
+                path.discard(expansion.key)
+                result = self._finish_expansion(userinfo, expansion,
+                                                rulenames)
+                if not stack:
+                    return result
+                expanded[expansion.key] = result + (
+                    rulenames[expansion.first:],)
+                stack[-1].add(result)
+                continue
+
+            key = (userinfo.topic_name, reference)
+            if key in expanded:
+                reply, memo, names = expanded[key]
+                log.debug("Reusing expansion of <{0}>".format(reference))
+                rulenames.extend(names)
+                stack[-1].add((reply, memo))
+                continue
+            if key in path or len(stack) > self._depth_limit:
+                raise RecursionTooDeepError
+            expansion = self._start_expansion(user, userinfo, reference,
+                                              len(stack), rulenames)
+            stack.append(expansion)
+            path.add(expansion.key)
 
+    def _start_expansion(self, user, userinfo, message, depth, rulenames):
+        """ Find the rule matching a message and run it, or find a reply
+        remembered from an earlier message, and return an _Expansion
+        for the result.
+        """
         log.debug('Searching for rule matching "{0}", depth == {1}'.format(
             message, depth))
-        userinfo = self._users[user]
-        topic = userinfo.topic_name
-        target = Target(message, self.rules_db.topics[topic].substitutions)
-        reply = ""
+        topic_name = userinfo.topic_name
+        topic = self.rules_db.topics[topic_name]
+        if topic_name not in userinfo.topics_set_up:
+            self._setup_topic(user, userinfo, topic_name, topic)
+        target = self._target(topic_name, message)
+        followups = self._followups(topic, userinfo)
+        expansion = _Expansion((topic_name, message), target, len(rulenames))
 
-        for rule in self.rules_db.topics[topic].sortedrules:
-            m = rule.match(target, userinfo.repl_history,
-                           self._variables)
+        cached = self._cached_reply(topic_name, topic, target, userinfo,
+                                    followups)
+        if cached is not None:
+            reply, memo, names = cached
+            log.debug("Reusing reply: " + reply)
+            rulenames.extend(names)
+            expansion.cached = (reply, memo)
+            return expansion
+
+        reply = ""
+        for rule in topic.rules_to_try(followups):
+            m = rule.match(target, userinfo.repl_history, self._variables)
             if m is not None:
+                rulenames.append(rule.rulename)
                 reply = self._reply_from_rule(rule, m, userinfo)
-                self._check_for_topic_change(user, rule, topic,
-                                             userinfo.topic_name)
+                expansion.rule = rule
+                # the cache is keyed on the normalized message, so a reply
+                # which used the raw text can't be reused
+                expansion.reusable = (rule.pure and
+                                      not m.dict.raw_text_used() and
+                                      userinfo.topic_name == topic_name)
+                self._check_for_topic_change(user, userinfo, rule,
+                                             topic_name, userinfo.topic_name)
                 break
 
-        reply = self._recursively_expand_reply(user, reply, depth)
+        expansion.pieces = _REFERENCE_RE.split(reply)
+        if len(expansion.pieces) > 1:
+            log.debug("Rule returned: " + reply)
+        return expansion
+
+    def _finish_expansion(self, userinfo, expansion, rulenames):
+        """ Join together the pieces of an expanded reply, and remember it
+        if it came from a pure rule. Return the reply and the value _reply
+        should return with it.
+        """
+        if expansion.cached is not None:
+            return expansion.cached
+        reply = "".join(expansion.parts)
+        memo = None
+        topic_name = expansion.key[0]
+        if (expansion.reusable and None not in expansion.memos and
+                userinfo.topic_name == topic_name):
+            memo = self._cache_reply(topic_name, expansion.rule,
+                                     expansion.target, userinfo, reply,
+                                     any(expansion.memos),
+                                     tuple(rulenames[expansion.first:]))
         if not reply:
             log.debug("Empty reply generated")
         else:
             log.debug("Generated reply: " + reply)
-        return reply
+        return reply, memo
+
+    def _followups(self, topic, userinfo):
+        """ Return the (rank, Rule) tuples for the rules in a topic which
+        name one of the rules that made the user's last reply as their
+        previous_rule (see Topic.followups_of). """
+        if not topic.followups or not userinfo.repl_history:
+            return []
+        return topic.followups_of(userinfo.repl_history[0].rulenames)
+
+    def _match(self, rule, target, userinfo, followups):
+        """ Match a rule against a message, unless it has a previous_rule
+        which didn't make the last reply. """
+        if rule.previous_rule and not any([rule is followup for rank, followup
+                                           in followups]):
+            return None
+        return rule.match(target, userinfo.repl_history, self._variables)
+
+    def _previous_key(self, userinfo):
+        """ The part of the key for a remembered reply which identifies the
+        previous reply. """
+        previous = userinfo.repl_history[0]
+        return (previous.normalized, previous.rulenames)
+
+    def _cached_reply(self, topic_name, topic, target, userinfo, followups):
+        """ Look for a remembered reply to a message. First look for one
+        which doesn't depend on the previous reply, and if there isn't one,
+        look for one that does. Then make sure none of the rules whose
+        patterns contain variables, and which would be tried before the rule
+        that made the reply, now match the message. Return None if there
+        is no reply that can be used, or a tuple of the reply, the value
+        _reply should return with it, and the names of the rules which
+        made it.
+        """
+        key = (topic_name, target.normalized)
+        entry = self._reply_cache.get(key + (None,))
+        if (entry is None and topic.has_previous_rules and
+                userinfo.repl_history):
+            entry = self._reply_cache.get(
+                key + (self._previous_key(userinfo),))
+        if entry is None:
+            return None
+        reply, guards, uses_previous, rulenames = entry
+        for guard in guards:
+            if self._match(guard, target, userinfo, followups) is not None:
+                return None
+        return reply, (None if guards else uses_previous), rulenames
+
+    def _cache_reply(self, topic_name, rule, target, userinfo, reply,
+                     uses_previous, rulenames):
+        """ Remember the reply made by a pure rule, keyed by topic and
+        message, and also by the previous reply if any rule which is tried
+        before it has a previous pattern or previous rule, or if
+        uses_previous is set. Return what _reply should return along with
+        the reply.
+
+        A rule referencing this one may only reuse its own reply if this
+        one doesn't depend on rules with variables in their patterns, since
+        those have to be checked against this reply's message.
+        """
+        uses_previous = uses_previous or rule.memo_uses_previous
+        previous = None
+        if uses_previous:
+            if not userinfo.repl_history:
+                return None
+            previous = self._previous_key(userinfo)
+        self._reply_cache.put((topic_name, target.normalized, previous),
+                              (reply, rule.memo_guards, uses_previous,
+                               rulenames))
+        return None if rule.memo_guards else uses_previous
 
     def _reply_from_rule(self, rule, rule_match, userinfo):
         """ Given a rule and the results from a successful match of the rule's
@@ -149,24 +587,8 @@ class ChatbotEngine(object):
         log.debug('Rule {0} returned "{1}"'.format(rule.rulename, reply))
         return reply
 
-    def _recursively_expand_reply(self, user, reply, depth):
-        """ Given a reply string from a rule, look for references to other
-        rules enclosed within < > and recursively call _reply to get responses,
-        and substitute those into the original string. Evaluates from left
-        to right. Doesn't care if you match the <>'s or not.
-        """
-        matches = [m for m in re.finditer("<(.*?)>", reply, flags=re.UNICODE)]
-        if matches:
-            log.debug("Rule returned: " + reply)
-        sub_replies = [self._reply(user, m.groups()[0], depth + 1)
-                       for m in matches]
-        zipper = list(zip(matches, sub_replies))
-        zipper.reverse()
-        for m, sub_reply in zipper:
-            reply = reply[:m.start()] + sub_reply + reply[m.end():]
-        return reply
-
-    def _check_for_topic_change(self, user, rule, old_topic, new_topic):
+    def _check_for_topic_change(self, user, userinfo, rule, old_topic,
+                                new_topic):
         """ Given a rule, and the topic set before and after its execution,
         make sure the change is legit and do appropriate debug logging.
         """
@@ -178,60 +600,267 @@ class ChatbotEngine(object):
                 new_topic = "all"
             log.debug("User {0} now in topic {1}".format(user, new_topic))
 
-        self._users[user].topic_name = new_topic
+        userinfo.topic_name = new_topic
 
     def _setup_user(self, user, user_dict):
         """ Set up the Script class to process a message from a user. If the
         user is new to us, create the UserInfo object for them, and call
-        the setup_user method of all the script instances so they can
-        initialize user variables.
+        the setup_user method of the script instances which ask for it to
+        be called eagerly. The others are called by _setup_topic when the
+        user first gets to their topic. Users who were evicted and saved
+        in the user store are restored rather than set up again. Return
+        the user's UserInfo.
         """
-        new = (user not in self._users)
+        userinfo = self._users.get(user)
+        new = userinfo is None
         if new:
-            self._users[user] = UserInfo(user_dict)
+            userinfo = UserInfo(user_dict)
+            self._users.add(user, userinfo)
         else:
-            self._users[user].info.update(user_dict)
+            userinfo.info.update(user_dict)
+        self._prepare_user(user, userinfo, new)
+        return userinfo
 
-        self._variables["u"] = self._users[user].vars
-        topic = self._users[user].topic_name
+    def _prepare_user(self, user, userinfo, new):
+        """ Make a user's variables available to patterns, make sure they
+        are in a topic which exists, and if they are new, call the eager
+        scripts' setup_user methods. """
+        self._variables["u"] = userinfo.vars
+        topic = userinfo.topic_name
         if topic not in self.rules_db.topics:
             log.warning("User {0} is in empty topic {1}, "
                         "returning to 'all'".format(user, topic))
-            topic = self._users[user].topic_name = "all"
+            topic = userinfo.topic_name = "all"
 
         if new:
-            log.debug("New user, running all scripts' setup_user methods")
+            log.debug("New user, running eager scripts' setup_user methods")
             for inst in self.rules_db.script_instances:
-                inst.userinfo = self._users[user]
+                if inst.eager_setup_user:
+                    inst.userinfo = userinfo
+                    inst.setup_user(user)
+
+    def _setup_topic(self, user, userinfo, topic_name, topic):
+        """ Call the setup_user methods of the scripts in a topic which the
+        user hasn't been in before, except for the eager ones which
+        _setup_user has already called. """
+        log.debug("User {0} is new to topic {1}, running its scripts' "
+                  "setup_user methods".format(user, topic_name))
+        userinfo.topics_set_up.add(topic_name)
+        for inst in topic.script_instances:
+            if not inst.eager_setup_user:
+                inst.userinfo = userinfo
                 inst.setup_user(user)
 
-    def _remember(self, user, message, reply):
-        """ Save recent messages and replies, per user """
-        user_info = self._users[user]
-        topic_name = user_info.topic_name
-        user_info.msg_history.appendleft(message)
-        user_info.repl_history.appendleft(
-            Target(reply, self.rules_db.topics[topic_name].substitutions))
+    def _remember(self, userinfo, message, reply, rulenames):
+        """ Save recent messages and replies, and the names of the rules
+        that made the replies, per user """
+        topic_name = userinfo.topic_name
+        userinfo.msg_history.appendleft(message)
+        userinfo.repl_history.appendleft(
+            LazyTarget(reply, topic_name, self._reply_target,
+                       tuple(rulenames)))
 
 
-class Target(object):
-    """ A message prepared to be a match target.
+def encode_user_state(userinfo, key):
+    """ Return a bytestring holding everything in a UserInfo except its info
+    dictionary, which the caller supplies with each message, signed with an
+    HMAC made with key. Replies in the history which were made in the
+    user's current topic don't repeat its name. """
+    topic_name = userinfo.topic_name
+    history = [(t.raw_text, t.rulenames) if t.topic_name == topic_name
+               else (t.raw_text, t.rulenames, t.topic_name)
+               for t in userinfo.repl_history]
+    data = pickle.dumps((_USER_STATE_VERSION, userinfo.vars, topic_name,
+                         list(userinfo.topics_set_up),
+                         list(userinfo.msg_history), history), 2)
+    return hmac.new(key, data, hashlib.sha256).digest() + data
+
+
+def decode_user_state(state, key, info, make_target):
+    """ Make a UserInfo from a bytestring made by encode_user_state with the
+    same key, and an info dictionary. make_target is given to the
+    LazyTargets made for the replies in the history. The signature is
+    checked before anything is unpickled. """
+    size = hashlib.sha256().digest_size
+    signature, data = state[:size], state[size:]
+    if not hmac.compare_digest(signature,
+                               hmac.new(key, data, hashlib.sha256).digest()):
+        raise ValueError("User state was not made by an engine with this "
+                         "state key")
+    (version, variables, topic_name, topics_set_up, messages,
+     history) = pickle.loads(data)
+    if version != _USER_STATE_VERSION:
+        raise ValueError("User state was made by a different version of "
+                         "the chatbot engine")
+    userinfo = UserInfo(info)
+    userinfo.vars = variables
+    userinfo.topic_name = topic_name
+    userinfo.topics_set_up = set(topics_set_up)
+    userinfo.msg_history.extend(messages)
+    for entry in history:
+        reply_topic = entry[2] if len(entry) > 2 else topic_name
+        userinfo.repl_history.append(
+            LazyTarget(entry[0], reply_topic, make_target, entry[1]))
+    return userinfo
+
+
+class _Expansion(object):
+    """ A reply whose references to other rules are being expanded by
+    ChatbotEngine._reply.
+
+    Instance variables:
+    key: (topic name, message) that the reply is for
+    target: the Target made from the message
+    first: index in the list of rule names where this reply's begin
+    rule: the rule which matched the message, or None
+    reusable: True if the reply may be remembered
+    cached: (reply, memo) if a remembered reply was found, otherwise None
+    pieces: the reply from the rule, split by _REFERENCE_RE, so that
+        the odd numbered items are references
+    parts: the pieces of the reply which have been expanded so far
+    memos: the memo values returned for each reference expanded so far
+    """
+    __slots__ = ("key", "target", "first", "rule", "reusable", "cached",
+                 "pieces", "parts", "memos")
+
+    def __init__(self, key, target, first):
+        self.key = key
+        self.target = target
+        self.first = first
+        self.rule = None
+        self.reusable = False
+        self.cached = None
+        self.pieces = ()
+        self.parts = []
+        self.memos = []
+
+    def next_reference(self):
+        """ Move literal text from pieces to parts, and return the next
+        reference to be expanded, or None if there are no more. """
+        position = len(self.parts)
+        if position < len(self.pieces):
+            self.parts.append(self.pieces[position])
+            position += 1
+        if position < len(self.pieces):
+            return self.pieces[position]
+        return None
+
+    def add(self, result):
+        """ Add the expansion of the reference returned by next_reference,
+        which is a tuple of reply and memo value. """
+        reply, memo = result
+        self.parts.append(reply)
+        self.memos.append(memo)
+
+
+class LazyTarget(object):
+    """ A reply in a user's history, which keeps the text of the reply and
+    waits until one of the other Target attributes is used to make a
+    Target from it. Most replies are never looked at by a rule with a
+    previous pattern, so most never need one.
 
     Public instance variables:
+    raw_text: the text of the reply
+    topic_name: the topic the user was in when the reply was made
+    rulenames: a tuple of the names of the rules which made the reply,
+        starting with the one which matched the message and followed by
+        the rules it referenced
+    target: the Target, made on first use
+    Any other Target attribute is looked up on target.
+
+    Public methods:
+    match_previous: match a previous pattern, remembering the result
+    rebind: supply the function which makes the Target, after unpickling
+
+    When pickled, only the text, topic name and rule names are kept.
+    """
+    __slots__ = ("raw_text", "topic_name", "rulenames", "_make_target",
+                 "_target", "_previous_matches")
+
+    def __init__(self, text, topic_name, make_target, rulenames=()):
+        """ make_target will be called with topic_name and text to make the
+        Target when it is needed. """
+        self.raw_text = text
+        self.topic_name = topic_name
+        self.rulenames = rulenames
+        self._make_target = make_target
+        self._target = None
+        self._previous_matches = None
+
+    def match_previous(self, pattern, variables):
+        """ Match a Pattern against this reply. Since many rules share the
+        same few previous patterns (see Topic._share_previous_patterns),
+        remember the result for patterns that don't contain variables, so
+        each is matched at most once.
+        """
+        if pattern.regexc is None:
+            return pattern.match(self.normalized, variables)
+        if self._previous_matches is None:
+            self._previous_matches = {}
+        try:
+            return self._previous_matches[pattern]
+        except KeyError:
+            m = pattern.match(self.normalized, variables)
+            self._previous_matches[pattern] = m
+            return m
+
+    def __getstate__(self):
+        return (self.raw_text, self.topic_name, self.rulenames)
+
+    def __setstate__(self, state):
+        self.raw_text, self.topic_name, self.rulenames = state
+        self._make_target = self._target = self._previous_matches = None
+
+    def rebind(self, make_target):
+        """ Set the function which makes the Target, if it is needed. """
+        if self._target is None:
+            self._make_target = make_target
+
+    @property
+    def target(self):
+        if self._target is None:
+            self._target = self._make_target(self.topic_name, self.raw_text)
+            self._make_target = None
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.target, name)
+
+
+class Target(object):
+    """ A message prepared to be a match target. Targets can't be changed
+    once they are made, so they may be shared between users.
+
+    To keep Targets small, only the raw and normalized strings are kept,
+    along with arrays of offsets into them for each word. The word lists
+    are made again when asked for.
+
+    Public instance variables (read only):
     raw_text: the string passed to the constructor
-    raw_words: a list of words of the same string, split on whitespace
-    tokenized_words: a list of lists, one for each word in orig_words
+    raw_words: a tuple of words of the same string, split on whitespace
+    tokenized_words: a tuple of tuples, one for each word in orig_words
         after doing substitutions (see below), making them lower case,
         and removing all remaining non-alphanumeric characters.
-    normalized: tokenized_words, joined back together by single spaces
+    normalized: tokenized_words, joined back together by single spaces,
+        leaving out the ones which are empty
+    word_offsets: an array of the positions in normalized where each of
+        the tuples in tokenized_words begins. An empty one is placed at the
+        end of the word before it, so that it goes along with that word
+        when a match is mapped back to the raw words.
 
     """
-    def __init__(self, text, substitutions=[]):
+    __slots__ = ("raw_text", "normalized", "_raw_spans", "_word_starts",
+                 "_empty_words", "__weakref__")
+
+    def __init__(self, text, substitutions=[], normalizer=None):
         """ Create a match target from a string.
             - Break it into a list of words on whitespace and save the originals
             - Run substitutions
             - lowercase everything
             - Kill remaining non-alphanumeric characters
+            - Pass the words through the normalizer, if there is one
 
         Parameters:
             text - the string to process
@@ -241,7 +870,10 @@ class Target(object):
                 must return a list of lists of words and the outer list must be
                 the same length as the input. The functions in the substitutions
                 list will all be called, using the output of one as the input of
-                the next.
+                the next. Functions declared with @substitution(edits=True)
+                are passed a TokenBuffer instead, and return a list of edits
+                to make to it.
+            normalizer - a Normalizer (see normalizer.py), or None
 
         Examples, showing text and the results placed in raw_words,
         tokenized_words and normalized.
@@ -269,35 +901,124 @@ class Target(object):
         "I'm tired today!" to the pattern "i am tired _*", the match dict
         entry for "raw_match0" will contain "today!"
         """
-        self.raw_text = text
-        self.raw_words = split_on_whitespace(text)
-        sub_words = self._do_substitutions(substitutions)
-
-        self.tokenized_words = [[kill_non_alphanumerics(word.lower())
-                                 for word in wl] for wl in sub_words]
-        self.normalized = " ".join(
-                                [" ".join(wl) for wl in self.tokenized_words])
-        log.debug('Normalized message to "{0}"'.format(self.normalized))
-
-    def _do_substitutions(self, substitutions):
-        """Check a word against the substitutions dictionary. If the word is
-        not found, return it wrapped in a list. Otherwise return the
-        value from the dictionary as a list of words.
+        raw_spans = array.array(str("i"))
+        raw_words = []
+        for m in _WORD_RE.finditer(text):
+            raw_spans.extend(m.span())
+            raw_words.append(m.group())
+        tokens = self._do_substitutions(text, raw_words, substitutions)
+        words = normalize_words(tokens.words)
+        if normalizer is not None:
+            words = normalizer.normalize_words(words)
+        if tokens.raw_index == list(range(len(raw_words))):
+            word_segments = words  # one word for each raw word
+            counts = None
+        else:
+            wordlists = tokens.wordlists(words)
+            word_segments = [" ".join(wl) for wl in wordlists]
+            counts = [len(wl) for wl in wordlists]
+
+        word_starts = array.array(str("i"))
+        empty_words = {}
+        segments = []
+        offset = 0
+        for i, segment in enumerate(word_segments):
+            if segment:
+                word_starts.append(offset)
+                segments.append(segment)
+                offset += len(segment) + 1
+            else:
+                word_starts.append(max(offset - 1, 0))
+                empty_words[i] = ("",) * (counts[i] if counts else 1)
+        normalized = " ".join(segments)
+        log.debug('Normalized message to "{0}"'.format(normalized))
+
+        set_attribute = super(Target, self).__setattr__
+        set_attribute("raw_text", text)
+        set_attribute("normalized", normalized)
+        set_attribute("_raw_spans", raw_spans)
+        set_attribute("_word_starts", word_starts)
+        set_attribute("_empty_words", empty_words or None)
+
+    @property
+    def raw_words(self):
+        spans = self._raw_spans
+        return tuple([self.raw_text[spans[i]:spans[i + 1]]
+                      for i in range(0, len(spans), 2)])
+
+    @property
+    def tokenized_words(self):
+        starts = self._word_starts
+        empty = self._empty_words or {}
+        words = []
+        end = len(self.normalized)
+        for i in reversed(range(len(starts))):
+            if i in empty:
+                words.append(empty[i])
+            else:
+                words.append(tuple(self.normalized[starts[i]:end].split(" ")))
+                end = starts[i] - 1
+        words.reverse()
+        return tuple(words)
+
+    @property
+    def word_offsets(self):
+        return self._word_starts
+
+    def match_previous(self, pattern, variables):
+        """ Match a Pattern against this Target. """
+        return pattern.match(self.normalized, variables)
+
+    def raw_text_between(self, start, end):
+        """ Given the start and end of part of normalized, return the
+        words of raw_text it came from, joined by spaces. """
+        i_start = bisect.bisect_left(self._word_starts, start)
+        i_end = bisect.bisect(self._word_starts, end)
+        spans = self._raw_spans
+        return " ".join([self.raw_text[spans[2 * i]:spans[2 * i + 1]]
+                         for i in range(i_start, i_end)])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Target objects are read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("Target objects are read-only")
+
+    def _do_substitutions(self, text, raw_words, substitutions):
+        """ Run the substitution functions on a TokenBuffer made from the
+        raw words, and return the buffer. Functions declared with
+        @substitution(edits=True) return edits which are made to the buffer
+        in place. The others are passed and return lists of lists of words,
+        which go straight from one function to the next, and are only put
+        into the buffer when the next function wants edits, or at the end.
         """
-        results = [[word] for word in self.raw_words]
-        length = len(results)
+        tokens = TokenBuffer(raw_words)
+        wordlists = None  # the words, while they are in lists of lists
         for name, func in substitutions:
             try:
                 clearer_error_message = ""
-                results = func(self.raw_text, results)
-                clearer_error_message = " return value of"
-                log.debug("{0} returned {1}".format(name, results))
-                if len(results) != length:
-                    raise TypeError("Returned list must be same length as "
-                                    "passed list")
+                if getattr(func, "edits", False):
+                    if wordlists is not None:
+                        tokens.set_wordlists(wordlists)
+                        wordlists = None
+                    edits = func(text, tokens)
+                    clearer_error_message = " return value of"
+                    tokens.apply(edits)
+                    log.debug("{0} made edits {1}".format(name, edits))
+                else:
+                    if wordlists is None:
+                        wordlists = tokens.wordlists()
+                    wordlists = func(text, wordlists)
+                    clearer_error_message = " return value of"
+                    log.debug("{0} returned {1}".format(name, wordlists))
+                    if len(wordlists) != len(raw_words):
+                        raise TypeError("Returned list must be same length "
+                                        "as passed list")
             except Exception as e:
                 msg = (" in{0} {1}".format(clearer_error_message, name))
                 e.args = (e.args[0] + msg,) + e.args[1:]
                 raise
 
-        return results
+        if wordlists is not None:
+            tokens.set_wordlists(wordlists)
+        return tokens
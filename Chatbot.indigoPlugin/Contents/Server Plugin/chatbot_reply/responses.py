@@ -0,0 +1,127 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.responses, lists of replies prepared once so that rules
+can choose from them quickly
+"""
+from __future__ import unicode_literals
+
+import random
+import zlib
+
+
+class ResponseTable(object):
+    """ A list of replies for rules to choose from, prepared when it is
+    created, which is usually when a script is imported. Declare one as a
+    class attribute of a Script and return it from a rule, and the rule's
+    reply will be chosen from it by Script.choose.
+
+    Choosing at random takes the same time however many replies there
+    are, even when they are weighted, because the weights are made into
+    an alias table (Vose's method) up front.
+
+    If rotate is True, each user gets the replies in turn, starting at a
+    random place in a shuffled order, so no reply is repeated to a user
+    before they have seen all the others. Weighted replies come round as
+    many times per turn as their weights. All each user needs is one
+    number for each table, which choose keeps in a dictionary of cursors,
+    keyed by a checksum of the replies and their weights. The order is
+    shuffled using the same checksum rather than the random module, so a
+    table made from the same replies, after a reload or a restart or in
+    another engine, puts them in the same order and the user's cursor
+    still works.
+
+    Public instance variables:
+        responses : tuple of the replies
+        weights : tuple of their weights, or None if they weren't weighted
+        rotate : the rotate argument given to the constructor
+        key : the key of the table's cursor in dictionaries of cursors
+
+    Public method:
+        choose - return a reply
+    """
+    def __init__(self, responses, rotate=False):
+        """ responses is a list of strings, or a list of (string, weight)
+        tuples where the weights are integers. Weights less than 1 count
+        as 1, as they do in Script.choose.
+        """
+        if not responses:
+            raise ValueError("A ResponseTable needs at least one response")
+        if isinstance(responses[0], tuple):
+            self.responses = tuple([string for string, weight in responses])
+            self.weights = tuple([max(1, int(weight))
+                                  for string, weight in responses])
+        else:
+            self.responses = tuple(responses)
+            self.weights = None
+        self.rotate = rotate
+        key = zlib.crc32("\x00".join(self.responses).encode("utf-8"))
+        if self.weights is not None:
+            weights = ",".join([str(w) for w in self.weights])
+            key = zlib.crc32(("\x01" + weights).encode("ascii"), key)
+        self.key = key & 0xffffffff
+
+        self._probabilities, self._aliases = _alias_table(self.weights)
+        if self.weights is None:
+            order = list(range(len(self.responses)))
+        else:
+            order = [i for i, weight in enumerate(self.weights)
+                     for n in range(weight)]
+        self._order = tuple(_shuffled(order, self.key))
+
+    def __len__(self):
+        return len(self.responses)
+
+    def choose(self, cursors=None):
+        """ Return one of the replies. If the table rotates and a dictionary
+        of cursors is given, return the user's next reply and move their
+        cursor on. Otherwise choose at random, according to the weights.
+        """
+        if self.rotate and cursors is not None:
+            cursor = cursors.get(self.key)
+            if cursor is None:
+                cursor = random.randrange(len(self._order))
+            cursor %= len(self._order)
+            cursors[self.key] = (cursor + 1) % len(self._order)
+            return self.responses[self._order[cursor]]
+        i = random.randrange(len(self.responses))
+        if (self._probabilities is not None and
+                random.random() >= self._probabilities[i]):
+            i = self._aliases[i]
+        return self.responses[i]
+
+
+def _shuffled(items, seed):
+    """ Return a copy of a list in an order which depends only on the
+    length of the list and seed, and is the same in every version of
+    Python, unlike random.shuffle. """
+    def position(i):
+        return zlib.crc32(str(i).encode("ascii"), seed) & 0xffffffff, i
+    return [items[i] for i in sorted(range(len(items)), key=position)]
+
+
+def _alias_table(weights):
+    """ Make the probability and alias lists for choosing an index with
+    probability proportional to weights, by Vose's method. Return (None,
+    None) if there are no weights or they are all the same, in which case
+    every index is equally likely. """
+    if weights is None or len(set(weights)) == 1:
+        return None, None
+    count = len(weights)
+    total = float(sum(weights))
+    scaled = [weight * count / total for weight in weights]
+    probabilities = [1.0] * count
+    aliases = list(range(count))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    return tuple(probabilities), tuple(aliases)
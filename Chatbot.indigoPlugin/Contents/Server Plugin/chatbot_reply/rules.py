@@ -7,16 +7,29 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import bisect
+import hashlib
+import heapq
 import imp
 import inspect
 import logging
 import os
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
 
+from chatbot_reply.six import get_method_self
+from chatbot_reply.six.moves import cPickle as pickle
 from chatbot_reply.constants import _PREFIX
 from chatbot_reply.exceptions import *
 from chatbot_reply.patterns import Pattern
-from chatbot_reply.script import Script, ScriptRegistrar
+from chatbot_reply.script import RuleSpec, Script, ScriptRegistrar
+from chatbot_reply.substitutions import SubstitutionTable
+
+_PREVIOUS_RULE_SCORE = 10
+_NO_PATTERN = Pattern("")  # shared by all the rules without a previous
+# instance variables given to scripts by the engine, which aren't saved
+_SCRIPT_ENGINE_VARIABLES = ("botvars", "userinfo", "match")
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +42,8 @@ class RulesDB(object):
     Public methods --
     load_script_directory: Load python files from a directory into the
         database
+    reload_script_directory: Bring the database up to date with the
+        python files in a directory which was loaded before
     clear_rules: Empty the rules database
 
     Public instance variables --
@@ -36,22 +51,38 @@ class RulesDB(object):
         Topic objects built from those subclasses
     script_instances: List containing one instance of each Script subclass
         found, except for those with their topic set to None
+    directories: list of (directory, ignore_errors) for each call to
+        load_script_directory
+    script_hashes: dictionary of the names of the imported modules and
+        the SHA-1 of their source files
+    script_files: dictionary of the names of the imported modules and
+        their source filenames
+    patterns: dictionary of script class names and dictionaries of the
+        Pattern objects made from the pattern strings of their rules
+    normalizer: the Normalizer (see normalizer.py) given to the Patterns,
+        or None
     """
-    def __init__(self):
+    def __init__(self, normalizer=None):
         """ Create a new empty RulesDB object """
+        self.normalizer = normalizer
         self.clear_rules()
 
     def clear_rules(self):
         """ Make a fresh new empty rules database. """
         self.topics = {}
         self.script_instances = []
+        self.directories = []
+        self.script_hashes = {}
+        self.script_files = {}
+        self.patterns = {}
         self._new_topic("all")
 
     def _new_topic(self, topic):
         """ Add a new topic to the rules database. """
         self.topics[topic] = Topic()
 
-    def load_script_directory(self, directory, botvars, ignore_errors):
+    def load_script_directory(self, directory, botvars, ignore_errors,
+                              saved=None):
         """Iterate through the .py files in a directory, and import all of
         them. Then look for subclasses of Script and search them for
         rules, and load those into self.topics.
@@ -62,33 +93,136 @@ class RulesDB(object):
         tracebacks will be logged. It's un-Pythonic, but the idea is to keep
         one broken file from killing the entire chatbot.
 
+        saved is a dictionary of script class names and the values returned
+        by saved_scripts when the scripts were loaded before. Scripts whose
+        source files, and those of the script classes they inherit from,
+        haven't changed since then get their instance variables back
+        instead of having their setup methods called, and their rules reuse
+        the Patterns made before.
         """
-        def call_handling_exceptions(func, *args, **kwargs):
-            try:
-                return func(*args, **kwargs)
-            except:
-                if ignore_errors:
-                    log.error("Error loading scripts, "
-                              "attempting to continue", exc_info=True)
-                    return None
-                else:
-                    raise
-
         self.rules_sorted = False
+        self.directories.append((directory, ignore_errors))
         ScriptRegistrar.clear()
 
-        files = call_handling_exceptions(os.listdir, directory)
+        files = _call_handling_exceptions(ignore_errors, os.listdir,
+                                          directory)
         if files is not None:
             for item in files:
                 if item.lower().endswith(".py"):
                     log.debug("Importing " + item)
                     filename = os.path.join(directory, item)
-                    call_handling_exceptions(self._import, filename)
-
+                    _call_handling_exceptions(ignore_errors, self._import,
+                                              filename)
+
+        self._add_registered_scripts(botvars, ignore_errors, saved or {})
+        self._check_for_rules(directory, ignore_errors)
+
+    def reload_script_directory(self, directory, botvars, ignore_errors):
+        """Bring the rules from a directory which was loaded before up to
+        date with the .py files now in it. Only the files which are new, or
+        whose SHA-1 has changed, are imported again, along with the files,
+        in this directory or any other, of the script classes which inherit
+        from classes in them. The scripts from those files and from deleted
+        files are dropped along with their rules and substitutions, and only
+        the topics they touched need sorting again. Scripts from unchanged
+        files keep their instances, so their setup methods aren't called
+        again.
+
+        If the directory wasn't loaded before, load it as
+        load_script_directory would. Returns the list of filenames
+        which were imported.
+        """
+        loaded = [os.path.normpath(d) for d, i in self.directories]
+        if os.path.normpath(directory) not in loaded:
+            self.load_script_directory(directory, botvars, ignore_errors)
+            return sorted(self.script_files.values())
+
+        files = _call_handling_exceptions(ignore_errors, os.listdir,
+                                          directory) or []
+        current = {}
+        for item in files:
+            if item.lower().endswith(".py"):
+                name = os.path.splitext(item)[0]
+                current[_PREFIX + name] = os.path.join(directory, item)
+
+        stale = []
+        for modname, filename in self.script_files.items():
+            if (os.path.normpath(os.path.dirname(filename)) !=
+                    os.path.normpath(directory)):
+                continue
+            if (modname not in current or
+                    _file_hash(current[modname]) !=
+                    self.script_hashes.get(modname)):
+                stale.append(modname)
+        changed = sorted([current[modname] for modname in current
+                          if modname not in self.script_files or
+                          modname in stale])
+        if not stale and not changed:
+            log.debug("No scripts have changed in " + directory)
+            return []
+
+        dependents = self._dependent_modules(stale)
+        changed.extend([self.script_files[modname]
+                        for modname in dependents])
+        self._remove_modules(stale + dependents)
+        ScriptRegistrar.clear()
+        for filename in changed:
+            log.debug("Reimporting " + filename)
+            _call_handling_exceptions(ignore_errors, self._import, filename)
+        self._add_registered_scripts(botvars, ignore_errors, {})
+        self._check_for_rules(directory, ignore_errors)
+        return changed
+
+    def _dependent_modules(self, modnames):
+        """ Return the names of the script modules, other than those named,
+        which define script classes inheriting from classes in the named
+        modules. They are in the order they should be imported again, those
+        of the classes with the fewest base classes first. """
+        depths = {}
+        for instance in self.script_instances:
+            for cls in instance.__class__.__mro__:
+                modname = cls.__module__
+                if (modname in self.script_files and
+                        modname not in modnames and
+                        any([base.__module__ in modnames
+                             for base in cls.__mro__[1:]])):
+                    depth = len(cls.__mro__)
+                    depths[modname] = min(depth, depths.get(modname, depth))
+        return sorted(depths, key=lambda modname: (depths[modname], modname))
+
+    def _remove_modules(self, modnames):
+        """ Drop the script instances which came from the named modules,
+        and the rules and substitutions which belong to them. Topics
+        left with nothing in them are removed, except for "all".
+        """
+        if not modnames:
+            return
+        instances = [i for i in self.script_instances
+                     if i.__module__ in modnames]
+        self.script_instances = [i for i in self.script_instances
+                                 if i.__module__ not in modnames]
+        for name, topic in list(self.topics.items()):
+            topic.remove_scripts(instances)
+            if (name != "all" and not topic.rules and
+                    not topic.script_instances):
+                log.debug("Removing empty topic {0}".format(name))
+                del self.topics[name]
+        for instance in instances:
+            self.patterns.pop(_script_class_name(instance), None)
+        for modname in modnames:
+            log.debug("Dropping scripts from " + self.script_files[modname])
+            self.script_hashes.pop(modname, None)
+            del self.script_files[modname]
+
+    def _add_registered_scripts(self, botvars, ignore_errors, saved):
+        """ Add the Script subclasses found by the last imports to the
+        database. """
         for cls in ScriptRegistrar.registry:
             log.debug("Loading scripts from " + cls.__name__)
-            call_handling_exceptions(self._add_to_rulesdb, cls, botvars)
+            _call_handling_exceptions(ignore_errors, self._add_to_rulesdb,
+                                      cls, botvars, saved)
 
+    def _check_for_rules(self, directory, ignore_errors):
         if sum([len(t.rules) for k, t in self.topics.items()]) == 0:
             msg = "No rules were found in {0}/*.py".format(directory)
             if ignore_errors:
@@ -108,14 +242,18 @@ class RulesDB(object):
         log.debug("Reading " + filename)
         modname = _PREFIX + name
         file, filename, data = imp.find_module(name, [path])
+        self.script_hashes[modname] = _file_hash(filename)
+        self.script_files[modname] = filename
         module = imp.load_module(modname, file, filename, data)
         return module
 
-    def _add_to_rulesdb(self, script_class, botvars):
+    def _add_to_rulesdb(self, script_class, botvars, saved):
         """Given a subclass of Script, create an instance of it.  If it's
         topic is set to None, ignore it, otherwise search its
         attributes for methods that begin with "rule" or "substitute"
-        and add those to the topic database.
+        and add those to the topic database. If the script is in saved and
+        the modules of its class and base classes are unchanged, restore
+        its instance variables instead of calling its setup method.
 
         """
         instance = script_class()
@@ -125,40 +263,58 @@ class RulesDB(object):
         if topic not in self.topics:
             self._new_topic(topic)
 
+        script_class_name = _script_class_name(instance)
+        module_hashes = self._class_hashes(script_class)
+        saved_hashes, state, patterns = saved.get(script_class_name,
+                                                  (None, None, None))
         instance.botvars = botvars
-        instance.setup()
+        if state is not None and saved_hashes == module_hashes:
+            log.debug("Restoring {0} without setup".format(script_class_name))
+            instance.__dict__.update(state)
+        else:
+            instance.setup()
+            patterns = {}
+        self.patterns[script_class_name] = patterns
         self.script_instances.append(instance)
+        self.topics[topic].script_instances.append(instance)
 
         rules, substitutions = self._load_script_methods(instance)
         self.topics[topic].add_rules(rules)
         self.topics[topic].add_substitutions(substitutions)
+        table = getattr(instance, "substitutions", None)
+        if table:
+            if not isinstance(table, Mapping):
+                raise TypeError("substitutions of {0} is not a "
+                                "dictionary".format(script_class_name))
+            self.topics[topic].add_substitution_table(
+                instance, script_class_name, table)
 
     def _load_script_methods(self, instance):
         """Given an instance of a subclass of Script, find all of its methods
-        which begin with one of our keywords and add them to the rules
-        database for the topic of the script instance.
+        which begin with one of our keywords, using the lists of their names
+        ScriptRegistrar made when the class was created, and add them to
+        the rules database for the topic of the script instance.
 
         If the instance defines an alternates dictionary, substitute
         those into the patterns of the rules.
 
         """
-        script_class_name = (instance.__module__[len(_PREFIX):] + "." +
-                             instance.__class__.__name__)
+        script_class_name = _script_class_name(instance)
+        patterns = self.patterns.setdefault(script_class_name, {})
         alternates = {}
         if hasattr(instance, "alternates"):
             alternates = self._parse_alternates(instance.alternates,
                                                 script_class_name)
         rules = []
         substitutes = []
-        for attribute in dir(instance):
-            if attribute.startswith('rule'):
-                rule = self._load_rule(script_class_name, instance,
-                                       attribute, alternates)
-                rules.append(rule)
-            elif attribute.startswith('substitute'):
-                sub = self._load_substitution(script_class_name,
-                                              instance, attribute)
-                substitutes.append(sub)
+        for attribute in instance._rule_names:
+            rule = self._load_rule(script_class_name, instance,
+                                   attribute, alternates, patterns)
+            rules.append(rule)
+        for attribute in instance._substitution_names:
+            sub = self._load_substitution(script_class_name,
+                                          instance, attribute)
+            substitutes.append(sub)
         return rules, substitutes
 
     def _parse_alternates(self, alternates, script_class_name):
@@ -185,19 +341,32 @@ class RulesDB(object):
         return {"a": valid}
 
     def _load_rule(self, script_class_name, instance, attribute,
-                   alternates):
+                   alternates, patterns):
         """ Given an instance of a class derived from Script and
         a callable attribute, check that it is declared correctly,
-        and then construct and return a Rule object.
+        and then construct and return a Rule object. patterns is a
+        dictionary of the Patterns already made for the script.
         """
         method = getattr(instance, attribute)
         rulename = script_class_name + "." + attribute
 
-        argspec = get_rule_method_spec(rulename, method)
-
-        raw_pattern, raw_previous, weight = argspec.defaults
+        raw_pattern, raw_previous, weight, pure, previous_rule = \
+            get_rule_spec(rulename, method)
+        if previous_rule:
+            previous_rule = self._qualify_rulename(script_class_name,
+                                                   previous_rule)
         return Rule(raw_pattern, raw_previous, weight, alternates,
-                    method, rulename)
+                    method, rulename, pure, previous_rule, patterns,
+                    self.normalizer)
+
+    def _qualify_rulename(self, script_class_name, name):
+        """ Turn the name of a rule given to @rule as previous_rule into a
+        full rule name, modulename.classname.methodname, by taking whatever
+        is missing from script_class_name.
+        """
+        parts = script_class_name.split(".")
+        given = name.split(".")
+        return ".".join(parts[:max(0, 3 - len(given))] + given)
 
     def _load_substitution(self, script_class_name, instance, attribute):
         """ Given an instance of a class derived from Script and
@@ -209,6 +378,42 @@ class RulesDB(object):
         check_substitution_method_spec(name, method)
         return (name, method)
 
+    def _class_hashes(self, script_class):
+        """ Return a tuple of (module name, SHA-1) tuples for the script
+        modules which define a script class and the classes it inherits
+        from, so that a change to any of them can be noticed. """
+        hashes = []
+        for cls in script_class.__mro__:
+            modname = cls.__module__
+            if (modname in self.script_hashes and
+                    (modname, self.script_hashes[modname]) not in hashes):
+                hashes.append((modname, self.script_hashes[modname]))
+        return tuple(hashes)
+
+    def saved_scripts(self):
+        """ Return a dictionary of script class names and tuples of
+        the SHA-1s of the modules of the script's class and base classes
+        (see _class_hashes), a dictionary of the script instance's
+        variables, and the dictionary of Patterns made for its rules,
+        suitable for passing to load_script_directory as saved.
+        Scripts whose instance variables can't be pickled are saved
+        without them, so they will be set up again.
+        """
+        saved = {}
+        for instance in self.script_instances:
+            name = _script_class_name(instance)
+            state = dict([(k, v) for k, v in instance.__dict__.items()
+                          if k not in _SCRIPT_ENGINE_VARIABLES])
+            try:
+                pickle.dumps(state, 2)
+            except Exception:
+                log.debug("Can't save the variables of {0}, it will be set "
+                          "up again".format(name), exc_info=True)
+                state = None
+            saved[name] = (self._class_hashes(instance.__class__),
+                           state, self.patterns.get(name, {}))
+        return saved
+
     def sort_rules(self):
         """ Sort the rules for each topic """
         updated = False
@@ -218,6 +423,19 @@ class RulesDB(object):
             topic.sort_rules()
         if updated:
             self._log_all_rules()
+            self._check_previous_rules()
+
+    def _check_previous_rules(self):
+        """ Warn about rules whose previous_rule doesn't name any rule, so
+        they will never be used. """
+        rulenames = set([rule.rulename for topic in self.topics.values()
+                         for rule in topic.rules.values()])
+        for topic in self.topics.values():
+            for rule in topic.sortedrules:
+                if rule.previous_rule and rule.previous_rule not in rulenames:
+                    log.warning("Rule {0} will never be used because its "
+                                "previous_rule {1} was not found".format(
+                                    rule.rulename, rule.previous_rule))
 
     def _log_all_rules(self):
         """ Print the rules lists to debug ouput """
@@ -228,25 +446,47 @@ class RulesDB(object):
         log.debug("-"*52)
 
 
-def get_rule_method_spec(name, method):
-    """ Check that the passed argument spec matches what we expect the
-    @rule decorator in scripts.py to do. Raises TypeError
-    if a problem is found. If all is good, return the argspec
-    (see inspect.getargspec)
+def _call_handling_exceptions(ignore_errors, func, *args, **kwargs):
+    """ Call func. If it raises an exception and ignore_errors is True, log
+    it and return None. It's un-Pythonic, but the idea is to keep one
+    broken file from killing the entire chatbot.
+    """
+    try:
+        return func(*args, **kwargs)
+    except:
+        if ignore_errors:
+            log.error("Error loading scripts, "
+                      "attempting to continue", exc_info=True)
+            return None
+        else:
+            raise
+
+
+def _file_hash(filename):
+    """ Return the SHA-1 of the contents of a file. """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _script_class_name(instance):
+    """ Return modulename.classname for a script instance. """
+    return (instance.__module__[len(_PREFIX):] + "." +
+            instance.__class__.__name__)
+
+
+def get_rule_spec(name, method):
+    """ Return the RuleSpec which the @rule decorator in script.py put on
+    a rule method. Raises TypeError if the method isn't callable or wasn't
+    decorated by @rule.
     """
     if not hasattr(method, '__call__'):
         raise TypeError(
             "{0} begins with 'rule' but is not callable.".format(
                 name))
-    argspec = inspect.getargspec(method)
-    if (len(argspec.args) != 4 or
-            " ".join(argspec.args) != "self pattern previous_reply weight" or
-            argspec.varargs is not None or
-            argspec.keywords is not None or
-            len(argspec.defaults) != 3):
-        raise TypeError("{0} was not decorated by @rule "
-                        "or it has the wrong number of arguments.".format(name))
-    return argspec
+    spec = getattr(method, "rule_spec", None)
+    if not isinstance(spec, RuleSpec):
+        raise TypeError("{0} was not decorated by @rule.".format(name))
+    return spec
 
 
 def check_substitution_method_spec(name, method):
@@ -275,15 +515,41 @@ class Topic(object):
                 the two formatted pattern strings of the rule
         sortedrules : List of all the Rule objects from the dictionary,
                 in reverse sorted order by score
+        general_rules : List of the Rule objects in sortedrules which don't
+                have a previous_rule, in the same order
         substitutions : List of substitution methods, in no particular
                 order. RulesDB puts tuples in here, (name, method)
+        has_previous_rules : True if any rule in the topic has a previous
+                pattern or a previous rule
+        followups : dictionary of rule names and lists of (rank, Rule)
+                tuples for the rules in this topic which name them as
+                previous_rule, where rank is the rule's position in
+                sortedrules
+        deterministic_substitutions : True if all the substitution methods
+                are declared deterministic by @substitution
+        script_instances : List of the instances of the Script subclasses
+                which have this topic
+        ignored_rules : List of the Rule objects which weren't added because
+                another rule had the same patterns
+        substitution_tables : List of (script instance, script class name,
+                table) tuples for the scripts with substitutions tables.
+                They are compiled into one SubstitutionTable, whose
+                substitute method is first in substitutions.
     """
     def __init__(self):
         """ Create a new empty Topic object. """
         self.rules = {}
         self.rules_are_sorted = True
         self.sortedrules = []
+        self.general_rules = []
+        self._ranked_general_rules = []
         self.substitutions = []
+        self.has_previous_rules = False
+        self.followups = {}
+        self.deterministic_substitutions = True
+        self.script_instances = []
+        self.ignored_rules = []
+        self.substitution_tables = []
 
     def add_rules(self, rules):
         """ Add rules from a list to the rule dictionary. If there is already
@@ -293,9 +559,10 @@ class Topic(object):
         self.rules_are_sorted = False
         for rule in rules:
             tup = (rule.pattern.formatted_pattern,
-                   rule.previous.formatted_pattern)
+                   rule.previous.formatted_pattern, rule.previous_rule)
             if tup in self.rules:
                 existing_rule = self.rules[tup]
+                self.ignored_rules.append(rule)
                 log.warning("Ignoring rule {0} because its patterns are "
                             "duplicates of the patterns of the rule "
                             "{1} ".format(
@@ -303,26 +570,144 @@ class Topic(object):
             else:
                 self.rules[tup] = rule
                 log.debug('Loaded pattern "{0[0]}", previous="{0[1]}", '
-                          'weight={1}, method={2}'.format(tup, rule.weight,
-                                                          rule.rulename))
+                          'previous_rule="{0[2]}", weight={1}, '
+                          'method={2}'.format(tup, rule.weight,
+                                              rule.rulename))
 
     def add_substitutions(self, substitutions):
         """ Add substitution methods to the substitutions list """
         self.substitutions.extend(substitutions)
+        self.deterministic_substitutions = all(
+            [getattr(method, "deterministic", False)
+             for name, method in self.substitutions])
+
+    def add_substitution_table(self, instance, name, table):
+        """ Add a script's substitutions table to the ones compiled into
+        this topic's SubstitutionTable. """
+        self.substitution_tables.append((instance, name, table))
+        self._compile_substitution_tables()
+
+    def _compile_substitution_tables(self):
+        """ Replace the topic's SubstitutionTable with a new one made from
+        substitution_tables. """
+        substitutions = [(name, method) for name, method in self.substitutions
+                         if not isinstance(get_method_self(method),
+                                           SubstitutionTable)]
+        if self.substitution_tables:
+            compiled = SubstitutionTable([(name, table) for instance, name,
+                                          table in self.substitution_tables])
+            substitutions.insert(0, ("substitutions", compiled.substitute))
+        self.substitutions = []
+        self.add_substitutions(substitutions)
+
+    def remove_scripts(self, instances):
+        """ Remove script instances from this topic, along with the rules
+        and substitution methods which belong to them. Rules which were
+        ignored because they duplicated a removed rule are added in its
+        place.
+        """
+        ids = set([id(instance) for instance in instances])
+
+        def owned(method):
+            return id(get_method_self(method)) in ids
+
+        removed = [k for k, rule in self.rules.items() if owned(rule.method)]
+        for k in removed:
+            del self.rules[k]
+        self.script_instances = [i for i in self.script_instances
+                                 if id(i) not in ids]
+        substitutions = [(name, method) for name, method in self.substitutions
+                         if not owned(method)]
+        if len(substitutions) != len(self.substitutions):
+            self.substitutions = []
+            self.add_substitutions(substitutions)
+        tables = [t for t in self.substitution_tables if id(t[0]) not in ids]
+        if len(tables) != len(self.substitution_tables):
+            self.substitution_tables = tables
+            self._compile_substitution_tables()
+        ignored = [rule for rule in self.ignored_rules
+                   if not owned(rule.method)]
+        self.ignored_rules = []
+        if removed:
+            self.add_rules(ignored)
+        else:
+            self.ignored_rules = ignored
 
     def sort_rules(self):
-        """ If sorted_rules is out of date, update it. """
+        """ If sorted_rules is out of date, update it. Then work out what
+        must be checked before reusing a reply from a pure rule. Rules tried
+        before it whose patterns contain user or bot variables might match
+        the same message next time, so those have to be tried again. If any
+        rule tried before it has a previous pattern, the reply may only be
+        reused when the previous reply is the same too.
+        """
         if self.rules_are_sorted:
             return
         self.sortedrules = sorted(self.rules.values(), reverse=True)
         self.rules_are_sorted = True
+        self._share_previous_patterns()
+
+        variable_rules = []
+        previous_seen = False
+        self.followups = {}
+        self._ranked_general_rules = []
+        for rank, rule in enumerate(self.sortedrules):
+            if rule.uses_variables():
+                variable_rules.append(rule)
+            previous_seen = (previous_seen or bool(rule.previous) or
+                             bool(rule.previous_rule))
+            rule.memo_guards = tuple(variable_rules)
+            rule.memo_uses_previous = previous_seen
+            if rule.previous_rule:
+                self.followups.setdefault(rule.previous_rule, []).append(
+                    (rank, rule))
+            else:
+                self._ranked_general_rules.append((rank, rule))
+        self.general_rules = [rule for rank, rule
+                              in self._ranked_general_rules]
+        self.has_previous_rules = previous_seen
+
+    def followups_of(self, rulenames):
+        """ Given the names of the rules which made a reply, return a list,
+        sorted by rank, of (rank, Rule) tuples for the rules in this topic
+        which may follow it because they name one of them as
+        previous_rule. """
+        followups = {}
+        for name in rulenames:
+            followups.update(self.followups.get(name, ()))
+        return sorted(followups.items())
+
+    def rules_to_try(self, followups):
+        """ Return an iterable of the rules to try, in sorted order: the
+        rules without a previous_rule, and the (rank, Rule) tuples given by
+        followups_of. Rules with a previous_rule that didn't make the last
+        reply aren't looked at at all. """
+        if not followups:
+            return self.general_rules
+        return (rule for rank, rule in
+                heapq.merge(followups, self._ranked_general_rules))
+
+    def _share_previous_patterns(self):
+        """ Group the rules by previous pattern, and give all the rules in
+        a group the same Pattern object, so that a history entry which
+        remembers the results of matching previous patterns (see
+        LazyTarget.match_previous) will only match each one once. Patterns
+        containing user or bot variables are left alone, since they can't
+        be matched ahead of time.
+        """
+        shared = {}
+        for rule in self.sortedrules:
+            if rule.previous and rule.previous.regexc is not None:
+                key = rule.previous.regexc.pattern
+                rule.previous = shared.setdefault(key, rule.previous)
 
     def log_sorted_rules(self):
         """ Print sorted rules to logging output """
         for r in self.sortedrules:
-            log.debug('({2}) "{0}"/"{1}"'.format(
+            log.debug('({2}) "{0}"/"{1}"{3}'.format(
                 r.pattern.formatted_pattern,
-                r.previous.formatted_pattern, r.weight))
+                r.previous.formatted_pattern, r.weight,
+                " after " + r.previous_rule if r.previous_rule else ""))
 
 
 class Rule(object):
@@ -339,15 +724,29 @@ class Rule(object):
     weight - the weight, given to @rule
     method - a reference to the decorated method
     rulename - modulename.classname.methodname, for error messages
+    pure - the pure flag given to @rule
+    previous_rule - the full name of the rule which must have made the
+            previous reply for this one to be used, or ""
+    memo_guards - the rules which must fail to match before a remembered
+            reply from this rule can be reused, set by Topic.sort_rules
+    memo_uses_previous - True if a remembered reply must be looked up
+            using the previous reply as well as the message, set by
+            Topic.sort_rules
 
     Public methods:
     match - given current message and reply history, return a Match
             object if the patterns match or None if they don't
+    uses_variables - True if the patterns depend on user or bot variables
     full set of comparison operators - to enable sorting first by weight then
             score of the two patterns
     """
+    __slots__ = ("pattern", "previous", "weight", "method", "rulename",
+                 "pure", "previous_rule", "memo_guards",
+                 "memo_uses_previous")
+
     def __init__(self, raw_pattern, raw_previous, weight, alternates,
-                 method, rulename):
+                 method, rulename, pure=False, previous_rule="",
+                 patterns=None, normalizer=None):
         """ Create a new Rule object based on information supplied to the
         @rule decorator. Arguments:
         raw_pattern - simplified regular expression string supplied to @rule
@@ -358,6 +757,13 @@ class Rule(object):
         method - reference to method decorated by @rule
         rulename - modulename.classname.methodname, used to make better
                  error messages
+        pure - pure flag supplied to @rule
+        previous_rule - full name of the rule given as previous_rule
+                 to @rule
+        patterns - dictionary of pattern strings and the Patterns made
+                 from them with the same alternates, to reuse; new ones
+                 are added to it
+        normalizer - Normalizer to give to the Patterns, or None
 
         Raises PatternError, PatternVariableNotFoundError,
                PatternVariableValueError
@@ -366,9 +772,14 @@ class Rule(object):
             previous = ""
             if not raw_pattern:
                 raise PatternError("Empty string found")
-            self.pattern = Pattern(raw_pattern, alternates)
+            if patterns is None:
+                patterns = {}
+            self.pattern = _make_pattern(raw_pattern, alternates, patterns,
+                                         normalizer)
             previous = "previous "
-            self.previous = Pattern(raw_previous, alternates)
+            self.previous = (_make_pattern(raw_previous, alternates, patterns,
+                                           normalizer)
+                             if raw_previous else _NO_PATTERN)
         except (TypeError, PatternError, PatternVariableValueError,
                 PatternVariableNotFoundError) as e:
             msg = " in {0}pattern of {1}".format(previous, rulename)
@@ -378,32 +789,53 @@ class Rule(object):
         self.weight = weight
         self.method = method
         self.rulename = rulename
+        self.pure = pure
+        self.previous_rule = previous_rule
+        self.memo_guards = ()
+        self.memo_uses_previous = True
+
+    def uses_variables(self):
+        """ Return True if either pattern could only be turned into a
+        regular expression at match time, because it uses user or bot
+        variables.
+        """
+        return (self.pattern.regexc is None or
+                (bool(self.previous) and self.previous.regexc is None))
 
     def match(self, target, history, variables):
         """ Return a Match object if the targets match the patterns
         for this rule, or None if they don't.
         Arguments:
             target - a Target object for the user's message
-            history - a deque object containing Targets for previous
-                      replies
+            history - a deque object containing Targets (or LazyTargets)
+                      for previous replies
             variables - User and Bot variables for the PatternParser
                       to substitute into the patterns
         """
-        m = self.pattern.match(target.normalized, variables)
-        if m is None:
-            return None
         mp = None
         reply_target = None
-
         if self.previous:
             if not history:
                 return None
             reply_target = history[0]
-            mp = self.previous.match(reply_target.normalized, variables)
+            mp = reply_target.match_previous(self.previous, variables)
             if mp is None:
                 return None
+
+        m = self.pattern.match(target.normalized, variables)
+        if m is None:
+            return None
         return Match(m, mp, target, reply_target)
 
+    @property
+    def previous_score(self):
+        """ The score of the previous pattern, with a bonus if there is
+        a previous rule, so that rules which are follow-ups to other rules
+        are tried before those which aren't. """
+        if self.previous_rule:
+            return self.previous.score + _PREVIOUS_RULE_SCORE
+        return self.previous.score
+
     def __lt__(self, other):
         """ Full set of comparison operators. The weight passed to @rule
         is the most significant, followed by the complexity of the pattern
@@ -414,12 +846,12 @@ class Rule(object):
                  self.pattern.score < other.pattern.score) or
                 (self.weight == other.weight and
                  self.pattern.score == other.pattern.score and
-                 self.previous.score < other.previous.score))
+                 self.previous_score < other.previous_score))
 
     def __eq__(self, other):
         return (self.weight == other.weight and
                 self.pattern.score == other.pattern.score and
-                self.previous.score == other.previous.score)
+                self.previous_score == other.previous_score)
 
     def __gt__(self, other):
         return not (self == other or self < other)
@@ -434,13 +866,39 @@ class Rule(object):
         return not self == other
 
 
+def _make_pattern(raw, alternates, patterns, normalizer):
+    """ Return the Pattern in patterns for raw, or make one and add it.
+    Patterns made with a different normalizer, such as those saved by an
+    engine configured differently, are made again. """
+    pattern = patterns.get(raw)
+    if pattern is None or pattern.normalizer != normalizer:
+        pattern = patterns[raw] = Pattern(raw, alternates,
+                                          normalizer=normalizer)
+    return pattern
+
+
 class Match(object):
     """ For a match between the two patterns of a @rule and a user message
-    and previous reply, construct a dictionary of values for the parts of the
+    and previous reply, make a MatchDict of values for the parts of the
     match the @rule wanted to use.
 
     Public instance variable:
-        dict -- dictionary of matched text
+        dict -- MatchDict of matched text
+    """
+    def __init__(self, m_pattern, m_previous, target, previous_target):
+        """ Construct a Match object given two regular expression match objects,
+        which if constructed by ParsedPattern will have named groups
+        match0, match1, ... matchN, as well as the Target objects
+        they were matched to.
+        """
+        self.dict = MatchDict(m_pattern, target, m_previous, previous_target)
+
+
+class MatchDict(Mapping):
+    """ A read-only dictionary of the text matched by the memorized parts of
+    a rule's patterns. Values are only looked up when they are asked for,
+    so the work of finding the raw text for a match is not done unless
+    something uses it.
 
     The dictionary keys will be:
     match0..matchN         -- memorized matches in the tokenized text of
@@ -450,42 +908,51 @@ class Match(object):
     raw_match0..rawN       -- memorized matches of the untokenized text of the
                               message, all capitals and punctuation included,
                               but whitespace normalized.
-    reply_raw_match0 -- reply_rawmatchN -- memorized matches of the untokenized
-                              text of the previous reply
+    raw_reply_match0 -- raw_reply_matchN -- memorized matches of the
+                              untokenized text of the previous reply
     """
-    def __init__(self, m_pattern, m_previous, target, previous_target):
-        """ Construct a Match object given two regular expression match objects,
-        which if constructed by ParsedPattern will have populated the groupdict
-        with keys match0, match1, ... matchN, as well as the Target objects
-        they were matched to.
-        """
-        self.dict = {}
-        self._add_matches(m_pattern, target, "")
+    def __init__(self, m_pattern, target, m_previous=None,
+                 previous_target=None):
+        self._sources = {"": (m_pattern, target)}
         if m_previous is not None:
-            self._add_matches(m_previous, previous_target, "reply_")
-
-    def _add_matches(self, m, target, prefix):
-        """ Prefix all keys from m.groupdict() with the prefix argument, and
-        add them to self.dict. Then use the fact that the tokenized_words and
-        raw_words lists in target are the same length to find the chunk of raw
-        text that each match corresponds to, and add those to the dictionary
-        with "raw_" prefixed to their keys.
-        Arguments:
-            m - a match object from a re function
-            target - a Target object
-            prefix - a prefix string to add to key names
+            self._sources["reply_"] = (m_previous, previous_target)
+        self._values = {}
 
-        """
-        offsets = []
-        offset = 0
-        for wl in target.tokenized_words:
-            offsets.append(offset)
-            offset += len(" ".join(wl)) + 1
-
-        for k, v in m.groupdict().items():
-            self.dict[prefix + k] = v
-            start, end = m.span(k)
-            i_start = bisect.bisect_left(offsets, start)
-            i_end = bisect.bisect(offsets, end)
-            self.dict["raw_" + prefix + k] = " ".join(target.raw_words[i_start:
-                                                                       i_end])
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._values[key] = self._lookup(key)
+        return value
+
+    def raw_text_used(self):
+        """ Return True if any of the raw_ values have been looked up. """
+        return any([key.startswith("raw_") for key in self._values])
+
+    def _lookup(self, key):
+        """ Find the value for a key. Raise KeyError if there isn't one. """
+        raw = key.startswith("raw_")
+        name = key[4:] if raw else key
+        prefix = "reply_" if name.startswith("reply_") else ""
+        try:
+            m, target = self._sources[prefix]
+        except KeyError:
+            raise KeyError(key)
+        group = name[len(prefix):]
+        if group not in m.re.groupindex:
+            raise KeyError(key)
+        if raw:
+            start, end = m.span(group)
+            return target.raw_text_between(start, end)
+        return m.group(group)
+
+    def __iter__(self):
+        for prefix, (m, target) in sorted(self._sources.items()):
+            for group in sorted(m.re.groupindex):
+                yield prefix + group
+                yield "raw_" + prefix + group
+
+    def __len__(self):
+        return 2 * sum([len(m.re.groupindex)
+                        for m, target in self._sources.values()])
@@ -10,17 +10,33 @@ import collections
 from functools import wraps
 import random
 import re
+from string import Formatter
 
 from chatbot_reply.six import with_metaclass
 from chatbot_reply.constants import _HISTORY, _PREFIX
+from chatbot_reply.responses import ResponseTable
 
+# Formatter.vformat only looks up the keys a format string uses, unlike
+# str.format(**match), which would copy every key of the MatchDict.
+_formatter = Formatter()
 
-def rule(pattern_text, previous_reply="", weight=1):
+# the arguments given to @rule, kept as the rule_spec attribute of the
+# method it returns
+RuleSpec = collections.namedtuple(
+    "RuleSpec", "pattern previous_reply weight pure previous_rule")
+
+
+def rule(pattern_text, previous_reply="", weight=1, pure=False,
+         previous_rule=""):
     """ decorator for rules in subclasses of Script """
+    if callable(previous_rule):
+        previous_rule = previous_rule.__name__
+    spec = RuleSpec(pattern_text, previous_reply, weight, pure,
+                    previous_rule)
+
     def rule_decorator(func):
         @wraps(func)
-        def func_wrapper(self, pattern=pattern_text,
-                         previous_reply=previous_reply, weight=weight):
+        def func_wrapper(self):
             result = func(self)
             try:
                 return self.process_reply(self.choose(result))
@@ -31,13 +47,33 @@ def rule(pattern_text, previous_reply="", weight=1):
                        "from {0}".format(name))
                 e.args = (e.args[0] + msg,) + e.args[1:]
                 raise
+        func_wrapper.rule_spec = spec
         return func_wrapper
     return rule_decorator
 
 
+def substitution(deterministic=False, edits=False):
+    """ decorator for substitute methods in subclasses of Script. Use it
+    with deterministic=True to declare that the method's return value
+    depends only on its arguments, so that the engine may remember and
+    share the results of substitutions. Use it with edits=True to declare
+    that the method takes a TokenBuffer and returns a list of edits to
+    make to it, instead of taking and returning lists of lists of words.
+    """
+    def substitution_decorator(func):
+        func.deterministic = deterministic
+        func.edits = edits
+        return func
+    return substitution_decorator
+
+
 class ScriptRegistrar(type):
     """ Metaclass of Script which keeps track of newly imported Script
-    subclasses in a list.
+    subclasses in a list, and gives each one the sorted names of its
+    attributes, including inherited ones, which begin with "rule" and
+    "substitute", as the class attributes _rule_names and
+    _substitution_names. Attributes added to a class after it is created
+    aren't included.
     Public class attribute:
         registry - a list of classes
     Public class method:
@@ -47,6 +83,16 @@ class ScriptRegistrar(type):
 
     def __new__(cls, name, bases, attributes):
         new_cls = type.__new__(cls, name, bases, attributes)
+        rule_names = set()
+        substitution_names = set()
+        for klass in new_cls.__mro__:
+            for attribute in vars(klass):
+                if attribute.startswith("rule"):
+                    rule_names.add(attribute)
+                elif attribute.startswith("substitute"):
+                    substitution_names.add(attribute)
+        new_cls._rule_names = tuple(sorted(rule_names))
+        new_cls._substitution_names = tuple(sorted(substitution_names))
         if new_cls.__module__ != cls.__module__:
             cls.registry.append(new_cls)
         return new_cls
@@ -78,11 +124,31 @@ class Script(with_metaclass(ScriptRegistrar, object)):
     setup(self) - a method that may be used to define alternates (see below)
         and to initialize bot variables. It will be called after each instance
         of a script object is created, and may be called again if the engine
-        wants to reset bot variables.
+        wants to reset bot variables. When the engine is restored from a
+        snapshot and the script's file hasn't changed, setup isn't called.
+        Instead the instance variables it set are restored, so anything
+        setup does outside of the chatbot won't be done again.
 
     setup_user(self, user) - a method that is called the first time the engine
-        is processing a message from a given user. This is a good place to
-        initialize user variables used by a script.
+        is processing a message from a given user in the script's topic. This
+        is a good place to initialize user variables used by a script. Most
+        users never visit most topics, so this saves setting up what they
+        would never use.
+
+    eager_setup_user - set this class variable to True to have setup_user
+        called when the engine first hears from a user, whatever topic they
+        are in, for scripts whose user variables are used by rules in
+        other topics.
+
+    evict_user(self, user) - a method that is called when the engine is
+        about to stop keeping information about a user, because it was told
+        to keep only so many users or to forget users who have been idle.
+        self.uservars and self.userinfo belong to the user being evicted.
+        If the engine has a user store, the user will be restored the next
+        time they send a message, otherwise they will be treated as new.
+        It isn't called if the store is shared, such as a
+        SharedSQLiteUserStore, since the user's variables were saved after
+        their last reply and changes made to them now would be lost.
 
     alternates - a dictionary of patterns. Key names must be alphanumeric and
         may not begin with an underscore or number. The patterns must be simple
@@ -103,19 +169,60 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         expand contractions, interpret ascii smileys such as >:| and otherwise
         mess with the tokenizations. If there is more than one substitute method
         for a topic, they will all be called in an unpredictable order, each
-        passed the output of the one before.
-
-    @rule(pattern, previous="", weight=1)
+        passed the output of the one before. If all the substitute methods
+        for a topic are decorated by @substitution(deterministic=True), the
+        engine will remember the results for messages and replies it sees
+        often instead of calling them again.
+        A substitute method decorated by @substitution(edits=True) is
+        passed a TokenBuffer instead of a list of lists of words. It
+        should return a list of (start, end, words) tuples, each of which
+        replaces tokens.words[start:end] with a list of words, and the
+        engine will make those edits to the buffer. The words in the buffer
+        are not copied for each substitute method, so this is faster for
+        methods which change only a few words. tokens.raw_index gives the
+        index of the raw word each word came from.
+
+    substitutions - a dictionary of words or phrases and the words to put in
+        their place, for the common case of a substitute method that looks
+        words up in a dictionary. A word matches if it is the same once it
+        is made lower case and any punctuation at its end is removed, and
+        the longest phrase which matches is replaced. The tables of all the
+        scripts in a topic are merged and compiled when the scripts are
+        loaded, and used before the topic's substitute methods, which
+        remain available for anything a table can't do. The engine may
+        remember the results, as for deterministic substitute methods.
+
+    @rule(pattern, previous="", weight=1, pure=False, previous_rule="")
     rule(self) - Methods decorated by @rule and beginning with "rule" are
         the gears of the script engine. The engine will select one rule method
         that matches a message and call it. The @rule decorator will run the
         method's return value through first self.choose then self.process_reply.
+        If pure is True, the rule promises that its reply depends only on
+        the normalized words it matched, the match variables: it doesn't
+        look at or change other variables or the topic, has no other side
+        effects, and returns a single string rather than a list to choose
+        from. The engine may then remember the reply and reuse it the next
+        time a message which normalizes the same way arrives, without
+        calling the rule method again. A reply which uses the raw_match
+        variables, whose capitals and punctuation may differ from one such
+        message to the next, is not remembered.
+        If previous_rule is given, the rule will only be used if the last
+        reply was made by, or included the reply from, the named rule. It
+        may be the rule method itself, the name of a method in the same
+        class, or a name of the form "classname.methodname" or
+        "modulename.classname.methodname".
+        The engine finds rule and substitute methods when the class is
+        created, so they must be defined in a class statement rather than
+        added to the class or instance afterwards.
 
     Child classes may redefine self.choose and self.process_reply if they would
     like different behavior.
 
     choose(self, retval) - A method that returns a string. The @rule decorator
-        will call self.choose on the return values of all rules.
+        will call self.choose on the return values of all rules. Rules
+        which choose from the same replies every time can return a
+        ResponseTable declared as a class attribute, which is prepared once
+        instead of on every call and can give each user the replies in turn.
 
     process_reply(self, string) - A method that takes a string and returns a
         string. The @rule decorator will call this on the return value it gets
@@ -130,7 +237,7 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         all users of the chatbot engine
     uservars - dictionary of variable names and values for the current user
     userinfo - UserInfo object containing info about the sender
-    match - a Match object (see rules.py) representing the relationship between
+    match - a MatchDict (see rules.py) representing the relationship between
         the matched user input (and previous reply, if applicable) and the
         rule's patterns
 
@@ -142,6 +249,7 @@ class Script(with_metaclass(ScriptRegistrar, object)):
 
     """
     topic = "all"
+    eager_setup_user = False
 
     def __init__(self):
         self.botvars = None
@@ -168,6 +276,10 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         """ placeholder """
         pass
 
+    def evict_user(self, user):
+        """ placeholder """
+        pass
+
     def choose(self, args):
         """ Select a response from a list of possible responses. For increased
         flexibility, since this is used to process all return values from all
@@ -180,7 +292,16 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         weight, select a string randomly with the probability of its selection
         being proportional to the weight.
 
+        If the argument is a ResponseTable, let it choose. The cursors of
+        tables which rotate are kept for each user in
+        self.uservars["_response_cursors"].
+
         """
+        if isinstance(args, ResponseTable):
+            cursors = None
+            if args.rotate:
+                cursors = self.uservars.setdefault("_response_cursors", {})
+            return args.choose(cursors)
         if args is None or not args:
             reply = ""
         else:
@@ -204,7 +325,7 @@ class Script(with_metaclass(ScriptRegistrar, object)):
         thing this does is use built-in string formatting to substitute in the
         match results.
         """
-        return string.format(*[], **self.match)
+        return _formatter.vformat(string, (), self.match)
 
 
 class UserInfo(object):
@@ -212,32 +333,55 @@ class UserInfo(object):
     vars: a dictionary of variable names and values
     info: a dictionary of information about the user
     topic_name: the name of the topic the user is currently in
-    msg_history: a deque containing Targets for a few recent messages
-    repl_history: a deque containing Targets for a few recent replies
+    msg_history: a deque containing a few recent messages
+    repl_history: a deque containing a few recent replies, as LazyTargets
+        (see reply.py), which may be used like Targets
+    topics_set_up: a set of the names of the topics whose scripts have
+        had their setup_user methods called for this user
     """
     def __init__(self, info):
         self.vars = {}
         self.info = info
         self.topic_name = "all"
+        self.topics_set_up = set()
         self.msg_history = collections.deque(maxlen=_HISTORY)
         self.repl_history = collections.deque(maxlen=_HISTORY)
 
 # ----- a couple of useful utility functions for writers of substitute methods
 
 
+# Compiled patterns take flags in Py 2.6, unlike re.split and re.sub.
+_WHITESPACE_RE = re.compile(r"\S+", flags=re.UNICODE)
+_NON_ALPHANUMERIC_RE = re.compile(r"\W+", flags=re.UNICODE)
+# normalize_words joins words with this, so it must not be alphanumeric
+_SEPARATOR = "\x00"
+_NON_ALPHANUMERIC_OR_SEPARATOR_RE = re.compile(r"[^\w\x00]+",
+                                               flags=re.UNICODE)
+
+
 def split_on_whitespace(text):
-    """ Because this has to work in Py 2.6, and re.split doesn't do UNICODE
-    in 2.6.  Return text broken into words by whitespace. """
-    matches = [m for m in re.finditer("[\S]+", text, flags=re.UNICODE)]
-    results = [text[m.span()[0]:m.span()[1]] for m in matches]
-    return results
+    """ Return text broken into words by whitespace. """
+    return _WHITESPACE_RE.findall(text)
 
 
 def kill_non_alphanumerics(text):
     """remove any non-alphanumeric characters from a string and return the
-    result. re.sub doesn't do UNICODE in python 2.6.
+    result.
 
     """
-    matches = [m for m in re.finditer("[\w]+", text, flags=re.UNICODE)]
-    result = "".join([text[m.span()[0]:m.span()[1]] for m in matches])
-    return result
+    return _NON_ALPHANUMERIC_RE.sub("", text)
+
+
+def normalize_words(words):
+    """ Return a list of the words in a list, made lower case and with
+    their non-alphanumeric characters removed. This gives the same results
+    as calling kill_non_alphanumerics(word.lower()) on each word, but does
+    all the words at once with one call to lower and one to the regular
+    expression engine.
+    """
+    joined = _SEPARATOR.join(words).lower()
+    results = _NON_ALPHANUMERIC_OR_SEPARATOR_RE.sub("", joined).split(
+        _SEPARATOR)
+    if len(results) != len(words):  # empty list, or a word had a separator
+        results = [kill_non_alphanumerics(word.lower()) for word in words]
+    return results
@@ -0,0 +1,398 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.sqlite_store, keeps users' UserInfo objects in a SQLite
+database so conversations can survive a restart, or be shared between
+engines.
+"""
+from __future__ import unicode_literals
+
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from chatbot_reply.six.moves import cPickle as pickle
+from chatbot_reply.exceptions import UserStateConflictError
+from chatbot_reply.users import UserStore
+
+log = logging.getLogger(__name__)
+
+_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL")
+
+# the open lock files of the SharedSQLiteUserStores in this process, by
+# real path, since fcntl locks belong to the process and closing any file
+# descriptor of a file drops all of them
+_lock_files = {}
+_lock_files_lock = threading.Lock()
+
+
+class SQLiteUserStore(UserStore):
+    """ A persistent UserStore which pickles UserInfo objects into a SQLite
+    database.
+
+    update and save don't touch the database. They pickle the UserInfo
+    and put it on a list of changed users, and a background thread writes
+    all the changed users every flush_interval seconds in a single
+    transaction. load looks at that list before reading the database, so
+    it always sees the latest save.
+
+    The database is opened, and the background thread started, when the
+    store is first used, so a store may be created in one process and
+    used in a child process.
+
+    Public method, besides those of UserStore:
+    flush - write the changed users now
+    """
+    persistent = True
+
+    def __init__(self, path, flush_interval=1.0, synchronous="NORMAL"):
+        """ Arguments:
+        path - filename of the database, which will be created if needed
+        flush_interval - number of seconds between writes
+        synchronous - durability mode, passed to SQLite's synchronous
+            pragma. "FULL" survives power failures, "NORMAL" survives
+            crashes of the program, and "OFF" is fastest.
+        """
+        if synchronous.upper() not in _SYNCHRONOUS_MODES:
+            raise ValueError("synchronous must be one of " +
+                             ", ".join(_SYNCHRONOUS_MODES))
+        self.path = path
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous.upper()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._conn = None
+        self._write_conn = None
+        self._thread = None
+        self._stop = None
+
+    def __getstate__(self):
+        return (self.path, self.flush_interval, self.synchronous)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _open(self):
+        """ Open the database and start the flushing thread, if that hasn't
+        been done already. Must be called with self._lock held. There are
+        two connections, one for reading, used with self._lock held, and
+        one for the flushing thread, used with self._write_lock held, so
+        that reading and saving users never waits for a flush to finish.
+        """
+        if self._conn is not None:
+            return
+        self._write_conn = sqlite3.connect(self.path,
+                                           check_same_thread=False)
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._write_conn.execute("PRAGMA synchronous={0}".format(
+            self.synchronous))
+        self._write_conn.execute("CREATE TABLE IF NOT EXISTS users "
+                                 "(user BLOB PRIMARY KEY, userinfo BLOB)")
+        self._write_conn.commit()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically,
+                                        name="Chatbot User Store")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _flush_periodically(self):
+        stop = self._stop
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                log.error("Error saving users to {0}".format(self.path),
+                          exc_info=True)
+
+    def load(self, user):
+        key = _dumps(user)
+        with self._lock:
+            if key in self._pending:
+                data = self._pending[key]
+            elif key in self._flushing:
+                data = self._flushing[key]
+            else:
+                self._open()
+                row = self._conn.execute(
+                    "SELECT userinfo FROM users WHERE user = ?",
+                    (sqlite3.Binary(key),)).fetchone()
+                data = row[0] if row is not None else None
+        if data is None:
+            return None
+        return pickle.loads(bytes(data))
+
+    def save(self, user, userinfo):
+        try:
+            data = _dumps(userinfo)
+        except Exception:
+            log.error("Could not save user {0}".format(user), exc_info=True)
+            return
+        with self._lock:
+            self._open()
+            self._pending[_dumps(user)] = data
+
+    def update(self, user, userinfo):
+        self.save(user, userinfo)
+
+    def delete(self, user):
+        with self._lock:
+            self._open()
+            self._pending[_dumps(user)] = None
+
+    def keys(self):
+        with self._lock:
+            self._open()
+            keys = set([bytes(row[0]) for row in
+                        self._conn.execute("SELECT user FROM users")])
+            changes = list(self._flushing.items())
+            changes.extend(self._pending.items())
+            for key, data in changes:
+                if data is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return [pickle.loads(key) for key in keys]
+
+    def flush(self):
+        """ Write all the changed users in one transaction. """
+        with self._write_lock:
+            with self._lock:
+                if self._conn is None or not self._pending:
+                    return
+                pending = self._flushing = self._pending
+                self._pending = {}
+            try:
+                with self._write_conn:
+                    self._write_conn.executemany(
+                        "DELETE FROM users WHERE user = ?",
+                        [(sqlite3.Binary(key),)
+                         for key, data in pending.items() if data is None])
+                    self._write_conn.executemany(
+                        "INSERT OR REPLACE INTO users VALUES (?, ?)",
+                        [(sqlite3.Binary(key), sqlite3.Binary(data))
+                         for key, data in pending.items()
+                         if data is not None])
+            except sqlite3.Error:
+                with self._lock:  # try again next time
+                    pending.update(self._pending)
+                    self._pending = pending
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            log.debug("Saved {0} users to {1}".format(len(pending),
+                                                      self.path))
+
+    def close(self):
+        """ Stop the flushing thread, write the changed users and close the
+        database. """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        self.flush()
+        with self._write_lock:
+            with self._lock:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._write_conn.close()
+                self._conn = self._write_conn = self._thread = None
+
+
+class SharedSQLiteUserStore(UserStore):
+    """ A shared UserStore which pickles UserInfo objects into a SQLite
+    database, which several engines in different processes on the same
+    host may use at once.
+
+    Each user has a version number, which every write increases. update
+    only writes a user if their version is still the one this store
+    loaded, and raises UserStateConflictError if it isn't. Writes are made
+    straight away, so that other engines see them.
+
+    The per-user locks are advisory fcntl locks on single bytes of a lock
+    file kept next to the database, picked by a hash of the user, so
+    engines talking to different users rarely wait for each other. Since
+    fcntl locks belong to a process, a threading lock is held too, and all
+    the stores in a process on the same database share the lock file and
+    the threading locks (see _LockFile).
+    """
+    persistent = True
+    shared = True
+    _LOCK_SLOTS = 1 << 16
+
+    def __init__(self, path, timeout=30.0):
+        """ Arguments:
+        path - filename of the database, which will be created if needed.
+            The lock file is path + ".locks".
+        timeout - number of seconds to wait for another engine to finish
+            writing to the database
+        """
+        if fcntl is None:
+            raise NotImplementedError("SharedSQLiteUserStore needs fcntl, "
+                                      "which this platform doesn't have")
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._lock_file = None
+        self._versions = {}
+
+    def __getstate__(self):
+        return (self.path, self.timeout)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _open(self):
+        """ Open the database and the lock file, if that hasn't been done
+        already. Must be called with self._lock held. """
+        if self._conn is not None:
+            return
+        self._conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS shared_users "
+                               "(user BLOB PRIMARY KEY, version INTEGER, "
+                               "userinfo BLOB)")
+        self._lock_file = _LockFile.open(self.path + ".locks")
+
+    def load(self, user):
+        key = _dumps(user)
+        with self._lock:
+            self._open()
+            row = self._conn.execute(
+                "SELECT version, userinfo FROM shared_users WHERE user = ?",
+                (sqlite3.Binary(key),)).fetchone()
+            if row is None:
+                self._versions.pop(key, None)
+                return None
+            self._versions[key] = row[0]
+        return pickle.loads(bytes(row[1]))
+
+    def save(self, user, userinfo):
+        self.update(user, userinfo)
+
+    def update(self, user, userinfo):
+        key = _dumps(user)
+        data = sqlite3.Binary(_dumps(userinfo))
+        with self._lock:
+            self._open()
+            version = self._versions.get(key)
+            try:
+                with self._conn:
+                    if version is None:
+                        self._conn.execute(
+                            "INSERT INTO shared_users VALUES (?, 1, ?)",
+                            (sqlite3.Binary(key), data))
+                    elif self._conn.execute(
+                            "UPDATE shared_users SET version = ?, "
+                            "userinfo = ? WHERE user = ? AND version = ?",
+                            (version + 1, data, sqlite3.Binary(key),
+                             version)).rowcount != 1:
+                        raise UserStateConflictError
+            except (sqlite3.IntegrityError, UserStateConflictError):
+                self._versions.pop(key, None)
+                raise UserStateConflictError(
+                    "User {0} was changed by another chatbot engine".format(
+                        user))
+            self._versions[key] = (version or 0) + 1
+
+    def delete(self, user):
+        key = _dumps(user)
+        with self._lock:
+            self._open()
+            with self._conn:
+                self._conn.execute("DELETE FROM shared_users WHERE user = ?",
+                                   (sqlite3.Binary(key),))
+            self._versions.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            self._open()
+            rows = self._conn.execute("SELECT user FROM shared_users")
+            return [pickle.loads(bytes(row[0])) for row in rows]
+
+    def lock(self, user):
+        offset = zlib.crc32(_dumps(user)) & (self._LOCK_SLOTS - 1)
+        with self._lock:
+            self._open()
+            lock_file = self._lock_file
+        lock_file.lock(offset)
+
+    def unlock(self, user):
+        offset = zlib.crc32(_dumps(user)) & (self._LOCK_SLOTS - 1)
+        self._lock_file.unlock(offset)
+
+    def close(self):
+        """ Close the database, and the lock file if no other store in this
+        process is using it. """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._lock_file.close()
+            self._conn = self._lock_file = None
+            self._versions = {}
+
+
+class _LockFile(object):
+    """ A lock file opened once in this process for all the
+    SharedSQLiteUserStores on the same database, with a threading lock for
+    each byte that has been locked, so that threads using different stores
+    wait for each other as engines in other processes do. It is closed when
+    the last store using it closes it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        self.thread_locks = {}
+        self.stores = 0
+
+    @classmethod
+    def open(cls, path):
+        """ Return the _LockFile for a path, opening it if no store in
+        this process has it open. """
+        path = os.path.realpath(path)
+        with _lock_files_lock:
+            lock_file = _lock_files.get(path)
+            if lock_file is None:
+                lock_file = _lock_files[path] = cls(path)
+            lock_file.stores += 1
+            return lock_file
+
+    def close(self):
+        with _lock_files_lock:
+            self.stores -= 1
+            if self.stores == 0:
+                del _lock_files[self.path]
+                self.file.close()
+
+    def lock(self, offset):
+        with _lock_files_lock:
+            thread_lock = self.thread_locks.setdefault(offset,
+                                                       threading.Lock())
+        thread_lock.acquire()
+        try:
+            fcntl.lockf(self.file, fcntl.LOCK_EX, 1, offset)
+        except Exception:
+            thread_lock.release()
+            raise
+
+    def unlock(self, offset):
+        try:
+            fcntl.lockf(self.file, fcntl.LOCK_UN, 1, offset)
+        finally:
+            self.thread_locks[offset].release()
+
+
+def _dumps(obj):
+    return pickle.dumps(obj, 2)
@@ -0,0 +1,167 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.substitutions, the token buffer which substitute methods
+edit, and compiles the substitutions tables of the scripts in a topic into
+a single substitution method
+"""
+from __future__ import unicode_literals
+
+import logging
+import string
+
+from chatbot_reply.script import substitution
+
+log = logging.getLogger(__name__)
+
+_END = None  # trie key under which a phrase's replacement is kept
+
+
+def table_key(word):
+    """ Return the form of a word which is looked up in substitutions
+    tables: lower case, with any punctuation at the end removed. """
+    return word.lower().rstrip(string.punctuation)
+
+
+class TokenBuffer(object):
+    """ The words of a message, as they are changed by the substitute
+    methods of a topic. Each word remembers which of the message's raw
+    words it came from, so the tokenized words of a Target can be made
+    from the buffer.
+
+    Substitute methods declared with @substitution(edits=True) are passed
+    the buffer and return a list of edits, which the engine applies to
+    the buffer in place. Other substitute methods are passed the lists of
+    words made by wordlists, and what they return replaces the contents of
+    the buffer.
+
+    Public instance variables:
+        raw_words : tuple of the words of the message, split on whitespace
+        words : list of the words of the message after the substitutions
+            done so far
+        raw_index : list, the same length as words, of the index in
+            raw_words of the word each word came from. It never decreases
+            from one word to the next.
+    """
+    def __init__(self, raw_words):
+        self.raw_words = tuple(raw_words)
+        self.words = list(self.raw_words)
+        self.raw_index = list(range(len(self.raw_words)))
+
+    def apply(self, edits):
+        """ Apply a list of edits to the buffer. Each edit is a tuple
+        (start, end, words), which replaces self.words[start:end] with the
+        list of words, so start == end inserts words and an empty list of
+        words deletes them. The indexes of all the edits refer to the buffer
+        as it was before any of them were made, and the edits may not
+        overlap. The new words belong to the raw word of the first word
+        they replace, or if they replace nothing, of the word they are put
+        before, or the last raw word if they are put at the end.
+        Raises ValueError if the edits are out of range or overlap.
+        """
+        edits = sorted(edits, key=lambda edit: edit[:2])
+        limit = 0
+        for start, end, words in edits:
+            if not limit <= start <= end <= len(self.words):
+                raise ValueError("Edit ({0}, {1}) is out of range or overlaps "
+                                 "another edit".format(start, end))
+            limit = end
+        for start, end, words in reversed(edits):
+            if start < len(self.raw_index):
+                index = self.raw_index[start]
+            elif self.raw_words:
+                index = len(self.raw_words) - 1
+            else:
+                raise ValueError("Can't add words to an empty message")
+            self.words[start:end] = words
+            self.raw_index[start:end] = [index] * len(words)
+
+    def wordlists(self, words=None):
+        """ Return a list containing a list of the words which came from
+        each raw word. If a list of words the same length as self.words is
+        given, such as self.words after normalization, group those instead.
+        """
+        results = [[] for word in self.raw_words]
+        if words is None:
+            words = self.words
+        for word, index in zip(words, self.raw_index):
+            results[index].append(word)
+        return results
+
+    def set_wordlists(self, wordlists):
+        """ Replace the contents of the buffer with a list of lists of words
+        such as wordlists returns. Raises TypeError if there isn't one list
+        for each raw word. """
+        if len(wordlists) != len(self.raw_words):
+            raise TypeError("Returned list must be same length as "
+                            "passed list")
+        self.words = [word for wl in wordlists for word in wl]
+        self.raw_index = [i for i, wl in enumerate(wordlists) for word in wl]
+
+
+class SubstitutionTable(object):
+    """ The substitutions tables of the scripts in a topic, merged into a
+    trie of words. Its substitute method replaces each word or phrase found
+    in the tables in one pass over the words of a message, trying the
+    longest phrase first, so the tables may be used in the place of
+    substitute methods which look words up in a dictionary.
+
+    Public instance variables:
+        sources : dictionary of the phrases in the trie, as tuples of
+            words, and the names of the scripts whose tables they came from
+    """
+    def __init__(self, tables=()):
+        """ tables is a list of (name, table) tuples, where each table is a
+        dictionary of words or phrases and the words to replace them with.
+        If more than one table has the same phrase, the first one wins.
+        """
+        self._trie = {}
+        self.sources = {}
+        for name, table in tables:
+            self.add(name, table)
+
+    def add(self, name, table):
+        """ Add the phrases in a substitutions table to the trie. """
+        for phrase, replacement in table.items():
+            key = tuple([table_key(word) for word in phrase.split()])
+            if not key:
+                raise ValueError("Empty phrase in substitutions "
+                                 "of {0}".format(name))
+            if key in self.sources:
+                log.warning('Ignoring substitution for "{0}" in {1} because '
+                            "{2} already has one".format(
+                                phrase, name, self.sources[key]))
+                continue
+            self.sources[key] = name
+            node = self._trie
+            for word in key:
+                node = node.setdefault(word, {})
+            node[_END] = tuple(replacement.split())
+
+    @substitution(deterministic=True, edits=True)
+    def substitute(self, text, tokens):
+        """ A substitution method (see Script) which replaces the words and
+        phrases in the tables in a TokenBuffer. The replacement for a
+        phrase belongs to its first word.
+        """
+        keys = [table_key(word) for word in tokens.words]
+        edits = []
+        pos = 0
+        while pos < len(keys):
+            node = self._trie
+            end = replacement = None
+            j = pos
+            while j < len(keys):
+                node = node.get(keys[j])
+                if node is None:
+                    break
+                j += 1
+                if _END in node:
+                    end, replacement = j, node[_END]
+            if end is None:
+                pos += 1
+            else:
+                edits.append((pos, end, replacement))
+                pos = end
+        return edits
@@ -0,0 +1,250 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" chatbot_reply.users, keeps track of the users the engine is talking to
+"""
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+UserTableInfo = collections.namedtuple(
+    "UserTableInfo",
+    ["resident", "max_users", "evictions", "expirations", "restores"])
+
+
+class UserStore(object):
+    """ Somewhere to keep the UserInfo objects of users who have been
+    evicted from a UserTable, so they can be restored when the user sends
+    another message. Subclasses must define these methods:
+
+    load(user) - return the UserInfo saved for user, or None
+    save(user, userinfo) - save a UserInfo
+    delete(user) - forget a user, if they were saved
+    keys() - return a list of the users saved
+
+    A store which is persistent keeps resident users too, so they are
+    still there after a restart. UserTable calls its update method each
+    time a resident user's UserInfo changes, and doesn't delete users
+    from it when they are restored. Persistent stores should override:
+
+    update(user, userinfo) - save the latest UserInfo of a resident user
+    close() - finish writing and release resources
+
+    A store which is shared may be used by several engines, in different
+    processes, at once. UserTable holds the store's lock on a user while
+    the engine replies to them, always loads the user from the store
+    rather than trusting its own copy, and doesn't save users to it when
+    evicting them, since they were saved by update. For the same reason
+    on_evict isn't called for them: by then the engine no longer holds
+    their lock, so anything it changed couldn't safely be saved. Shared
+    stores are also persistent, and must override:
+
+    lock(user) - wait until no other engine is replying to user, and
+        keep them from doing so until unlock is called
+    unlock(user) - undo lock
+    """
+    persistent = False
+    shared = False
+
+    def load(self, user):
+        raise NotImplementedError
+
+    def save(self, user, userinfo):
+        raise NotImplementedError
+
+    def delete(self, user):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def update(self, user, userinfo):
+        pass
+
+    def close(self):
+        pass
+
+    def lock(self, user):
+        pass
+
+    def unlock(self, user):
+        pass
+
+
+class MemoryUserStore(UserStore):
+    """ A UserStore which keeps UserInfo objects in a dictionary. """
+    def __init__(self):
+        self._saved = {}
+
+    def load(self, user):
+        return self._saved.get(user)
+
+    def save(self, user, userinfo):
+        self._saved[user] = userinfo
+
+    def delete(self, user):
+        self._saved.pop(user, None)
+
+    def keys(self):
+        return list(self._saved.keys())
+
+
+class UserTable(object):
+    """ A dictionary of users and their UserInfo objects, which may be
+    limited in size. When there are more than max_users users, the one who
+    sent a message least recently is evicted, and users who haven't sent
+    a message for idle_timeout seconds are evicted too. A limit of 0 means
+    no limit. Before a user is evicted on_evict is called with the user and
+    their UserInfo, and then if there is a store, the UserInfo is saved to
+    it, so that get can restore it later. If the store is shared, the user
+    was saved after their last reply, and on_evict isn't called. After a
+    user is restored, on_restore is called with the user and their UserInfo.
+
+    Public methods:
+    get - return a user's UserInfo, restoring it from the store if need be
+    add - add a new user
+    locked - context manager which holds a shared store's lock on a user
+    changed - tell a persistent store that a user's UserInfo has changed
+    expire - evict the users who have been idle too long
+    set_limits - change max_users and idle_timeout
+    info - return a UserTableInfo tuple of statistics
+
+    Looking up users with [], in, keys(), items() and values() only sees
+    the users who are resident, and doesn't count as using them.
+    """
+    def __init__(self, max_users=0, idle_timeout=0, store=None,
+                 on_evict=None, on_restore=None, clock=time.time):
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.store = store
+        self._on_evict = on_evict
+        self._on_restore = on_restore
+        self._clock = clock
+        self._users = collections.OrderedDict()  # least recently used first
+        self._last_used = {}
+        self.evictions = 0
+        self.expirations = 0
+        self.restores = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user):
+        return user in self._users
+
+    def __getitem__(self, user):
+        return self._users[user]
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def keys(self):
+        return list(self._users.keys())
+
+    def items(self):
+        return list(self._users.items())
+
+    def values(self):
+        return list(self._users.values())
+
+    def get(self, user):
+        """ Return the UserInfo for a user and mark them as most recently
+        used. If they aren't resident but are in the store, restore them.
+        If the store is shared, always load them from it, since another
+        engine may have changed them. Return None for users we don't know.
+        """
+        self.expire()
+        userinfo = self._users.pop(user, None)
+        resident = userinfo is not None
+        loaded = False
+        if self.store is not None and (not resident or self.store.shared):
+            stored = self.store.load(user)
+            if stored is not None:
+                userinfo = stored
+                loaded = True
+                if not resident:
+                    log.debug("Restored user {0}".format(user))
+                    self.restores += 1
+                if not self.store.persistent:
+                    self.store.delete(user)
+        if userinfo is not None:
+            self._users[user] = userinfo
+            self._last_used[user] = self._clock()
+            if loaded:
+                if self._on_restore is not None:
+                    self._on_restore(user, userinfo)
+                self._evict_over_limit()
+        return userinfo
+
+    def add(self, user, userinfo):
+        """ Add a user, making them the most recently used, and evict the
+        least recently used user if there are too many. """
+        self.expire()
+        self._users.pop(user, None)
+        self._users[user] = userinfo
+        self._last_used[user] = self._clock()
+        self._evict_over_limit()
+
+    @contextlib.contextmanager
+    def locked(self, user):
+        """ Hold the store's lock on a user, if the store is shared. """
+        if self.store is None or not self.store.shared:
+            yield
+            return
+        self.store.lock(user)
+        try:
+            yield
+        finally:
+            self.store.unlock(user)
+
+    def changed(self, user):
+        """ Pass a resident user's UserInfo to the store's update method,
+        if the store is persistent. """
+        if self.store is not None and self.store.persistent:
+            self.store.update(user, self._users[user])
+
+    def expire(self):
+        """ Evict all the users who have been idle for longer than
+        idle_timeout. """
+        if not self.idle_timeout:
+            return
+        cutoff = self._clock() - self.idle_timeout
+        while self._users:
+            user = next(iter(self._users))
+            if self._last_used[user] > cutoff:
+                break
+            self.expirations += 1
+            self._evict(user)
+
+    def set_limits(self, max_users=0, idle_timeout=0):
+        """ Change the limits, and evict users if there are now too many. """
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.expire()
+        self._evict_over_limit()
+
+    def info(self):
+        return UserTableInfo(len(self._users), self.max_users, self.evictions,
+                             self.expirations, self.restores)
+
+    def _evict_over_limit(self):
+        while self.max_users and len(self._users) > self.max_users:
+            self.evictions += 1
+            self._evict(next(iter(self._users)))
+
+    def _evict(self, user):
+        userinfo = self._users.pop(user)
+        del self._last_used[user]
+        log.debug("Evicting user {0}".format(user))
+        if self.store is not None and self.store.shared:
+            return
+        if self._on_evict is not None:
+            self._on_evict(user, userinfo)
+        if self.store is not None:
+            self.store.save(user, userinfo)
@@ -0,0 +1,443 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Run the chatbot engine in a child process.
+
+The child process owns a ChatbotEngine and answers requests sent to it
+over a multiprocessing Pipe. Requests are tagged with an id so that
+several of them may be in flight at once, and the child answers them in
+the order they were sent, except for load_rules when the engine already
+has rules, which the child works on in a thread of its own so that it can
+go on replying with the old rules in the meantime.  Log records made by
+the engine in the child are sent back through the pipe and logged in the
+parent.
+
+Messages from parent to child are tuples: (request_id, command, args)
+Messages from child to parent are tuples: (request_id, kind, value)
+    where kind is one of "result", "error", "log" or "ready".
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+
+from chatbot_reply import ChatbotEngine
+
+log = logging.getLogger(__name__)
+
+
+class EngineProcessError(Exception):
+    """ Raised for requests that were waiting for a reply from the engine
+    process when it exited. """
+    pass
+
+
+class PendingRequest(object):
+    """ A request which has been sent to the engine process. Call result()
+    to wait for and return the engine's answer, or to raise the exception
+    the engine raised.
+    """
+    def __init__(self, command):
+        self.command = command
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set_result(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the engine process to answer the request. Raises
+        EngineProcessError if timeout seconds pass with no answer.
+        """
+        if not self._done.wait(timeout):
+            raise EngineProcessError("Timed out waiting for the chatbot "
+                                     "engine to answer {0}".format(
+                                         self.command))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class RemoteUserInfo(object):
+    """ What the terminal chat console needs to know about a user whose
+    UserInfo lives in the engine process. """
+    def __init__(self, info):
+        self.info = info
+
+
+class EngineHost(object):
+    """ Owns a child process running a ChatbotEngine, and offers the same
+    load_script_directory, clear_rules and reply methods as ChatbotEngine.
+
+    If the child process exits unexpectedly, requests waiting on it fail
+    with EngineProcessError and a new child is started, which replays the
+    script loading requests made since the last clear_rules. User state in
+    the engine does not survive a restart, unless the engine was given a
+    persistent user_store.
+
+    Public instance methods:
+      start, stop: start and stop the child process
+      submit: send a request without waiting for the answer
+      wait_until_ready: wait until scripts have been loaded
+      load_script_directory, reload_script_directory, load_rules,
+          clear_rules, reply, reply_stateless, cache_info, set_user_limits,
+          user_table_info, snapshot, restore: see ChatbotEngine
+
+    Public instance variables:
+      ready: threading.Event which is set when the child process has
+          loaded its script directory, and cleared while it is (re)loading.
+      restarts: number of times the child process has been restarted
+    """
+    def __init__(self, depth=50, **engine_options):
+        """ Keyword arguments are passed on to ChatbotEngine in the child
+        process. If there is no state_key, one is made here, so that the
+        state returned by reply_stateless still works after a restart. """
+        self._depth = depth
+        engine_options.setdefault("state_key", os.urandom(32))
+        self._engine_options = engine_options
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._loads = []
+        self._process = None
+        self._conn = None
+        self.ready = threading.Event()
+        self.restarts = 0
+
+    def start(self):
+        """ Start the child process, unless it is already running. """
+        with self._lock:
+            if self._process is None:
+                self._start_process()
+
+    def stop(self, timeout=5):
+        """ Ask the child process to exit and wait for it to do so. """
+        with self._lock:
+            process, conn = self._process, self._conn
+            self._process = self._conn = None
+            pending, self._pending = self._pending, {}
+            if process is None:
+                return
+            try:
+                conn.send((None, "stop", ()))
+            except (IOError, OSError, EOFError):
+                pass
+        self._fail(pending, "was stopped")
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+        conn.close()
+
+    def _start_process(self):
+        """ Create the pipe and the child process, and a thread to read
+        answers from it. Must be called with self._lock held.
+        """
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_serve,
+                                          name="Chatbot Engine",
+                                          args=(child_conn, self._depth,
+                                                self._engine_options))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._process, self._conn = process, parent_conn
+        self.ready.clear()
+        reader = threading.Thread(target=self._read_answers,
+                                  name="Chatbot Engine Reader",
+                                  args=(process, parent_conn))
+        reader.daemon = True
+        reader.start()
+        log.debug("Started chatbot engine process {0}".format(process.pid))
+
+    def _read_answers(self, process, conn):
+        """ Dispatch messages from the child process to the PendingRequests
+        waiting for them, until the connection closes. Then restart the
+        child if nobody asked it to stop.
+        """
+        while True:
+            try:
+                request_id, kind, value = conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+            if kind == "log":
+                name, level, msg = value
+                logging.getLogger(name).log(level, msg)
+            elif kind == "ready":
+                self.ready.set()
+            else:
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                if pending is None:
+                    continue
+                if kind == "error":
+                    pending.set_error(value)
+                else:
+                    pending.set_result(value)
+        self._process_exited(process)
+
+    def _process_exited(self, process):
+        with self._lock:
+            if self._process is not process:
+                return  # stopped, or already replaced
+            pending = self._restart()
+        self._fail(pending, "exited")
+
+    def _restart(self):
+        """ Replace the child process which has exited with a new one, and
+        send it the script loading requests. Must be called with self._lock
+        held. Returns the PendingRequests which the old child never answered.
+        """
+        self._process.join(1)
+        log.error("Chatbot engine process exited with code {0}, "
+                  "restarting it".format(self._process.exitcode))
+        pending, self._pending = self._pending, {}
+        self._conn.close()
+        self._start_process()
+        self.restarts += 1
+        for command, args in self._loads:
+            self._send(command, args)
+        return pending
+
+    def _fail(self, pending, what):
+        for p in pending.values():
+            p.set_error(EngineProcessError(
+                "Chatbot engine process {0} while working on "
+                "{1}".format(what, p.command)))
+
+    def _send(self, command, args):
+        """ Send a request to the child. Must be called with self._lock
+        held. Returns a PendingRequest.
+        """
+        request_id = next(self._ids)
+        pending = PendingRequest(command)
+        self._pending[request_id] = pending
+        try:
+            self._conn.send((request_id, command, args))
+        except (IOError, OSError, EOFError):
+            # the reader thread will notice and restart the child
+            pass
+        return pending
+
+    def submit(self, command, *args):
+        """ Send a request to the engine process and return a PendingRequest
+        without waiting for the answer. Commands are "reply",
+        "reply_stateless", "load_script_directory", "reload_script_directory",
+        "load_rules", "clear_rules", "cache_info", "set_user_limits",
+        "user_table_info", "user_info", "snapshot" and "restore".
+        """
+        if command not in _COMMANDS:
+            raise ValueError("Unknown engine command {0}".format(command))
+        with self._lock:
+            if self._process is None:
+                self._start_process()
+            elif not self._process.is_alive():
+                self._fail(self._restart(), "exited")
+            if command in ("clear_rules", "load_rules"):
+                self._loads = [(command, args)]
+                self.ready.clear()
+            elif command == "load_script_directory":
+                self._loads.append((command, args))
+                self.ready.clear()
+            elif command == "reload_script_directory":
+                # a restarted child loads the directory as it is by then
+                if ("load_script_directory", args) not in self._loads:
+                    self._loads.append(("load_script_directory", args))
+                self.ready.clear()
+            elif command == "restore":
+                self.ready.clear()
+            return self._send(command, args)
+
+    def wait_until_ready(self, timeout=None):
+        """ Wait until the engine process has loaded its scripts. Returns
+        True if it has, False if the timeout expired first.
+        """
+        return self.ready.wait(timeout)
+
+    def clear_rules(self):
+        return self.submit("clear_rules").result()
+
+    def load_script_directory(self, directory, ignore_errors=False):
+        return self.submit("load_script_directory", directory,
+                           ignore_errors).result()
+
+    def load_rules(self, directories, ignore_errors=False):
+        return self.submit("load_rules", directories, ignore_errors).result()
+
+    def reload_script_directory(self, directory, ignore_errors=False):
+        return self.submit("reload_script_directory", directory,
+                           ignore_errors).result()
+
+    def reply(self, user, user_dict, message):
+        return self.submit("reply", user, user_dict, message).result()
+
+    def reply_stateless(self, user, user_dict, message, state=None):
+        return self.submit("reply_stateless", user, user_dict, message,
+                           state).result()
+
+    def cache_info(self):
+        return self.submit("cache_info").result()
+
+    def set_user_limits(self, max_users=0, idle_timeout=0):
+        """ Change the user limits of the engine, and remember them in case
+        the engine process has to be restarted. """
+        self._engine_options.update(max_users=max_users,
+                                    idle_timeout=idle_timeout)
+        return self.submit("set_user_limits", max_users,
+                           idle_timeout).result()
+
+    def user_table_info(self):
+        return self.submit("user_table_info").result()
+
+    def snapshot(self, path):
+        return self.submit("snapshot", path).result()
+
+    def restore(self, path):
+        """ Restore the engine from a snapshot. If the engine process has
+        to be restarted later, it will load the restored script directories
+        from scratch. """
+        directories = self.submit("restore", path).result()
+        with self._lock:
+            self._loads = [("clear_rules", ())]
+            self._loads.extend([("load_script_directory", (directory, False))
+                                for directory in directories])
+        return directories
+
+    @property
+    def _users(self):
+        """ Like ChatbotEngine._users, but with only the info dictionaries
+        available. Used by the terminal chat console.
+        """
+        return dict([(user, RemoteUserInfo(info)) for user, info in
+                     self.submit("user_info").result().items()])
+
+
+# ----- code that runs in the child process
+
+
+class _LockedConnection(object):
+    """ Wrap the child's end of the pipe so that the main loop, the thread
+    loading rules and the log handler can all send through it. """
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, obj):
+        with self._lock:
+            self._conn.send(obj)
+
+    def recv(self):
+        return self._conn.recv()
+
+    def close(self):
+        self._conn.close()
+
+
+class _PipeLogHandler(logging.Handler):
+    """ Send log records from the engine through the pipe to the parent """
+    def __init__(self, conn):
+        logging.Handler.__init__(self)
+        self.conn = conn
+
+    def emit(self, record):
+        try:
+            self.conn.send((None, "log", (record.name, record.levelno,
+                                          record.getMessage())))
+        except Exception:
+            self.handleError(record)
+
+
+def _user_info(engine):
+    return dict([(user, userinfo.info)
+                 for user, userinfo in engine._users.items()])
+
+_COMMANDS = {
+    "reply": lambda engine, *args: engine.reply(*args),
+    "reply_stateless": lambda engine, *args: engine.reply_stateless(*args),
+    "load_script_directory":
+        lambda engine, *args: engine.load_script_directory(*args),
+    "reload_script_directory":
+        lambda engine, *args: engine.reload_script_directory(*args),
+    "load_rules": lambda engine, *args: engine.load_rules(*args),
+    "clear_rules": lambda engine: engine.clear_rules(),
+    "cache_info": lambda engine: engine.cache_info(),
+    "set_user_limits":
+        lambda engine, *args: engine.set_user_limits(*args),
+    "user_table_info": lambda engine: engine.user_table_info(),
+    "snapshot": lambda engine, *args: engine.snapshot(*args),
+    "restore": lambda engine, *args: engine.restore(*args),
+    "user_info": _user_info,
+}
+
+
+def _serve(conn, depth, engine_options):
+    """ Main loop of the engine process. Handle requests from the parent
+    until told to stop or until the parent goes away.
+    """
+    conn = _LockedConnection(conn)
+    engine_log = logging.getLogger("chatbot_reply")
+    for handler in engine_log.handlers[:]:
+        engine_log.removeHandler(handler)
+    engine_log.addHandler(_PipeLogHandler(conn))
+
+    engine = ChatbotEngine(depth, **engine_options)
+    while True:
+        try:
+            request_id, command, args = conn.recv()
+        except (EOFError, IOError, OSError, KeyboardInterrupt):
+            break
+        if command == "stop":
+            break
+        if command == "load_rules" and engine.rules_db.directories:
+            loader = threading.Thread(target=_run_command,
+                                      name="Chatbot Rules Loader",
+                                      args=(conn, engine, request_id,
+                                            command, args))
+            loader.daemon = True
+            loader.start()
+        else:
+            _run_command(conn, engine, request_id, command, args)
+    engine.close()
+    conn.close()
+
+
+def _run_command(conn, engine, request_id, command, args):
+    """ Carry out a request from the parent, and send it the answer. """
+    try:
+        result = _COMMANDS[command](engine, *args)
+    except Exception as e:
+        logging.getLogger("chatbot_reply").debug("Error in engine process",
+                                                 exc_info=True)
+        _send_answer(conn, request_id, "error", e)
+    else:
+        _send_answer(conn, request_id, "result", result)
+        if command in ("load_script_directory", "reload_script_directory",
+                       "load_rules", "restore"):
+            conn.send((None, "ready", None))
+
+
+def _send_answer(conn, request_id, kind, value):
+    """ Send an answer to the parent. If it can't be pickled (an exception
+    from a rule method, perhaps), send a description of it instead.
+    """
+    try:
+        conn.send((request_id, kind, value))
+    except Exception as e:
+        conn.send((request_id, "error",
+                   EngineProcessError("Could not return {0!r} from the "
+                                      "chatbot engine process: {1}".format(
+                                          value, e))))
@@ -10,10 +10,16 @@ from __future__ import unicode_literals
 
 from distutils.version import StrictVersion
 import logging
+import os
+import threading
+import time
 import traceback
 import indigo
 
-from chatbot_reply import ChatbotEngine, NoRulesFoundError
+from chatbot_reply import ChatbotEngine, NoRulesFoundError, SQLiteUserStore
+from chatbot_reply import Normalizer
+from engine_host import EngineHost
+from script_watcher import ScriptWatcher
 from termapp_server import start_interaction_thread, start_shell_thread
 
 _VERSION = "0.3.0"
@@ -39,29 +45,147 @@ class Plugin(indigo.PluginBase):
             log.debug("Updating config version to " + version)
             prefs["configVersion"] = version
         self.device_info = {}
+        self.bot = None
+        self.loader = None
+        self.watcher = None
+        self.engine_status = "Not Loaded"
 
     def startup(self):
         log.debug("Startup called")
-        self.bot = ChatbotEngine()
+        self.start_engine(self.pluginPrefs.get("useEngineProcess", False),
+                          self.pluginPrefs.get("rememberUsers", False),
+                          self.normalizer(self.pluginPrefs))
 
         scripts_directory = self.pluginPrefs.get("scriptsPath", "")
+        self.watch_scripts(self.pluginPrefs)
         if scripts_directory:
-            self.load_scripts(scripts_directory)
+            if self.restore_snapshot(scripts_directory):
+                self.set_engine_status("Ready")
+            else:
+                self.load_scripts_in_background(scripts_directory)
         else:
             log.debug("Chatbot plugin is not configured.")
 
     def shutdown(self):
         log.debug("Shutdown called")
-        pass
+        self.save_snapshot()
+        self.stop_engine()
+
+    def start_engine(self, use_process, remember_users=False,
+                     normalizer=None):
+        """ Replace the chatbot engine with a new one with no scripts loaded.
+        If use_process is True, run the engine in a child process so that
+        replies and script reloads don't hold up Indigo's callback thread.
+        If remember_users is True, give the engine a database to keep its
+        users in, so conversations survive restarting the plugin.
+        normalizer is passed on to the engine (see normalizer).
+        """
+        self.stop_engine()
+        user_store = None
+        if remember_users:
+            user_store = SQLiteUserStore(self.user_database_path())
+        if use_process:
+            self.bot = EngineHost(user_store=user_store,
+                                  normalizer=normalizer)
+            self.bot.start()
+        else:
+            self.bot = ChatbotEngine(user_store=user_store,
+                                     normalizer=normalizer)
+        self.bot.set_user_limits(*self.user_limits(self.pluginPrefs))
+
+    def data_file_path(self, extension):
+        """ Return the filename of a file kept with the plugin's
+        preferences. """
+        return os.path.join(indigo.server.getInstallFolderPath(),
+                            "Preferences", "Plugins",
+                            self.pluginId + extension)
+
+    def user_database_path(self):
+        """ Return the filename of the database of users. """
+        return self.data_file_path(".users.sqlite")
+
+    def snapshot_path(self):
+        """ Return the filename of the snapshot of the engine's state. """
+        return self.data_file_path(".snapshot")
+
+    def save_snapshot(self):
+        """ Save the state of the chatbot engine, so that the next startup
+        doesn't have to set up the scripts and users again. """
+        if self.bot is None or not self.pluginPrefs.get("scriptsPath", ""):
+            return
+        try:
+            self.bot.snapshot(self.snapshot_path())
+        except Exception:
+            log.error("Unable to save the state of the chatbot engine",
+                      exc_info=True)
+
+    def restore_snapshot(self, scripts_directory):
+        """ If there is a snapshot saved by the last shutdown, restore the
+        chatbot engine from it. Return True if that worked and the snapshot
+        was of scripts_directory. The snapshot is removed afterwards,
+        so that a stale one won't be used after a crash.
+        """
+        path = self.snapshot_path()
+        if not os.path.exists(path):
+            return False
+        directories = None
+        try:
+            directories = self.bot.restore(path)
+        except Exception:
+            log.error("Unable to restore the state of the chatbot engine, "
+                      "loading the scripts again", exc_info=True)
+        try:
+            os.remove(path)
+        except OSError:
+            log.error("", exc_info=True)
+        return directories == [scripts_directory]
+
+    def normalizer(self, prefs):
+        """ Return a Normalizer for the word stemming and accent folding
+        chosen in the plugin preferences, or None if neither is. """
+        stem = prefs.get("stemWords", False)
+        fold_accents = prefs.get("foldAccents", False)
+        if not (stem or fold_accents):
+            return None
+        return Normalizer(fold_accents=fold_accents, stem=stem)
+
+    def user_limits(self, prefs):
+        """ Return the maximum number of users and the idle timeout in
+        seconds from the plugin preferences. Zero means no limit. """
+        return (int(prefs.get("maxUsers", "0") or 0),
+                int(prefs.get("userIdleTimeout", "0") or 0) * 60)
+
+    def stop_engine(self):
+        """ If the chatbot engine is running in a child process, stop it.
+        Otherwise close its user database, if it has one. """
+        if isinstance(self.bot, EngineHost):
+            self.bot.stop()
+        elif self.bot is not None:
+            self.bot.close()
+
+    def watch_scripts(self, prefs):
+        """ Start watching the scripts directory for changes, unless the
+        preferences say not to. """
+        scripts_directory = prefs.get("scriptsPath", "")
+        if not scripts_directory or not prefs.get("watchScripts", True):
+            self.watcher = None
+        elif (self.watcher is None or
+              self.watcher.directory != scripts_directory):
+            self.watcher = ScriptWatcher(scripts_directory)
 
     def update(self):
-        pass
+        """ If the script files have changed, and then been left alone for
+        a couple of seconds, reload the ones which changed. """
+        watcher = self.watcher
+        if watcher is not None and watcher.poll():
+            self.wait_until_loaded()
+            self.load_scripts(watcher.directory, reload=True)
 
     def runConcurrentThread(self):
         try:
             while True:
                 self.update()
-                self.sleep(3600)  # seconds
+                self.sleep(1)  # seconds
         except self.StopThread:
             pass
 
@@ -74,6 +198,7 @@ class Plugin(indigo.PluginBase):
                               prefix="Engine")
         self.configure_logger(logging.getLogger("termapp_server"),
                               prefix="Console")
+        self.configure_logger(logging.getLogger("engine_host"))
         self.set_chatbot_logging()
 
     def configure_logger(self, logger, level=logging.DEBUG, prefix="",
@@ -132,24 +257,77 @@ class Plugin(indigo.PluginBase):
         self.debug_engine = values.get("showEngineDebugInfo", False)
         self.set_chatbot_logging()
 
+        for key in ["maxUsers", "userIdleTimeout"]:
+            try:
+                if int(values.get(key, "0") or 0) < 0:
+                    raise ValueError
+            except ValueError:
+                errors[key] = "Please enter a whole number, or 0 for no limit."
         scripts_directory = values.get("scriptsPath", "")
         if not scripts_directory:
             errors["scriptsPath"] = "Directory of script files is required."
-        elif scripts_directory != self.pluginPrefs.get("scriptsPath", ""):
+        if errors:
+            return (False, values, errors)
+
+        use_process = values.get("useEngineProcess", False)
+        remember_users = values.get("rememberUsers", False)
+        normalizer = self.normalizer(values)
+        engine_changed = (
+            use_process != isinstance(self.bot, EngineHost) or
+            remember_users != self.pluginPrefs.get("rememberUsers", False) or
+            normalizer != self.normalizer(self.pluginPrefs))
+        if engine_changed:
+            self.start_engine(use_process, remember_users, normalizer)
+        self.bot.set_user_limits(*self.user_limits(values))
+
+        if (engine_changed or
+                scripts_directory != self.pluginPrefs.get("scriptsPath", "")):
             self.load_scripts(scripts_directory, errors, "scriptsPath")
         if errors:
             return (False, values, errors)
         else:
+            self.watch_scripts(values)
             return(True, values)
 
-    def load_scripts(self, scripts_directory, errors=None, key=None):
+    def load_scripts_in_background(self, scripts_directory):
+        """ Load scripts in a thread of their own, so that startup doesn't
+        wait for them to be compiled. Replies wait for them (see
+        wait_until_loaded). """
+        self.loader = threading.Thread(target=self.load_scripts,
+                                       name="Chatbot Script Loader",
+                                       args=(scripts_directory,))
+        self.loader.daemon = True
+        self.loader.start()
+
+    def wait_until_loaded(self, timeout=None):
+        """ Wait for scripts being loaded by load_scripts_in_background.
+        """
+        loader = self.loader
+        if loader is not None:
+            loader.join(timeout)
+
+    def load_scripts(self, scripts_directory, errors=None, key=None,
+                     reload=False):
         """ Call the chatbot engine to load scripts, catch all exceptions
         and send them to the error log or error dictionary if provided.
+        If reload is True, only reload the script files which have changed
+        since they were loaded. Otherwise the engine goes on replying with
+        the scripts it has until the new ones are ready, and keeps them if
+        the new ones can't be loaded.
         """
         message = ""
+        self.set_engine_status("Loading")
+        start = time.time()
         try:
-            self.bot.clear_rules()
-            self.bot.load_script_directory(scripts_directory)
+            if reload:
+                changed = self.bot.reload_script_directory(scripts_directory)
+                log.debug("Reloaded {0} changed script files in "
+                          "{1:.0f} ms".format(len(changed),
+                                              (time.time() - start) * 1000))
+            else:
+                self.bot.load_rules([scripts_directory])
+                log.debug("Loaded script files in {0:.0f} ms".format(
+                    (time.time() - start) * 1000))
         except OSError as e:
             log.error("", exc_info=True)
             message = ("Unable to read script files from directory "
@@ -162,10 +340,19 @@ class Plugin(indigo.PluginBase):
 
         if message:
             log.error(message)
+        self.set_engine_status("Error" if message else "Ready")
         if errors is not None:
             if message:
                 errors[key] = message
 
+    def set_engine_status(self, status):
+        """ Show whether scripts are loading, ready, or failed to load in
+        the engineStatus state of all the Chatbot devices. """
+        self.engine_status = status
+        for device_id in list(self.device_info):
+            indigo.devices[device_id].updateStateOnServer("engineStatus",
+                                                          status)
+
     # ----- Action Configuration UI ----- #
 
     def validateActionConfigUi(self, values, type_id, device_id):
@@ -229,12 +416,31 @@ class Plugin(indigo.PluginBase):
         """ Called by the Indigo UI for the Reload Script Files menu item. """
         scripts_directory = self.pluginPrefs.get("scriptsPath", "")
         if scripts_directory:
-            self.load_scripts(scripts_directory)
+            self.load_scripts(scripts_directory, reload=True)
         else:
             log.error("Can't load script files because the scripts "
                       "directory has not been set. See the Chatbot "
                       "Configure dialog.")
 
+    def logCacheStatistics(self):
+        """ Called by the Indigo UI for the Log Chatbot Engine Cache
+        Statistics menu item.
+        """
+        for name, info in sorted(self.bot.cache_info().items()):
+            lookups = info.hits + info.misses
+            rate = 100.0 * info.hits / lookups if lookups else 0.0
+            indigo.server.log("{0} cache: {1} of {2} entries used, "
+                              "{3} hits, {4} misses, {5:.1f}% hit "
+                              "rate".format(name.capitalize(), info.currsize,
+                                            info.maxsize, info.hits,
+                                            info.misses, rate))
+        info = self.bot.user_table_info()
+        indigo.server.log("Users: {0} kept, limit {1}, {2} evicted, "
+                          "{3} expired, {4} restored".format(
+                              info.resident, info.max_users or "none",
+                              info.evictions, info.expirations,
+                              info.restores))
+
     def startInteractiveInterpreter(self):
         """ Called by the Indigo UI for the Start Interactive Interpreter
         menu item.
@@ -267,6 +473,7 @@ class Plugin(indigo.PluginBase):
         log.debug("Starting device {0}".format(device.id))
         self.device_info[device.id] = []
         self.clear_device_state(device)
+        device.updateStateOnServer("engineStatus", self.engine_status)
 
     def clear_device_state(self, device):
         device.updateStateOnServer("message", "")
@@ -346,6 +553,7 @@ class Plugin(indigo.PluginBase):
         try:
             log.debug("Processing message: '{0}' From user {1}".format(
                 message, sender_info["name"]))
+            self.wait_until_loaded()
             reply = self.bot.reply(sender_info["name"], sender_info, message)
             log.debug("Chatbot response: '{0}'".format(reply))
         except Exception:
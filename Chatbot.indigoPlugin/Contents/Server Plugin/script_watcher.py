@@ -0,0 +1,81 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Notice when the script files in a directory change.
+
+The plugin polls a ScriptWatcher from its concurrent thread. Since an
+editor saving a file, or a batch of files being copied in, can change the
+directory several times in quick succession, the watcher waits for the
+directory to stay the same for a little while before it reports a change,
+so that the scripts are reloaded once per burst of saves.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ScriptWatcher(object):
+    """ Watch the modification times and sizes of the .py files in a
+    directory. Looking at those is cheap enough to do every second, and
+    works on any platform.
+
+    Public instance methods:
+      poll: return True if the scripts should be reloaded
+
+    Public instance variables:
+      directory: the directory being watched
+      settle_time: number of seconds the directory must stay unchanged
+          before poll reports a change
+    """
+    def __init__(self, directory, settle_time=2.0, clock=time.time):
+        """ Start watching a directory. Changes made before this are not
+        reported, so create the watcher before loading the scripts. """
+        self.directory = directory
+        self.settle_time = settle_time
+        self._clock = clock
+        self._loaded = self._latest = self._scan()
+        self._changed_at = clock()
+
+    def _scan(self):
+        """ Return a dictionary of the .py files in the directory and their
+        modification times and sizes. If the directory can't be read,
+        return an empty one. """
+        files = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return files
+        for name in names:
+            if not name.lower().endswith(".py"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:  # deleted since listdir
+                continue
+            files[name] = (st.st_mtime, st.st_size)
+        return files
+
+    def poll(self):
+        """ Look at the directory, and return True if its script files have
+        changed since poll last returned True, or since the watcher was
+        created, and haven't changed again for settle_time seconds.
+        """
+        files = self._scan()
+        now = self._clock()
+        if files != self._latest:
+            log.debug("Script files in {0} have changed".format(
+                self.directory))
+            self._latest = files
+            self._changed_at = now
+        if (self._latest != self._loaded and
+                now - self._changed_at >= self.settle_time):
+            self._loaded = self._latest
+            return True
+        return False
@@ -0,0 +1,90 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Measure the time taken to normalize messages: splitting them into
+words, making them lower case and removing punctuation, with and without
+a substitutions table or a Normalizer, for short commands and long pasted
+paragraphs.
+
+    python benchmarks/normalize.py
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "Chatbot.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+from chatbot_reply import split_on_whitespace, kill_non_alphanumerics
+from chatbot_reply import Normalizer
+from chatbot_reply.reply import Target
+from chatbot_reply.substitutions import SubstitutionTable
+
+COMMANDS = ["valve status", "open it", "Close the main valve!",
+            "What's the status of the drain valve?", "sensor wet :("]
+
+PARAGRAPH = (
+    "I'm writing because the shutoff valve in the basement didn't close "
+    "last night, even though the leak sensor said it was wet. Can't you "
+    "check the log? I've looked at the schedule (it's the one called "
+    "\"Nightly -- Basement\") and everything seems fine; the valve opens "
+    "at 6:00 AM and closes at 11:30 PM, every day. Don't worry about the "
+    "garden valves, they're working as they should. ") * 4
+
+CONTRACTIONS = {"don't": "do not", "can't": "can not", "won't": "will not",
+                "you're": "you are", "i'm": "i am", "i've": "i have",
+                "didn't": "did not", "it's": "it is", "they're": "they are"}
+
+
+def report(name, func, count, messages):
+    """ Print the time func takes per message, when it normalizes
+    messages messages each time it is called. """
+    seconds = min(timeit.repeat(func, number=count, repeat=5))
+    print("{0}: {1:.1f} us per message".format(
+        name, seconds / (count * messages) * 1e6))
+
+
+def main():
+    table = SubstitutionTable([("contractions", CONTRACTIONS)])
+    substitutions = [("substitutions", table.substitute)]
+    normalizer = Normalizer(fold_accents=True, stem=True,
+                            synonyms={"lamp": "light"})
+    for name, messages, count in [("commands", COMMANDS, 20000),
+                                  ("paragraph", [PARAGRAPH], 500)]:
+        print("{0}, {1} words per message:".format(
+            name, sum([len(m.split()) for m in messages]) // len(messages)))
+
+        def helpers():
+            for message in messages:
+                [kill_non_alphanumerics(word.lower())
+                 for word in split_on_whitespace(message)]
+
+        def target():
+            for message in messages:
+                Target(message)
+
+        def target_with_table():
+            for message in messages:
+                Target(message, substitutions)
+
+        def target_with_normalizer():
+            for message in messages:
+                Target(message, normalizer=normalizer)
+
+        number = count // len(messages)
+        report("  split_on_whitespace + kill_non_alphanumerics", helpers,
+               number, len(messages))
+        report("  Target", target, number, len(messages))
+        report("  Target with substitutions table", target_with_table,
+               number, len(messages))
+        report("  Target with stemming and accent folding",
+               target_with_normalizer, number, len(messages))
+
+
+if __name__ == "__main__":
+    main()
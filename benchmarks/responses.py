@@ -0,0 +1,60 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Measure the time taken to choose a reply: from a weighted list passed
+to Script.choose and from a weighted ResponseTable, and the least used
+reply by counting uses as the Eliza example script used to, and from a
+ResponseTable which rotates, for short and long lists of replies.
+
+    python benchmarks/responses.py
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import random
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "Chatbot.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+from chatbot_reply import ResponseTable, Script, UserInfo
+
+
+def report(name, func, count):
+    """ Print the time func takes per call. """
+    seconds = min(timeit.repeat(func, number=count, repeat=5))
+    print("{0}: {1:.2f} us per reply".format(name, seconds / count * 1e6))
+
+
+def main():
+    script = Script()
+    script.userinfo = UserInfo({})
+    for size in [4, 50]:
+        print("{0} replies:".format(size))
+        replies = ["Reply number {0}.".format(i) for i in range(size)]
+        weighted = [(reply, random.randint(1, 20)) for reply in replies]
+        weighted_table = ResponseTable(weighted)
+        rotating_table = ResponseTable(replies, rotate=True)
+        uses = {}
+
+        def least_used():
+            counts = [(reply, uses.get(reply, 0)) for reply in replies]
+            fewest = min([count for reply, count in counts])
+            reply = random.choice([reply for reply, count in counts
+                                   if count == fewest])
+            uses[reply] = fewest + 1
+
+        report("  weighted list", lambda: script.choose(weighted), 100000)
+        report("  weighted ResponseTable",
+               lambda: script.choose(weighted_table), 100000)
+        report("  least used by counting", least_used, 100000)
+        report("  rotating ResponseTable",
+               lambda: script.choose(rotating_table), 100000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Compare the time from starting an engine to its first reply, when
+loading scripts from scratch and when restoring a snapshot.
+
+    python benchmarks/restart_time.py [script directory] [number of users]
+
+The script directory defaults to test/test_scripts, and the number of
+users to 1000. Each user has sent a few messages before the snapshot is
+taken. A cold load forgets the users, while a restore brings them back,
+so the restore time grows with the number of users.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "Chatbot.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+from chatbot_reply import ChatbotEngine
+
+MESSAGES = ["hello", "how are you", "sensor wet", "open it"]
+
+
+def main():
+    directory = (sys.argv[1] if len(sys.argv) > 1 else
+                 os.path.join(HERE, "..", "test", "test_scripts"))
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "snapshot")
+    try:
+        engine = ChatbotEngine()
+        engine.load_script_directory(directory)
+        for user in range(users):
+            for message in MESSAGES:
+                engine.reply(user, {}, message)
+        engine.snapshot(path)
+        print("Snapshot of {0} users: {1} bytes".format(
+            users, os.path.getsize(path)))
+
+        def cold():
+            engine = ChatbotEngine()
+            engine.load_script_directory(directory)
+            engine.reply(0, {}, "hello")
+
+        def warm():
+            engine = ChatbotEngine()
+            engine.restore(path)
+            engine.reply(0, {}, "hello")
+
+        for name, func in [("Cold load", cold), ("Restore", warm)]:
+            seconds = min(timeit.repeat(func, number=1, repeat=5))
+            print("{0}: {1:.1f} ms to the first reply".format(
+                name, seconds * 1000))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Measure the resident memory used by a large number of rules.
+
+    python benchmarks/rules_memory.py [number of rules]
+
+The number of rules defaults to 100000. Resident size is read from
+/proc/self/statm, so this only works on Linux.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import os
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "Chatbot.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+from chatbot_reply.rules import Rule
+
+PATTERNS = ["what is the _* of thing{0}",
+            "[please] open the (valve|door) number {0} [now]",
+            "_@ likes _*~3 and word{0}",
+            "tell me about %a:thing and item{0}",
+            "is my name _@ [_@] or item{0}"]
+PREVIOUS = ["", "", "", "* item{0} *", ""]
+ALTERNATES = {"a": {"thing": "(car|boat|bicycle)"}}
+
+
+def resident_size():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def method():
+    return ""
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    gc.collect()
+    before = resident_size()
+    start = time.time()
+    rules = [Rule(PATTERNS[i % len(PATTERNS)].format(i),
+                  PREVIOUS[i % len(PREVIOUS)].format(i), 1, ALTERNATES,
+                  method, "bench.Bench.rule_{0}".format(i))
+             for i in range(count)]
+    elapsed = time.time() - start
+    gc.collect()
+    size = resident_size() - before
+    print("{0} rules in {1:.1f} s, resident size {2:.1f} MB, "
+          "{3:.0f} bytes per rule".format(len(rules), elapsed,
+                                          size / 1048576.0,
+                                          size / float(count)))
+
+
+if __name__ == "__main__":
+    main()
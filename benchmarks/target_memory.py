@@ -0,0 +1,83 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Measure the memory used by Targets, and the memory kept by the engine
+for each reply it makes. Needs tracemalloc, so run it with Python 3:
+
+    python3 benchmarks/target_memory.py [script directory]
+
+The script directory defaults to test/test_scripts.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import os
+import sys
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "Chatbot.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+from chatbot_reply import ChatbotEngine
+from chatbot_reply.reply import Target
+
+MESSAGES = ["Open the shutoff valve, please!",
+            "What is the status of the drain valve?",
+            "I'm tired of the leak sensor being wet all the time.",
+            "valve status",
+            "close it",
+            "Hello there, how are you doing today?"]
+
+
+def measure(make, count):
+    """ Call make(i) count times, keeping the results, and return the
+    number of memory blocks and bytes still allocated per call. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [make(i) for i in range(count)]
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    del kept
+    return blocks / float(count), size / float(count)
+
+
+def main():
+    directory = (sys.argv[1] if len(sys.argv) > 1 else
+                 os.path.join(HERE, "..", "test", "test_scripts"))
+    count = 10000
+
+    def make_target(i):
+        return Target("{0} {1}".format(MESSAGES[i % len(MESSAGES)], i))
+
+    blocks, size = measure(make_target, count)
+    print("Target: {0:.1f} blocks, {1:.0f} bytes".format(blocks, size))
+
+    # Set up enough users that no history fills up, so that everything
+    # each reply adds to a user's history is still there at the end.
+    engine = ChatbotEngine()
+    engine.load_script_directory(directory)
+    users = count // 8
+    for user in range(users):
+        engine.reply(user, {}, "hello")
+
+    def make_reply(i):
+        message = "{0} {1}".format(MESSAGES[i % len(MESSAGES)], i)
+        reply = engine.reply(i % users, {}, message)
+        engine._users[i % users].repl_history[0].target
+        return reply
+
+    blocks, size = measure(make_reply, count)
+    print("Reply kept in history: {0:.1f} blocks, {1:.0f} bytes".format(
+        blocks, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright (c) 2016 Gemini Lasswell
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+""" Measure the cost of keeping users' state outside the engine: the size
+of the state and the time to encode and decode it, compared with the
+memory used by a UserInfo and the time of a reply.
+
+    python benchmarks/user_state.py [script directory]
+
+The script directory defaults to test/test_scripts. The UserInfo memory
+is measured with tracemalloc, so it is only shown with Python 3.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import os
+import sys
+import timeit
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "Chatbot.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+from chatbot_reply import ChatbotEngine
+from chatbot_reply.reply import encode_user_state, decode_user_state
+
+MESSAGES = ["hello", "valve status", "sensor wet", "open it", "sensor dry",
+            "open", "why", "count", "how are you",
+            "what is the status of the drain valve"]
+
+
+def main():
+    directory = (sys.argv[1] if len(sys.argv) > 1 else
+                 os.path.join(HERE, "..", "test", "test_scripts"))
+    users = 1000
+    engine = ChatbotEngine()
+    engine.load_script_directory(directory)
+
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+    for user in range(users):
+        for message in MESSAGES:
+            engine.reply(user, {"name": "user"}, message)
+    if tracemalloc is not None:
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("UserInfo in memory: {0:.0f} bytes".format(size / users))
+
+    userinfo = engine._users[0]
+    state = encode_user_state(userinfo, engine._state_key)
+    print("Encoded state: {0} bytes".format(len(state)))
+
+    count = 10000
+    encode = timeit.timeit(
+        lambda: encode_user_state(userinfo, engine._state_key), number=count)
+    decode = timeit.timeit(
+        lambda: decode_user_state(state, engine._state_key, {},
+                                  engine._reply_target),
+        number=count)
+    print("Encode: {0:.1f} us, decode: {1:.1f} us".format(
+        encode / count * 1e6, decode / count * 1e6))
+
+    states = [encode_user_state(engine._users[user], engine._state_key)
+              for user in range(users)]
+    engine._users = type(engine._users)()
+
+    def stateful():
+        for user in range(users):
+            engine.reply(user, {"name": "user"}, "valve status")
+
+    def stateless():
+        for user in range(users):
+            engine.reply_stateless(user, {"name": "user"}, "valve status",
+                                   states[user])
+
+    stateful()  # set the users up again
+    for name, func in [("reply", stateful),
+                       ("reply_stateless", stateless)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=5))
+        print("{0}: {1:.1f} us per message".format(
+            name, seconds / users * 1e6))
+
+
+if __name__ == "__main__":
+    main()
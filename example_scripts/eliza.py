@@ -2,9 +2,36 @@
 #Any copyright is dedicated to the Public Domain.
 #http://creativecommons.org/publicdomain/zero/1.0/
 from __future__ import unicode_literals
-import random
 import string
-from chatbot_reply import rule, Script
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from chatbot_reply import rule, ResponseTable, Script
+
+formatter = string.Formatter()
+
+
+class Reflections(Mapping):
+    """A view of a match dictionary which adds a "refl_" version of each
+    key, with first and second person swapped. Only the values a reply
+    actually uses are looked up and reflected."""
+    def __init__(self, match, reflect):
+        self.match = match
+        self.reflect = reflect
+
+    def __getitem__(self, key):
+        if key.startswith("refl_"):
+            return self.reflect(self.match[key[len("refl_"):]])
+        return self.match[key]
+
+    def __iter__(self):
+        for key in self.match:
+            yield key
+            yield "refl_" + key
+
+    def __len__(self):
+        return 2 * len(self.match)
 
 class ElizaIntroScript(Script):
     @rule("[id like to|can i|may i] talk to Eliza")
@@ -26,6 +53,9 @@ class ElizaIntroScript(Script):
 
 class ElizaScript(Script):
     topic = "eliza"
+    substitutions = {"don't":"do not", "can't":"can not", "won't":"will not",
+                     "you're":"you are", "i'm" : "i am",
+                     "i've" : "i have", "you've" : "you have"}
 
     def setup(self):
         self.alternates = {
@@ -40,7 +70,6 @@ class ElizaScript(Script):
             "sad"      : "(unhappy|depressed|sick|sad)"}
 
     def setup_user(self, user):
-        self.uservars["Eliza replies"] = {}
         self.uservars["Eliza remembers"] = []
 
     def reflect(self, text):
@@ -53,47 +82,29 @@ class ElizaScript(Script):
         words = [swaps.get(w.lower(), w) for w in words]
         return " ".join(words)
 
+    tables = {}
+
     def choose(self, args):
-        """This version of choose maintains a dictionary of responses that 
-        have already been used, in self.uservars, and will select from the
-        least-used responses available. 
+        """This version of choose makes each list of responses into a
+        ResponseTable which rotates, the first time it sees it, so each
+        user hears all the responses in a list before any of them is
+        repeated.
         """
         if isinstance(args, list) and args and isinstance(args[0], unicode):
-            counted_args = [(string,
-                             self.uservars["Eliza replies"].get(string, 0))
-                            for string in args]
-            least_uses = min([c for s, c in counted_args])
-            reply = random.choice([s for s, c in counted_args
-                                   if c == least_uses])
-            self.uservars["Eliza replies"][reply] = least_uses + 1
-            return reply
-        else:
-            return super(ElizaScript, self).choose(args)
-
-    def substitute(self, text, wordlists):
-        contractions = {"don't":"do not", "can't":"can not", "won't":"will not",
-                        "you're":"you are", "i'm" : "i am",
-                        "i've" : "i have", "you've" : "you have"}
-        results = []
-        for wl in wordlists:
-            new = []
-            for word in wl:
-                stripped = word.lower().rstrip(string.punctuation)
-                new_word = contractions.get(stripped, word)
-                new.extend(new_word.split())
-            results.append(new)
-        return results
+            key = tuple(args)
+            table = self.tables.get(key)
+            if table is None:
+                table = self.tables[key] = ResponseTable(args, rotate=True)
+            args = table
+        return super(ElizaScript, self).choose(args)
 
     def process_reply(self, string):
         """This version of process_reply does Eliza style swapping of first and
-        second person, and creates a match dictionary containing swapped versions
-        of all the match variables that it then passes to str.format
+        second person, making swapped versions of the match variables
+        available to the format string with "refl_" added to their names.
         """
-        reflected_matches = {}
-        for k, v in self.match.items():
-            reflected_matches[k] = v
-            reflected_matches["refl_" + k] = self.reflect(v)
-        return string.format(*[], **reflected_matches)
+        return formatter.vformat(string, (),
+                                 Reflections(self.match, self.reflect))
 
     @rule("(bye|goodbye|done|exit|quit)")
     def rule_leave_eliza(self):
@@ -2,7 +2,7 @@
 #http://creativecommons.org/publicdomain/zero/1.0/
 from __future__ import unicode_literals
 import string
-from chatbot_reply import Script, rule
+from chatbot_reply import ResponseTable, Script, rule
 
 class TutorialScript(Script):
     def setup(self):
@@ -18,7 +18,7 @@ class TutorialScript(Script):
         return ["I don't understand that. <random help>",
                 "Let's change the subject. <random help>"]
 
-    @rule("hello robot")
+    @rule("hello robot", pure=True)
     def rule_hello_robot(self):
         return "Hello, carbon-based life form!"
         
@@ -34,11 +34,13 @@ class TutorialScript(Script):
         word = self.choose(["it's fun", "potato"])
         return "I like being random because {0}.".format(word)
 
+    greetings = ResponseTable([("Hello!", 20),
+                               ("Buenas dias!", 25),
+                               ("Buongiorno!", 1)])
+
     @rule("greetings")
     def rule_greetings(self):
-        return [("Hello!", 20),
-                ("Buenas dias!", 25),
-                ("Buongiorno!", 1)]
+        return self.greetings
 
     @rule("_* told me to say _*")
     def rule_star2_told_me_to_say_star(self):
@@ -49,7 +51,7 @@ class TutorialScript(Script):
     def rule_i_am_number1_years_old(self):
         return "{match0} isn't old at all!"
 
-    @rule("who is _*")
+    @rule("who is _*", pure=True)
     def rule_who_is_star(self):
         return "I don't know who {match0} is."
 
@@ -61,7 +63,7 @@ class TutorialScript(Script):
     def rule_i_am_star_years_old(self):
         return "Can you use a number instead?"
 
-    @rule("are you a (bot|robot|computer|machine)")
+    @rule("are you a (bot|robot|computer|machine)", pure=True)
     def rule_are_you_a_alt(self):
         return "Darn! You got me!"
 
@@ -80,15 +82,15 @@ class TutorialScript(Script):
     def rule_how_opt_you(self):
         return "I'm great, you?"
 
-    @rule("what is your (home|office|cell) [phone] number")
+    @rule("what is your (home|office|cell) [phone] number", pure=True)
     def rule_what_is_your_alt_opt_number(self):
         return "You can reach me at: 1 (800) 555-1234."
 
-    @rule("i have a [red|green|blue] car")
+    @rule("i have a [red|green|blue] car", pure=True)
     def rule_i_have_a_optalt_car(self):
         return "I bet you like your car a lot."
 
-    @rule("[*] the matrix [*]")
+    @rule("[*] the matrix [*]", pure=True)
     def rule_optstar_the_matrix_optstar(self):
         return "How do you know about the matrix?"
 
@@ -7,6 +7,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import sys, os
+import multiprocessing
+import shutil
+import sqlite3
+import string
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
@@ -21,6 +28,7 @@ sys.path.append(os.path.abspath('../Chatbot.indigoPlugin/Contents/Server Plugin'
 
 class PluginBaseForTest(object):
     def __init__(self, pid, name, version, prefs):
+        self.pluginId = pid
         self.pluginPrefs = prefs
 
 def substitute(self, string, validateOnly=False):
@@ -76,12 +84,24 @@ class PluginTestCase(IndigoMockTestCase):
         PluginBaseForTest.sleep = Mock()
         PluginBaseForTest.substitute = substitute
 
+        self.install_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.install_folder)
+        os.makedirs(os.path.join(self.install_folder,
+                                 "Preferences", "Plugins"))
+        self.indigo_mock.server.getInstallFolderPath.return_value = \
+            self.install_folder
+
+        self.plugins = []
         self.plugin = self.new_plugin()
         self.assertFalse(PluginBaseForTest.errorLog.called)
 
     def tearDown(self):
+        for plugin in self.plugins:
+            plugin.shutdown()
         IndigoMockTestCase.tearDown(self)
 
+    use_engine_process = False
+
     def new_plugin(self, path="./test_scripts"):
         # Before I created this little function,
         # python was giving me a bizillion "NoneType object has no
@@ -89,9 +109,12 @@ class PluginTestCase(IndigoMockTestCase):
         # removing the base class, before the plugin objects are deleted.
         # why this fixed it is a mystery to me
         props = {"showDebugInfo" : False,
-                 "scriptsPath": path}
+                 "scriptsPath": path,
+                 "useEngineProcess": self.use_engine_process}
         plugin = self.plugin_module.Plugin("", "", _VERSION, props)
         plugin.startup()
+        plugin.wait_until_loaded()
+        self.plugins.append(plugin)
         return plugin
 
     def test_Startup_LogsError_OnNonexistantLoadPath(self):
@@ -108,6 +131,7 @@ class PluginTestCase(IndigoMockTestCase):
 
     def test_Startup_Succeeds(self):
         self.plugin.startup()
+        self.plugin.wait_until_loaded()
         self.assertFalse(PluginBaseForTest.errorLog.called)
 
     def test_Shutdown_Succeeds(self):
@@ -118,6 +142,44 @@ class PluginTestCase(IndigoMockTestCase):
         self.plugin.update()
         self.assertFalse(PluginBaseForTest.errorLog.called)
 
+    def test_Update_ReloadsScripts_WhenTheyChange(self):
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        values = {"scriptsPath": directory,
+                  "useEngineProcess": self.use_engine_process}
+        self.assertTrue(self.plugin.validatePrefsConfigUi(values)[0])
+        self.plugin.pluginPrefs = values
+        self.plugin.watcher.settle_time = 0
+
+        self.plugin.update()
+        self.assertEqual(self.plugin.bot.reply("test", {}, "are you new"), "")
+        with open(os.path.join(directory, "watched.py"), "w") as f:
+            f.write(NEW_SCRIPT)
+        self.plugin.update()
+        self.assertEqual(self.plugin.bot.reply("test", {}, "are you new"),
+                         "yes")
+        self.assertFalse(PluginBaseForTest.errorLog.called)
+
+    def test_ScriptWatcher_WaitsForSavesToStop(self):
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        clock = Mock(return_value=100.0)
+        watcher = self.plugin_module.ScriptWatcher(directory, 2.0, clock)
+        self.assertFalse(watcher.poll())
+
+        filename = os.path.join(directory, "watched.py")
+        for t in [100.0, 101.0]:
+            clock.return_value = t
+            with open(filename, "a") as f:
+                f.write(NEW_SCRIPT)
+            self.assertFalse(watcher.poll())
+        clock.return_value = 102.5
+        self.assertFalse(watcher.poll())
+        clock.return_value = 103.0
+        self.assertTrue(watcher.poll())
+        clock.return_value = 110.0
+        self.assertFalse(watcher.poll())
+
     def test_RunConcurrentThread_Exits_OnStopThread(self):
         self.plugin.StopThread = Exception
         self.plugin.sleep = Mock(side_effect = Exception("test"))
@@ -165,6 +227,62 @@ class PluginTestCase(IndigoMockTestCase):
         self.assertTrue(ok)
         self.assertFalse(PluginBaseForTest.errorLog.called)
 
+    def test_PreferencesUIValidation_SwitchesEngine(self):
+        use_process = not self.use_engine_process
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "useEngineProcess": use_process}
+        ok, d = self.plugin.validatePrefsConfigUi(values)
+        self.assertTrue(ok)
+        self.assertEqual(isinstance(self.plugin.bot,
+                                    self.plugin_module.EngineHost),
+                         use_process)
+        self.assertEqual(self.plugin.bot.reply("test", {}, "sensor wet"),
+                         "Now the leak sensor is wet.")
+        self.assertFalse(PluginBaseForTest.errorLog.called)
+
+    def test_PreferencesUIValidation_SetsNormalizer(self):
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "useEngineProcess": self.use_engine_process}
+        self.assertTrue(self.plugin.validatePrefsConfigUi(values)[0])
+        self.plugin.pluginPrefs = values
+        self.assertNotEqual(self.plugin.bot.reply("test", {}, "sensors wet"),
+                            "Now the leak sensor is wet.")
+        values = dict(values, stemWords=True)
+        ok, d = self.plugin.validatePrefsConfigUi(values)
+        self.assertTrue(ok)
+        self.assertEqual(self.plugin.bot.reply("test", {}, "sensors wet"),
+                         "Now the leak sensor is wet.")
+        self.assertFalse(PluginBaseForTest.errorLog.called)
+
+    def test_PreferencesUIValidation_SetsUserLimits(self):
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "maxUsers": "2", "userIdleTimeout": "10"}
+        ok, d = self.plugin.validatePrefsConfigUi(values)
+        self.assertTrue(ok)
+        info = self.plugin.bot.user_table_info()
+        self.assertEqual(info.max_users, 2)
+
+    def test_PreferencesUIValidation_ReturnsErrorDict_OnBadUserLimits(self):
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "maxUsers": "lots"}
+        tup = self.plugin.validatePrefsConfigUi(values)
+        self.asserts_for_UIValidation_Failure("maxUsers", tup)
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "userIdleTimeout": "-5"}
+        tup = self.plugin.validatePrefsConfigUi(values)
+        self.asserts_for_UIValidation_Failure("userIdleTimeout", tup)
+
+    def test_PreferencesUIValidation_KeepsEngine_OnErrors(self):
+        bot = self.plugin.bot
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "useEngineProcess": not self.use_engine_process,
+                  "maxUsers": "lots"}
+        tup = self.plugin.validatePrefsConfigUi(values)
+        self.asserts_for_UIValidation_Failure("maxUsers", tup)
+        self.assertIs(self.plugin.bot, bot)
+        self.assertEqual(self.plugin.bot.reply("test", {}, "sensor wet"),
+                         "Now the leak sensor is wet.")
+
     def test_PreferencesUIValidation_ReturnsErrorDict_OnBadLoadPath(self):
         values = {"showDebugInfo" : False, "scriptsPath" : "doesnt_exist"}
         tup = self.plugin.validatePrefsConfigUi(values)
@@ -227,7 +345,8 @@ class PluginTestCase(IndigoMockTestCase):
                                                 {"deviceVersion":_VERSION})
         states = dev.states
         self.assertEqual(len(states),
-                         4 + len(self.plugin_module._SENDER_INFO_FIELDS))
+                         5 + len(self.plugin_module._SENDER_INFO_FIELDS))
+        self.assertEqual(states["engineStatus"], "Ready")
         self.assertEqual(states["message"], "")
         self.assertEqual(states["name"], "")
         self.assertEqual(states["status"], "Idle")
@@ -317,6 +436,737 @@ class PluginTestCase(IndigoMockTestCase):
         self.assertEqual(dev.states["status"], "Idle")
         self.assertFalse(PluginBaseForTest.errorLog.called)
 
+    def test_PureRuleReplies_AreReused(self):
+        bot = self.plugin.bot
+        for i in range(3):
+            self.assertEqual(bot.reply("test", {}, "What can you do?"),
+                             "I can tell you about the valves and the "
+                             "leak sensor.")
+        self.assertEqual(bot.cache_info()["replies"].hits, 2)
+        self.plugin.reloadScripts()
+        self.assertEqual(bot.cache_info()["replies"].currsize, 0)
+
+    def test_PureRuleReplies_UsingRawText_AreNotReused(self):
+        bot = sys.modules["chatbot_reply"].ChatbotEngine()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, "pure.py"), "w") as f:
+            f.write(PURE_SCRIPT)
+        bot.load_script_directory(directory)
+
+        for message, reply in [("hello Buddy", "hi Buddy"),
+                               ("hello BUDDY!", "hi BUDDY!"),
+                               ("bye Buddy", "bye buddy"),
+                               ("bye BUDDY!", "bye buddy")]:
+            self.assertEqual(bot.reply("test", {}, message), reply)
+        self.assertEqual(bot.cache_info()["replies"].hits, 1)
+
+    def test_SameMessage_ReusesTarget(self):
+        bot = self.plugin.bot
+        bot.reply("test", {}, "sensor wet")
+        bot.reply("test", {}, "sensor wet")
+        self.assertTrue(bot.cache_info()["targets"].hits > 0)
+
+    def local_bot(self):
+        """ Return the plugin's ChatbotEngine, for tests that look inside it,
+        or skip the test if the engine is in another process. """
+        if self.use_engine_process:
+            self.skipTest("chatbot engine is in another process")
+        return self.plugin.bot
+
+    def test_ReplyHistory_SharesTargets_OnlyWhenNeeded(self):
+        bot = self.local_bot()
+        for user in ["test1", "test2"]:
+            bot.reply(user, {}, "sensor wet")
+        entries = [bot._users[user].repl_history[0]
+                   for user in ["test1", "test2"]]
+        self.assertEqual(entries[0].raw_text, "Now the leak sensor is wet.")
+        self.assertTrue(entries[0]._target is None)
+
+        for user in ["test1", "test2"]:
+            bot.reply(user, {}, "open it")
+        self.assertTrue(entries[0]._target is not None)
+        self.assertTrue(entries[0].target is entries[1].target)
+
+    def test_PreviousPatterns_AreMatchedOncePerReply(self):
+        bot = self.local_bot()
+        bot.reply("test", {}, "sensor wet")
+        entry = bot._users["test"].repl_history[0]
+        bot.reply("test", {}, "open it")
+        previous_patterns = [r.previous for r in
+                             bot.rules_db.topics["all"].sortedrules
+                             if r.previous]
+        self.assertEqual(len(previous_patterns), 4)
+        self.assertEqual(len(entry._previous_matches), 3)
+
+    def test_PreviousRule_MatchesRuleNotReplyText(self):
+        bot = self.plugin.bot
+        self.assertEqual(bot.reply("test", {}, "open"),
+                         "What do you want me to open?")
+        self.assertEqual(bot.reply("test", {}, "why"),
+                         "Because you didn't say which valve.")
+        bot.reply("test", {}, "valve status")
+        self.assertEqual(bot.reply("test", {}, "open it"),
+                         "What do you want me to open?")
+        self.assertNotEqual(bot.reply("test", {}, "why"),
+                            "Because you didn't say which valve.")
+
+    def test_PreviousRule_IsOnlyTried_AfterItsRule(self):
+        bot = self.local_bot()
+        bot.rules_db.sort_rules()
+        topic = bot.rules_db.topics["all"]
+        self.assertEqual([r for r in topic.sortedrules if not r.previous_rule],
+                         topic.general_rules)
+        self.assertTrue(topic.followups)
+
+        rules = sys.modules["chatbot_reply.rules"]
+        bot = sys.modules["chatbot_reply"].ChatbotEngine()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, "typo.py"), "w") as f:
+            f.write(TYPO_SCRIPT)
+        with patch.object(rules, "log") as log:
+            bot.load_script_directory(directory)
+            bot.rules_db.sort_rules()
+        self.assertEqual(log.warning.call_count, 1)
+        self.assertIn("typo.TypoScript.rule_knock_knok",
+                      log.warning.call_args[0][0])
+        self.assertEqual(bot.reply("test", {}, "knock knock"), "who is there")
+        self.assertEqual(bot.reply("test", {}, "boo"), "boo who")
+
+    def test_ReplyHistory_RecordsRuleNames(self):
+        bot = self.local_bot()
+        bot.reply("test", {}, "open")
+        self.assertEqual(bot._users["test"].repl_history[0].rulenames,
+                         ("valves.ValveScript.rule_open_close_it",))
+
+    def test_RepeatedReferences_AreExpandedOnce(self):
+        bot = self.plugin.bot
+        self.assertEqual(bot.reply("test", {}, "count twice"), "1 and 1")
+        self.assertEqual(bot.reply("test", {}, "count"), "2")
+
+    def test_ReferenceCycle_RaisesRecursionTooDeep(self):
+        import chatbot_reply
+        with self.assertRaises(chatbot_reply.RecursionTooDeepError):
+            self.plugin.bot.reply("test", {}, "go around in circles")
+
+    def test_ReferenceCycle_IsDetectedImmediately(self):
+        bot = self.local_bot()
+        with patch.object(bot, "_reply_from_rule",
+                          wraps=bot._reply_from_rule) as reply_from_rule:
+            with self.assertRaises(Exception):
+                bot.reply("test", {}, "go around in circles")
+        self.assertEqual(reply_from_rule.call_count, 1)
+
+    def test_MatchDict_LooksUpRawTextOnlyWhenUsed(self):
+        bot = self.local_bot()
+        target_class = sys.modules["chatbot_reply.reply"].Target
+        with patch.object(target_class, "raw_text_between",
+                          autospec=True) as raw_text_between:
+            reply = bot.reply("test", {}, "Close the Shutoff Valve!")
+        self.assertTrue(reply.startswith("I'll tell the shutoff valve"))
+        self.assertFalse(raw_text_between.called)
+
+        inst = bot.rules_db.script_instances[0]
+        self.assertEqual(dict(inst.match),
+                         {"match0": "shutoff valve",
+                          "raw_match0": "Shutoff Valve!"})
+
+    def test_Target_ComputesWordOffsetsOnce(self):
+        bot = self.local_bot()
+        target = bot._target("all", "Close the  Shutoff Valve!")
+        self.assertEqual(target.raw_text_between(10, 23), "Shutoff Valve!")
+        self.assertIs(target.word_offsets, target.word_offsets)
+
+    def test_Target_KeepsWordListsCompatible(self):
+        self.local_bot()
+        target_class = sys.modules["chatbot_reply.reply"].Target
+        substitute = lambda text, words: [[], ["Be!"], ["c", ""]]
+        target = target_class("a  b c", [("substitute", substitute)])
+        self.assertEqual(target.raw_words, ("a", "b", "c"))
+        self.assertEqual(target.tokenized_words, ((), ("be",), ("c", "")))
+        self.assertEqual(target.normalized, "be c ")
+        self.assertEqual(target.raw_text_between(0, 4), "a b c")
+        self.assertEqual(target.raw_text_between(3, 4), "c")
+        with self.assertRaises(AttributeError):
+            target.normalized = "something else"
+
+    def test_NormalizeWords_MatchesKillNonAlphanumerics(self):
+        script = sys.modules["chatbot_reply.script"]
+        text = "  Don't STOP\tbelievin'!  :)  Caf\u00c9 nai_ve\x00x 42. "
+        words = script.split_on_whitespace(text)
+        self.assertEqual(words, text.split())
+        self.assertEqual(script.kill_non_alphanumerics("Don't-stop!"),
+                         "Dontstop")
+        for wordlist in [words, words[:-2], [], [""]]:
+            self.assertEqual(script.normalize_words(wordlist),
+                             [script.kill_non_alphanumerics(word.lower())
+                              for word in wordlist])
+
+    def test_Pattern_ReleasesParseTree_AndReparsesOnDemand(self):
+        self.local_bot()
+        pattern_class = sys.modules["chatbot_reply.patterns"].Pattern
+        pattern = pattern_class("open  the [main] _*", {})
+        self.assertIsNone(pattern._parse_tree)
+        self.assertEqual(pattern.parse_tree.format(), pattern.formatted_pattern)
+        self.assertEqual(pattern.regex({}), pattern.regexc.pattern)
+
+        pattern = pattern_class("hello %u:name", {})
+        self.assertIsNone(pattern.regexc)
+        self.assertIsNotNone(pattern._parse_tree)
+
+    def test_UserLimit_EvictsLeastRecentlyUsedUser(self):
+        bot = self.plugin.bot
+        bot.set_user_limits(2)
+        for user in ["test1", "test2", "test1", "test3"]:
+            bot.reply(user, {}, "sensor wet")
+        info = bot.user_table_info()
+        self.assertEqual((info.resident, info.evictions), (2, 1))
+        self.assertEqual(sorted(bot._users.keys()), ["test1", "test3"])
+
+    def test_IdleUsers_AreEvicted(self):
+        bot = self.local_bot()
+        now = [1000.0]
+        bot._users._clock = lambda: now[0]
+        bot.set_user_limits(idle_timeout=60)
+        bot.reply("test1", {}, "sensor wet")
+        now[0] += 30
+        bot.reply("test2", {}, "sensor wet")
+        now[0] += 45
+        bot.reply("test2", {}, "sensor wet")
+        self.assertEqual(bot._users.keys(), ["test2"])
+        self.assertEqual(bot.user_table_info().expirations, 1)
+
+    def test_EvictedUsers_AreSavedByScripts_AndRestored(self):
+        bot = self.local_bot()
+        bot._users.store = sys.modules["chatbot_reply"].MemoryUserStore()
+        bot.set_user_limits(1)
+        inst = bot.rules_db.script_instances[0]
+        with patch.object(inst, "evict_user") as evict_user:
+            bot.reply("test1", {}, "sensor wet")
+            userinfo = bot._users["test1"]
+            bot.reply("test2", {}, "hello")
+            evict_user.assert_called_once_with("test1")
+        self.assertNotIn("test1", bot._users)
+
+        with patch.object(inst, "setup_user") as setup_user:
+            bot.reply("test1", {}, "hello")
+            self.assertFalse(setup_user.called)
+        self.assertIs(bot._users["test1"], userinfo)
+        self.assertEqual(bot.user_table_info().restores, 1)
+
+    def test_EvictedUsers_OfSharedStore_AreNotPassedToScripts(self):
+        bot = self.local_bot()
+        store = sys.modules["chatbot_reply"].MemoryUserStore()
+        store.shared = store.persistent = True
+        store.update = store.save
+        bot._users.store = store
+        bot.set_user_limits(1)
+        inst = bot.rules_db.script_instances[0]
+        with patch.object(inst, "evict_user") as evict_user:
+            bot.reply("test1", {}, "sensor wet")
+            bot.reply("test2", {}, "hello")
+            self.assertFalse(evict_user.called)
+        self.assertNotIn("test1", bot._users)
+        self.assertIn("test1", store.keys())
+
+    def test_RememberUsers_SurvivesRestart(self):
+        values = {"showDebugInfo" : False, "scriptsPath":"./test_scripts",
+                  "useEngineProcess": self.use_engine_process,
+                  "rememberUsers": True}
+        ok, d = self.plugin.validatePrefsConfigUi(values)
+        self.assertTrue(ok)
+        self.plugin.pluginPrefs = values
+        self.assertEqual(self.plugin.bot.reply("test", {}, "count"), "1")
+        self.assertTrue(os.path.exists(self.plugin.user_database_path()))
+        self.plugin.bot.reply("test", {}, "open")
+
+        self.plugin.startup()
+        self.plugin.wait_until_loaded()
+        bot = self.plugin.bot
+        self.assertEqual(bot.user_table_info().resident, 0)
+        self.assertEqual(bot.reply("test", {}, "why"),
+                         "Because you didn't say which valve.")
+        self.assertEqual(bot.reply("test", {}, "count"), "2")
+        self.assertEqual(bot.user_table_info().restores, 1)
+        bot.reply("test", {}, "sensor wet")
+        bot.reply("test", {}, "open it")
+
+    def test_SQLiteUserStore_BatchesWrites(self):
+        path = os.path.join(self.install_folder, "users.sqlite")
+        userinfo_class = sys.modules["chatbot_reply"].UserInfo
+        store_class = sys.modules["chatbot_reply"].SQLiteUserStore
+        store = store_class(path, flush_interval=3600)
+        for user in ["test1", "test2"]:
+            userinfo = userinfo_class({"name": user})
+            store.update(user, userinfo)
+        store.delete("test2")
+        self.assertEqual(store.load("test1").info, {"name": "test1"})
+        self.assertIsNone(store.load("test2"))
+
+        def count_rows():
+            conn = sqlite3.connect(path)
+            try:
+                return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            finally:
+                conn.close()
+        self.assertEqual(count_rows(), 0)
+        store.flush()
+        self.assertEqual(count_rows(), 1)
+        store.close()
+
+        store = store_class(path)
+        self.assertEqual(store.keys(), ["test1"])
+        self.assertEqual(store.load("test1").info, {"name": "test1"})
+        store.close()
+
+    def test_SharedSQLiteUserStore_IsSafe_FromSeveralProcesses(self):
+        path = os.path.join(self.install_folder, "shared.sqlite")
+        processes = [multiprocessing.Process(target=count_in_new_engine,
+                                             args=(path, 10))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(30)
+            self.assertEqual(process.exitcode, 0)
+        store = sys.modules["chatbot_reply"].SharedSQLiteUserStore(path)
+        self.assertEqual(store.load("test").vars["count"], 40)
+        store.close()
+
+    def test_SharedSQLiteUserStores_InOneProcess_WaitForEachOther(self):
+        path = os.path.join(self.install_folder, "shared.sqlite")
+        errors = []
+
+        def count():
+            try:
+                count_in_new_engine(path, 10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        store = sys.modules["chatbot_reply"].SharedSQLiteUserStore(path)
+        self.assertEqual(store.load("test").vars["count"], 40)
+        store.close()
+        self.assertEqual(sys.modules["chatbot_reply.sqlite_store"]._lock_files,
+                         {})
+
+    def test_SharedSQLiteUserStore_RaisesConflictError(self):
+        path = os.path.join(self.install_folder, "shared.sqlite")
+        chatbot_reply = sys.modules["chatbot_reply"]
+        stores = [chatbot_reply.SharedSQLiteUserStore(path)
+                  for i in range(2)]
+        stores[0].update("test", chatbot_reply.UserInfo({}))
+        userinfos = [store.load("test") for store in stores]
+        stores[0].update("test", userinfos[0])
+        with self.assertRaises(chatbot_reply.UserStateConflictError):
+            stores[1].update("test", userinfos[1])
+        self.assertIsNotNone(stores[1].load("test"))
+        stores[1].update("test", userinfos[1])
+        for store in stores:
+            store.close()
+
+    def test_Snapshot_IsRestored_OnStartup(self):
+        self.assertEqual(self.plugin.bot.reply("test", {}, "count"), "1")
+        self.plugin.bot.reply("test", {}, "open")
+        self.plugin.shutdown()
+        self.assertTrue(os.path.exists(self.plugin.snapshot_path()))
+
+        plugin = self.new_plugin()
+        self.assertFalse(os.path.exists(plugin.snapshot_path()))
+        self.assertEqual(plugin.bot.reply("test", {}, "why"),
+                         "Because you didn't say which valve.")
+        self.assertEqual(plugin.bot.reply("test", {}, "count"), "2")
+        self.assertFalse(PluginBaseForTest.errorLog.called)
+
+    def test_ReplyStateless_ReturnsStateAndKeepsNoUser(self):
+        bot = self.plugin.bot
+        reply, state = bot.reply_stateless("test", {}, "count")
+        self.assertEqual(reply, "1")
+        reply, state = bot.reply_stateless("test", {}, "open", state)
+        reply, state = bot.reply_stateless("test", {}, "why", state)
+        self.assertEqual(reply, "Because you didn't say which valve.")
+        reply, state = bot.reply_stateless("test", {}, "count", state)
+        self.assertEqual(reply, "2")
+        reply, state = bot.reply_stateless("test", {}, "sensor wet", state)
+        self.assertEqual(bot.reply_stateless("test", {}, "open it", state)[0],
+                         "What do you want me to open?")
+        self.assertEqual(bot.user_table_info().resident, 0)
+
+    def test_ReplyStateless_RefusesTamperedState(self):
+        bot = self.plugin.bot
+        reply, state = bot.reply_stateless("test", {}, "count")
+        tampered = state[:-1] + (b"\x00" if state[-1:] != b"\x00"
+                                 else b"\x01")
+        self.assertRaises(ValueError, bot.reply_stateless,
+                          "test", {}, "count", tampered)
+        forged = sys.modules["chatbot_reply.reply"].encode_user_state(
+            sys.modules["chatbot_reply"].UserInfo({}), b"other key")
+        self.assertRaises(ValueError, bot.reply_stateless,
+                          "test", {}, "count", forged)
+        self.assertEqual(bot.reply_stateless("test", {}, "count", state)[0],
+                         "2")
+
+    def test_SetupUser_IsCalled_WhenUserFirstEntersTopic(self):
+        self.local_bot()
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        with open(os.path.join(directory, "topics.py"), "w") as f:
+            f.write(TOPICS_SCRIPT)
+        bot = sys.modules["chatbot_reply"].ChatbotEngine()
+        bot.load_script_directory(directory)
+
+        bot.reply("test", {}, "hello")
+        uservars = bot._users["test"].vars
+        self.assertEqual(uservars["eager"], 1)
+        self.assertNotIn("lazy", uservars)
+        self.assertIn("mainvalvestatus", uservars)
+
+        self.assertEqual(bot.reply("test", {}, "enter lazy topic"),
+                         "set up 1 times")
+        bot.reply("test", {}, "leave lazy topic")
+        self.assertEqual(bot.reply("test", {}, "enter lazy topic"),
+                         "set up 1 times")
+        self.assertEqual(uservars["eager"], 1)
+
+    def test_Snapshot_SkipsSetup_OnlyForUnchangedScripts(self):
+        self.local_bot()
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        engine_class = sys.modules["chatbot_reply"].ChatbotEngine
+        path = os.path.join(self.install_folder, "snapshot")
+
+        for changed in [False, True]:
+            bot = engine_class()
+            bot.load_script_directory(directory)
+            bot.reply("test", {}, "sensor wet")
+            inst = bot.rules_db.script_instances[0]
+            inst.alternates = dict(inst.alternates, extra="(x)")
+            bot.snapshot(path)
+            if changed:
+                with open(os.path.join(directory, "valves.py"), "a") as f:
+                    f.write("\n# changed\n")
+
+            bot = engine_class()
+            self.assertEqual(bot.restore(path), [directory])
+            inst = bot.rules_db.script_instances[0]
+            self.assertEqual("extra" in inst.alternates, not changed)
+            self.assertEqual(bot.reply("test", {}, "open it"),
+                             "What do you want me to open?")
+
+    def test_Snapshot_SetsUpScriptsAgain_WhenBaseClassChanges(self):
+        self.local_bot()
+        base_directory = os.path.join(self.install_folder, "base")
+        directory = os.path.join(self.install_folder, "scripts")
+        for name, script in [(base_directory, BASE_SCRIPT),
+                             (directory, DERIVED_SCRIPT)]:
+            os.mkdir(name)
+            filename = os.path.basename(name) + ".py"
+            with open(os.path.join(name, filename), "w") as f:
+                f.write(script)
+        engine_class = sys.modules["chatbot_reply"].ChatbotEngine
+        path = os.path.join(self.install_folder, "snapshot")
+
+        bot = engine_class()
+        bot.load_script_directory(base_directory)
+        bot.load_script_directory(directory)
+        bot.snapshot(path)
+        with open(os.path.join(base_directory, "base.py"), "w") as f:
+            f.write(BASE_SCRIPT.replace('"hello"', '"howdy"'))
+
+        bot = engine_class()
+        bot.restore(path)
+        self.assertEqual(bot.reply("test", {}, "hi"), "howdy")
+        self.assertEqual(bot.reply("test", {}, "derived"), "howdy")
+
+    def test_Reload_ImportsOnlyChangedFiles(self):
+        self.local_bot()
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        topics = os.path.join(directory, "topics.py")
+        with open(topics, "w") as f:
+            f.write(TOPICS_SCRIPT)
+        bot = sys.modules["chatbot_reply"].ChatbotEngine()
+        bot.load_script_directory(directory)
+        bot.reply("test", {}, "sensor wet")
+        valves = [i for i in bot.rules_db.script_instances
+                  if i.__module__.endswith("valves")]
+
+        self.assertEqual(bot.reload_script_directory(directory), [])
+        with open(topics, "w") as f:
+            f.write(TOPICS_SCRIPT.replace("<enter lazy topic>", "entered"))
+        # don't let Python 2 use the .pyc made less than a second ago
+        os.utime(topics, (time.time() + 10, time.time() + 10))
+        self.assertEqual(bot.reload_script_directory(directory), [topics])
+        self.assertEqual(bot.reply("test", {}, "enter lazy topic"),
+                         "entered")
+        self.assertEqual(bot.reply("test", {}, "leave lazy topic"), "bye")
+        for instance in valves:
+            self.assertIn(instance, bot.rules_db.script_instances)
+        self.assertEqual(len(bot.rules_db.script_instances), 4)
+        self.assertEqual(bot.reply("test", {}, "open it"),
+                         "What do you want me to open?")
+
+        os.remove(topics)
+        self.assertEqual(bot.reload_script_directory(directory), [])
+        self.assertEqual(len(bot.rules_db.script_instances), 1)
+        self.assertNotIn("lazy", bot.rules_db.topics)
+        self.assertEqual(bot.reply("test", {}, "leave lazy topic"), "")
+
+    def test_Reload_ImportsSubclasses_WhenBaseClassChanges(self):
+        self.local_bot()
+        base_directory = os.path.join(self.install_folder, "base")
+        directory = os.path.join(self.install_folder, "scripts")
+        for name, script in [(base_directory, BASE_SCRIPT),
+                             (directory, DERIVED_SCRIPT)]:
+            os.mkdir(name)
+            filename = os.path.basename(name) + ".py"
+            with open(os.path.join(name, filename), "w") as f:
+                f.write(script)
+        bot = sys.modules["chatbot_reply"].ChatbotEngine()
+        bot.load_script_directory(base_directory)
+        bot.load_script_directory(directory)
+        self.assertEqual(bot.reply("test", {}, "derived"), "hello")
+
+        base = os.path.join(base_directory, "base.py")
+        with open(base, "w") as f:
+            f.write(BASE_SCRIPT.replace('"hello"', '"howdy"'))
+        os.utime(base, (time.time() + 10, time.time() + 10))
+        self.assertEqual(bot.reload_script_directory(base_directory),
+                         [base, os.path.join(directory, "scripts.py")])
+        self.assertEqual(bot.reply("test", {}, "hi"), "howdy")
+        self.assertEqual(bot.reply("test", {}, "derived"), "howdy")
+
+    def test_LoadRules_KeepsOldRules_UntilNewOnesAreReady(self):
+        bot = self.local_bot()
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        with open(os.path.join(directory, "slow.py"), "w") as f:
+            f.write(SLOW_SCRIPT)
+        started, go = threading.Event(), threading.Event()
+        bot._botvars.update(started=started, go=go)
+
+        loader = Thread(target=bot.load_rules, args=([directory],))
+        loader.start()
+        self.assertTrue(started.wait(5))
+        reloader = Thread(target=bot.reload_script_directory,
+                          args=(bot.rules_db.directories[0][0],))
+        reloader.start()
+        self.assertEqual(bot.reply("test", {}, "sensor wet"),
+                         "Now the leak sensor is wet.")
+        self.assertEqual(bot.reply("test", {}, "are you new"), "")
+        self.assertNotIn("slow", bot._botvars)
+        reloader.join(0.2)
+        self.assertTrue(reloader.is_alive())
+        go.set()
+        loader.join(5)
+        reloader.join(5)
+        self.assertFalse(reloader.is_alive())
+        self.assertEqual(bot.reply("test", {}, "are you new"), "yes")
+        self.assertEqual(bot._botvars["slow"], "loaded")
+        for key in ["started", "go", "slow"]:
+            del bot._botvars[key]
+
+    def test_RuleMetadata_IsCollected_WhenClassIsCreated(self):
+        bot = self.local_bot()
+        script = sys.modules["chatbot_reply"].Script
+        rule = sys.modules["chatbot_reply"].rule
+
+        class Base(script):
+            topic = None
+
+            @rule("inherited")
+            def rule_inherited(self):
+                return "from base"
+
+        class Derived(Base):
+            topic = "all"
+
+            @rule("own", weight=2)
+            def rule_own(self):
+                return "own"
+
+            def substitute_nothing(self, text, wordlists):
+                return wordlists
+
+        self.assertEqual(Derived._rule_names, ("rule_inherited", "rule_own"))
+        self.assertEqual(Derived._substitution_names, ("substitute_nothing",))
+        self.assertEqual(Derived.rule_own.rule_spec.weight, 2)
+        rules, subs = bot.rules_db._load_script_methods(Derived())
+        self.assertEqual(sorted([r.rulename.split(".")[-1] for r in rules]),
+                         ["rule_inherited", "rule_own"])
+
+        class Undecorated(script):
+            def rule_undecorated(self):
+                return "oops"
+
+        with self.assertRaises(TypeError):
+            bot.rules_db._load_script_methods(Undecorated())
+
+    def test_SubstitutionTable_MatchesDictionaryLookupMethod(self):
+        substitutions = sys.modules["chatbot_reply.substitutions"]
+        table_class = substitutions.SubstitutionTable
+        contractions = {"don't": "do not", "can't": "can not",
+                        "i'm": "i am", "you're": "you are"}
+
+        def substitute(text, wordlists):  # as ElizaScript used to
+            results = []
+            for wl in wordlists:
+                new = []
+                for word in wl:
+                    stripped = word.lower().rstrip(string.punctuation)
+                    new.extend(contractions.get(stripped, word).split())
+                results.append(new)
+            return results
+
+        table = table_class([("test", contractions)])
+        for text in ["I'm sure you're right!", "DON'T. Can't? can't",
+                     "", "nothing to see", "i'm, i'm, i'm..."]:
+            tokens = substitutions.TokenBuffer(text.split())
+            tokens.apply(table.substitute(text, tokens))
+            self.assertEqual(tokens.wordlists(),
+                             substitute(text, [[word] for word in
+                                               text.split()]))
+
+    def test_SubstitutionsTables_AreMergedPerTopic(self):
+        bot = self.local_bot()
+        directory = os.path.join(self.install_folder, "scripts")
+        shutil.copytree("test_scripts", directory)
+        with open(os.path.join(directory, "tables.py"), "w") as f:
+            f.write(TABLES_SCRIPT)
+        bot.load_script_directory(directory)
+
+        self.assertEqual(bot.reply("test", {}, "R u there?"), "yes")
+        self.assertEqual(bot.reply("test", {}, "What's up, Buddy"),
+                         "hi Buddy")
+        self.assertEqual(bot.reply("test", {}, "Hello :) buddy"),
+                         "hi buddy")
+        self.assertEqual(len(bot.rules_db.topics["all"].substitutions), 1)
+
+    def test_Normalizer_FoldsWordForms_InMessagesAndPatterns(self):
+        self.local_bot()
+        chatbot_reply = sys.modules["chatbot_reply"]
+        normalizer = chatbot_reply.Normalizer(
+            fold_accents=True, stem=True, synonyms={"lamps": "Light"})
+        bot = chatbot_reply.ChatbotEngine(normalizer=normalizer)
+        directory = os.path.join(self.install_folder, "scripts")
+        os.mkdir(directory)
+        with open(os.path.join(directory, "lights.py"), "w") as f:
+            f.write(LIGHTS_SCRIPT)
+        bot.load_script_directory(directory)
+
+        for message, reply in [
+                ("Turn on the kitchen lights!", "kitchen light on"),
+                ("turning on the Living Room lamp", "Living Room light on"),
+                ("turn on the CAFE lighting", "CAFE light on"),
+                ("my pet is Puppies", "ok"),
+                ("are the puppy's fed?", "no")]:
+            self.assertEqual(bot.reply("test", {}, message), reply)
+        self.assertEqual(normalizer.normalize_text("lamps lighting"),
+                         "light light")
+        with self.assertRaises(ValueError):
+            chatbot_reply.Normalizer(synonyms={"lamp": "floor lamp"})
+
+    def test_TokenBuffer_AppliesEdits_AndAdaptsWordLists(self):
+        substitutions = sys.modules["chatbot_reply.substitutions"]
+        target_class = sys.modules["chatbot_reply.reply"].Target
+        substitution = sys.modules["chatbot_reply"].substitution
+
+        tokens = substitutions.TokenBuffer(["a", "b", "c"])
+        tokens.apply([(2, 3, ["see", "sea"]), (0, 0, ["x"]), (1, 2, [])])
+        self.assertEqual(tokens.words, ["x", "a", "see", "sea"])
+        self.assertEqual(tokens.wordlists(), [["x", "a"], [], ["see", "sea"]])
+        for edits in [[(0, 2, []), (1, 3, [])], [(3, 5, ["y"])]]:
+            with self.assertRaises(ValueError):
+                tokens.apply(edits)
+
+        @substitution(deterministic=True, edits=True)
+        def smileys(text, tokens):
+            return [(i, i + 1, ["smile"]) for i, word in
+                    enumerate(tokens.words) if word == ":)"]
+
+        def shout(text, wordlists):
+            return [[word.upper() for word in wl] for wl in wordlists]
+
+        target = target_class("Hi :) there", [("smileys", smileys),
+                                              ("shout", shout)])
+        self.assertEqual(target.normalized, "hi smile there")
+        self.assertEqual(target.tokenized_words,
+                         (("hi",), ("smile",), ("there",)))
+        self.assertEqual(target.raw_text_between(3, 8), ":)")
+
+        passed = []
+
+        def keep(text, wordlists):
+            passed.append(wordlists)
+            return wordlists
+
+        target_class("Hi there", [("keep", keep), ("keep_again", keep)])
+        self.assertIs(passed[0], passed[1])
+
+        def bad_length(text, wordlists):
+            return wordlists[1:]
+
+        with self.assertRaises(TypeError):
+            target_class("Hi :) there", [("smileys", smileys),
+                                         ("bad_length", bad_length)])
+
+    def test_ResponseTable_ChoosesByWeight_AndRotatesPerUser(self):
+        self.local_bot()
+        chatbot_reply = sys.modules["chatbot_reply"]
+        table = chatbot_reply.ResponseTable([("a", 2), ("b", 5), ("c", 1),
+                                             ("d", 0)])
+        chances = dict.fromkeys(table.responses, 0.0)
+        for i, response in enumerate(table.responses):
+            chances[response] += table._probabilities[i] / len(table)
+            alias = table.responses[table._aliases[i]]
+            chances[alias] += (1 - table._probabilities[i]) / len(table)
+        for response, weight in zip(table.responses, [2, 5, 1, 1]):
+            self.assertAlmostEqual(chances[response], weight / 9.0)
+        cursors = {}
+        self.assertIn(table.choose(cursors), table.responses)
+        self.assertEqual(cursors, {})
+
+        replies = ["reply {0}".format(i) for i in range(10)]
+        first = chatbot_reply.ResponseTable(replies, rotate=True)
+        second = chatbot_reply.ResponseTable(list(replies), rotate=True)
+        picks = [first.choose(cursors) for i in range(4)]
+        picks.extend([second.choose(cursors) for i in range(6)])
+        self.assertEqual(sorted(picks), sorted(replies))
+
+        heavy = chatbot_reply.ResponseTable([("x", 3), ("y", 1)], rotate=True)
+        light = chatbot_reply.ResponseTable([("x", 1), ("y", 1)], rotate=True)
+        self.assertNotEqual(heavy.key, light.key)
+        cursors = {heavy.key: 3, light.key: 3}
+        self.assertIn(light.choose(cursors), ["x", "y"])
+        self.assertEqual(cursors[heavy.key], 3)
+
+        bot = chatbot_reply.ChatbotEngine()
+        directory = os.path.join(self.install_folder, "scripts")
+        os.mkdir(directory)
+        with open(os.path.join(directory, "responses.py"), "w") as f:
+            f.write(RESPONSES_SCRIPT)
+        bot.load_script_directory(directory)
+
+        for user in ["alice", "bob"]:
+            replies = [bot.reply(user, {}, "hello") for i in range(8)]
+            self.assertEqual(sorted(replies[:4]), ["hi", "hiya", "howdy",
+                                                   "yo"])
+            self.assertEqual(replies[4:], replies[:4])
+        self.assertIn(bot.reply("alice", {}, "bye"), ["bye", "ciao"])
+
+    def test_LogCacheStatisticsMenuItem_Succeeds(self):
+        self.plugin.bot.reply("test", {}, "status")
+        self.indigo_mock.server.log.reset_mock()
+        self.plugin.logCacheStatistics()
+        self.assertEqual(self.indigo_mock.server.log.call_count, 3)
+        self.assertFalse(PluginBaseForTest.errorLog.called)
+
     def make_and_start_a_test_device(self, dev_id, name, props):
         dev = DeviceForTest(dev_id, name, props)
         self.indigo_mock.devices[dev_id] = dev
@@ -373,5 +1223,237 @@ class PluginTestCase(IndigoMockTestCase):
             self.assertTrue(p.called)
 
 
+def count_in_new_engine(path, times):
+    """ Run in a child process or a thread by the SharedSQLiteUserStore
+    tests. """
+    import chatbot_reply
+    bot = chatbot_reply.ChatbotEngine(
+        user_store=chatbot_reply.SharedSQLiteUserStore(path))
+    bot.load_script_directory("test_scripts")
+    for i in range(times):
+        bot.reply("test", {}, "count")
+    bot.close()
+
+
+LIGHTS_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class LightsScript(Script):
+    def setup(self):
+        self.alternates = {"room": "(kitchen|living room|caf\\u00e9)"}
+
+    @rule("turn on the _%a:room lights")
+    def rule_lights_on(self):
+        return "{raw_match0} light on"
+
+    @rule("my pet is _*")
+    def rule_my_pet(self):
+        self.uservars["pet"] = self.match["raw_match0"]
+        return "ok"
+
+    @rule("are the %u:pet fed")
+    def rule_pet_fed(self):
+        return "no"
+"""
+
+
+TABLES_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class ShortScript(Script):
+    substitutions = {"r": "are", "u": "you"}
+
+    @rule("are you there")
+    def rule_there(self):
+        return "yes"
+
+class GreetingScript(Script):
+    substitutions = {"what's up": "hello", "what's": "what is"}
+
+    @rule("hello _*")
+    def rule_hello(self):
+        return "hi {raw_match0}"
+"""
+
+
+RESPONSES_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import ResponseTable, Script, rule
+
+class ResponsesScript(Script):
+    hellos = ResponseTable(["hi", "hiya", "howdy", "yo"], rotate=True)
+    byes = ResponseTable([("bye", 3), ("ciao", 1)])
+
+    @rule("hello")
+    def rule_hello(self):
+        return self.hellos
+
+    @rule("bye")
+    def rule_bye(self):
+        return self.byes
+"""
+
+
+PURE_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class PureScript(Script):
+    @rule("hello _*", pure=True)
+    def rule_hello(self):
+        return "hi {raw_match0}"
+
+    @rule("bye _*", pure=True)
+    def rule_bye(self):
+        return "bye {match0}"
+"""
+
+
+TYPO_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class TypoScript(Script):
+    @rule("knock knock")
+    def rule_knock_knock(self):
+        return "who is there"
+
+    @rule("_*", previous_rule="rule_knock_knock")
+    def rule_who(self):
+        return "{match0} who"
+
+    @rule("_*", previous_rule="rule_knock_knok")
+    def rule_typo(self):
+        return "never"
+"""
+
+
+BASE_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class BaseScript(Script):
+    def setup(self):
+        self.greeting = "hello"
+
+    @rule("hi")
+    def rule_hi(self):
+        return self.greeting
+"""
+
+
+DERIVED_SCRIPT = """
+from __future__ import unicode_literals
+import sys
+from chatbot_reply import rule
+from chatbot_reply.constants import _PREFIX
+
+class DerivedScript(sys.modules[_PREFIX + "base"].BaseScript):
+    @rule("derived")
+    def rule_derived(self):
+        return self.greeting
+"""
+
+
+NEW_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class NewScript(Script):
+    @rule("are you new")
+    def rule_new(self):
+        return "yes"
+"""
+
+
+SLOW_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class SlowScript(Script):
+    def setup(self):
+        self.botvars["slow"] = "loading"
+        self.botvars["started"].set()
+        self.botvars["go"].wait(5)
+        self.botvars["slow"] = "loaded"
+
+    @rule("are you new")
+    def rule_new(self):
+        return "yes"
+"""
+
+
+TOPICS_SCRIPT = """
+from __future__ import unicode_literals
+from chatbot_reply import Script, rule
+
+class EagerScript(Script):
+    topic = "eager"
+    eager_setup_user = True
+
+    def setup_user(self, user):
+        self.uservars["eager"] = self.uservars.get("eager", 0) + 1
+
+    @rule("*")
+    def rule_star(self):
+        return "eager"
+
+class LazyScript(Script):
+    topic = "lazy"
+
+    def setup_user(self, user):
+        self.uservars["lazy"] = self.uservars.get("lazy", 0) + 1
+
+    @rule("leave lazy topic")
+    def rule_leave(self):
+        self.current_topic = "all"
+        return "bye"
+
+    @rule("*")
+    def rule_star(self):
+        return "set up {0} times".format(self.uservars["lazy"])
+
+class EnterScript(Script):
+    @rule("enter lazy topic")
+    def rule_enter(self):
+        self.current_topic = "lazy"
+        return "<enter lazy topic>"
+"""
+
+
+class EngineProcessTestCase(PluginTestCase):
+    """ Run all the plugin tests again with the chatbot engine in a
+    child process, and a few that are specific to that. """
+    use_engine_process = True
+
+    def test_EngineProcess_IsReady_AfterLoad(self):
+        self.assertTrue(self.plugin.bot.wait_until_ready(5))
+
+    def test_EngineProcess_PipelinesRequests(self):
+        bot = self.plugin.bot
+        pending = [bot.submit("reply", "test", {}, message)
+                   for message in ["sensor wet", "sensor dry", "sensor wet"]]
+        self.assertEqual([p.result(5) for p in pending],
+                         ["Now the leak sensor is wet.",
+                          "Now the leak sensor is dry.",
+                          "Now the leak sensor is wet."])
+
+    def test_EngineProcess_Restarts_AfterCrash(self):
+        bot = self.plugin.bot
+        bot.wait_until_ready(5)
+        bot._process.terminate()
+        bot._process.join()
+        self.assertEqual(bot.reply("test", {}, "sensor wet"),
+                         "Now the leak sensor is wet.")
+        self.assertEqual(bot.restarts, 1)
+        self.assertTrue(PluginBaseForTest.errorLog.called)
+
+    def test_EngineProcess_RaisesEngineErrors(self):
+        with self.assertRaises(TypeError):
+            self.plugin.bot.reply("test", {}, b"bytes")
+
+
 if __name__ == "__main__":
     unittest.main()
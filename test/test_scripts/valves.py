@@ -20,6 +20,14 @@ class ValveScript(Script):
         self.uservars["leaksensorstatus"] = "dry"
 
 
+    @rule("what can you do", pure=True)
+    def rule_what_can_you_do(self):
+        return "I can tell you about the <valve status help>"
+
+    @rule("valve status help", pure=True)
+    def rule_valve_status_help(self):
+        return "valves and the leak sensor."
+
     @rule("status")
     def rule_status(self):
         return ("Here is where I would tell you everything I know about "
@@ -93,10 +101,31 @@ class ValveScript(Script):
     def rule_open_close_it(self):
         return "What do you want me to {match0}?"
 
+    @rule("why", previous_rule=rule_open_close_it)
+    def rule_why_after_open_close_it(self):
+        return "Because you didn't say which valve."
+
     @rule("[the] _%a:anyvalve", previous_reply="what do you want me to _(open|close)")
     def rule_the_anyvalve_with_previous_whaddayawant(self):
         return "OK, <{botmatch0} the {match0}>"
 
+    @rule("never mind", previous_reply="what do you want me to _(open|close)")
+    def rule_never_mind_with_previous_whaddayawant(self):
+        return "OK, I won't {reply_match0} anything."
+
+    @rule("count")
+    def rule_count(self):
+        self.uservars["count"] = self.uservars.get("count", 0) + 1
+        return "{0}".format(self.uservars["count"])
+
+    @rule("count twice")
+    def rule_count_twice(self):
+        return "<count> and <count>"
+
+    @rule("go around in circles")
+    def rule_go_around_in_circles(self):
+        return "Round and <go around in circles>"
+
     @rule("[turn [the]] water on")
     def rule_turn_the_water_on(self):
         if self.mainvalvestatus() == "open":